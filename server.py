@@ -231,8 +231,22 @@ import hashlib
 import threading
 import shutil
 import ipaddress
+import ast
+import sys
+import re
+import queue
+import atexit
+import gzip
+import socket
+import ssl
+import select
+import random
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait as futures_wait
+from contextlib import contextmanager
 from datetime import datetime, timedelta, timezone
-from typing import Dict, Any, Optional, List
+from decimal import Decimal, ROUND_FLOOR
+from typing import Dict, Any, Optional, List, Tuple, Callable
 
 COMMODITY_ALIASES = {
     "XAG": "XAG/USDT",         # Gümüş token (varsa)
@@ -263,6 +277,18 @@ PORT = int(os.getenv("PORT", "8080"))
 SESSION_SECRET = os.getenv("SESSION_SECRET", os.getenv("FLASK_SECRET", "change_me_session_secret"))
 DB_PATH = os.getenv("DB_PATH", "data.db")
 
+# SQLite bağlantı ayarları (kalıcı bağlantı havuzu, WAL)
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "16").strip() or "16")  # boşta tutulan bağlantı sayısı
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "30000").strip() or "30000")
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(256 * 1024 * 1024)).strip() or "0")  # 0=kapalı
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "16384").strip() or "16384")
+
+# Log/audit yazıları için group-commit writer
+DB_WRITER_SYNC = os.getenv("DB_WRITER_SYNC", "0").strip().lower() in ("1", "true", "yes", "on")
+DB_WRITER_BATCH_MS = float(os.getenv("DB_WRITER_BATCH_MS", "50").strip() or "50")
+DB_WRITER_BATCH_ROWS = int(os.getenv("DB_WRITER_BATCH_ROWS", "200").strip() or "200")
+DB_WRITER_QUEUE_MAX = int(os.getenv("DB_WRITER_QUEUE_MAX", "10000").strip() or "10000")
+
 WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "").strip()
 DRY_RUN_DEFAULT = os.getenv("DRY_RUN", "1").strip().lower() in ("1", "true", "yes", "on")
 TP_PCT_DEFAULT = float(os.getenv("TP_PCT", "0.005").strip() or "0.005")  # 0.50%
@@ -1100,16 +1126,6 @@ def api_public_coins():
         return jsonify({"coins": [{"symbol": s} for s in fallback], "source": "fallback", "cached": False})
 
 
-# Alias: UI bazı yerlerde /api/coins kullanıyor
-@app.get("/api/coins")
-def api_coins_alias():
-    try:
-        return api_public_coins()
-    except Exception:
-        fallback = ["BTC/USDT", "ETH/USDT", "SOL/USDT", "XRP/USDT", "BNB/USDT"]
-        return jsonify({"coins": [{"symbol": s} for s in fallback], "source": "fallback", "cached": False})
-
-
 # ----- Public coins cache (OKX spot USDT) -----
 _PUBLIC_COINS_CACHE = {"ts": 0, "data": None}
 
@@ -1824,13 +1840,103 @@ def handle_error(e):
     # Kullanıcıya sade 500 dön
     return jsonify({"error": "internal server error"}), 500
 
+# =========================
+# HTTP client (host başına keep-alive session havuzu)
+# =========================
+# Tüm dış çağrılar (borsa public/private, Telegram, CoinGecko) buradan geçer: host başına tek
+# requests.Session (bağlantı havuzu + keep-alive), connect/read timeout ayrımı, idempotent GET'lerde
+# jitter'lı retry ve host bazlı istek/latency sayaçları. POST'lar (emir!) ASLA tekrar denenmez.
+HTTP_POOL_CONNECTIONS = int(os.getenv("HTTP_POOL_CONNECTIONS", "4").strip() or "4")
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", "16").strip() or "16")
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "3.05").strip() or "3.05")
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "10").strip() or "10")
+HTTP_GET_RETRIES = int(os.getenv("HTTP_GET_RETRIES", "2").strip() or "2")
+HTTP_RETRY_BASE_MS = int(os.getenv("HTTP_RETRY_BASE_MS", "150").strip() or "150")
+
+_HTTP_SESSIONS: Dict[str, requests.Session] = {}
+_HTTP_LOCK = threading.Lock()
+_HTTP_STATS: Dict[str, Dict[str, Any]] = {}  # host -> {"requests", "errors", "retries", "total_ms", "max_ms"}
+
+def http_session(url: str) -> requests.Session:
+    host = (urllib.parse.urlsplit(url).netloc or "").lower()
+    with _HTTP_LOCK:
+        s = _HTTP_SESSIONS.get(host)
+        if s is None:
+            s = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=max(1, HTTP_POOL_CONNECTIONS),
+                pool_maxsize=max(1, HTTP_POOL_MAXSIZE),
+                max_retries=0,
+            )
+            s.mount("https://", adapter)
+            s.mount("http://", adapter)
+            s.headers.update({"User-Agent": "AU-AutoTrade/1.0"})
+            _HTTP_SESSIONS[host] = s
+        return s
+
+def _http_stat(host: str, ms: float, ok: bool, retry: bool) -> None:
+    with _HTTP_LOCK:
+        st = _HTTP_STATS.setdefault(host, {"requests": 0, "errors": 0, "retries": 0, "total_ms": 0.0, "max_ms": 0.0})
+        st["requests"] += 1
+        st["total_ms"] += ms
+        st["max_ms"] = max(st["max_ms"], ms)
+        if not ok:
+            st["errors"] += 1
+        if retry:
+            st["retries"] += 1
+
+def http_request(method: str, url: str, timeout: Any = None, retries: Optional[int] = None, **kw) -> requests.Response:
+    """requests.request uyumlu; timeout tek sayı verilirse read timeout kabul edilir."""
+    method = method.upper()
+    if timeout is None:
+        timeout = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+    elif not isinstance(timeout, tuple):
+        timeout = (min(HTTP_CONNECT_TIMEOUT, float(timeout)), float(timeout))
+    if retries is None:
+        retries = HTTP_GET_RETRIES if method == "GET" else 0
+    host = (urllib.parse.urlsplit(url).netloc or "").lower()
+    sess = http_session(url)
+    attempt = 0
+    while True:
+        t0 = time.monotonic()
+        try:
+            r = sess.request(method, url, timeout=timeout, **kw)
+        except (requests.ConnectionError, requests.Timeout):
+            _http_stat(host, (time.monotonic() - t0) * 1000.0, False, attempt > 0)
+            if attempt >= retries:
+                raise
+        else:
+            retryable = r.status_code == 429 or r.status_code >= 500
+            _http_stat(host, (time.monotonic() - t0) * 1000.0, not retryable, attempt > 0)
+            if not retryable or attempt >= retries:
+                return r
+        attempt += 1
+        time.sleep((HTTP_RETRY_BASE_MS / 1000.0) * (2 ** (attempt - 1)) * (0.5 + random.random()))
+
+def http_get(url: str, **kw) -> requests.Response:
+    return http_request("GET", url, **kw)
+
+def http_post(url: str, **kw) -> requests.Response:
+    return http_request("POST", url, **kw)
+
+def http_stats() -> Dict[str, Any]:
+    with _HTTP_LOCK:
+        out = {}
+        for host, st in _HTTP_STATS.items():
+            d = dict(st)
+            d["avg_ms"] = round(st["total_ms"] / st["requests"], 1) if st["requests"] else 0.0
+            d["total_ms"] = round(st["total_ms"], 1)
+            d["max_ms"] = round(st["max_ms"], 1)
+            out[host] = d
+        return out
+
 # =========================
 # Helpers
 # =========================
 def http_get_json(url: str, headers: dict) -> dict:
-    req = urllib.request.Request(url, headers=headers, method="GET")
-    with urllib.request.urlopen(req, timeout=15) as resp:
-        raw = resp.read().decode("utf-8", errors="ignore")
+    resp = http_get(url, headers=headers, timeout=15)
+    resp.raise_for_status()
+    raw = resp.text
     try:
         return json.loads(raw)
     except Exception:
@@ -2036,119 +2142,1102 @@ def canon_symbol(sym: str) -> str:
         s = s[:-4] + "/USDT"
     return s
 
+# =========================
+# Exchange adapters
+# =========================
+# Borsa + credential seti başına tek instance (LRU cache): header şablonları ve HMAC key objesi bir kez
+# hazırlanır, HTTP host başına pooled session'dan (http_request) gider. Her operasyonun latency'si
+# borsa/op bazında sayılır (/admin/metrics.json -> exchange).
+EXCHANGE_HTTP_TIMEOUT = float(os.getenv("EXCHANGE_HTTP_TIMEOUT", "15").strip() or "15")
+EXCHANGE_ADAPTER_CACHE_MAX = int(os.getenv("EXCHANGE_ADAPTER_CACHE_MAX", "512").strip() or "512")
+
+_ADAPTERS: "OrderedDict[Tuple[str, str, str, str], Any]" = OrderedDict()
+_ADAPTER_LOCK = threading.Lock()
+_ADAPTER_STATS: Dict[str, Dict[str, Dict[str, float]]] = {}  # ex -> op -> {"calls", "errors", "total_ms", "max_ms"}
+
+def _fmt_amt(x: float) -> str:
+    return f"{float(x):.8f}".rstrip("0").rstrip(".")
+
+def _empty_fills() -> Dict[str, Any]:
+    return {"fill_price": 0.0, "fill_qty": 0.0, "real_usdt": 0.0, "fees": []}  # fees: [(ccy, amt, px_hint)]
+
+def _adapter_stat(ex: str, op: str, ms: float, ok: bool) -> None:
+    with _ADAPTER_LOCK:
+        st = _ADAPTER_STATS.setdefault(ex, {}).setdefault(op, {"calls": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0})
+        st["calls"] += 1
+        st["total_ms"] += ms
+        st["max_ms"] = max(st["max_ms"], ms)
+        if not ok:
+            st["errors"] += 1
+
+# Fill confirmation: emir sonrası sabit sleep yerine exponential backoff + deadline ile poll;
+# private WS order update'i (şimdilik OKX orders kanalı) gelirse bekleme anında biter.
+# Kısmi fill'ler VWAP fiyat / toplam qty / toplam fee olarak birleştirilir.
+FILL_CONFIRM_DEADLINE_SEC = float(os.getenv("FILL_CONFIRM_DEADLINE_SEC", "3").strip() or "3")
+FILL_CONFIRM_BASE_MS = float(os.getenv("FILL_CONFIRM_BASE_MS", "50").strip() or "50")
+FILL_CONFIRM_MAX_MS = float(os.getenv("FILL_CONFIRM_MAX_MS", "800").strip() or "800")
+
+_FILL_COND = threading.Condition()
+_FILL_EVENTS: "OrderedDict[Tuple[str, str], Tuple[Dict[str, Any], bool]]" = OrderedDict()  # (ex, ord_id) -> (fills, done)
+_FILL_STATS: Dict[str, float] = {"confirms": 0, "raw": 0, "poll": 0, "ws": 0, "timeouts": 0, "polls": 0, "total_ms": 0.0}
+
+def _fills_from_trades(rows: List[Tuple[float, float, str, float]]) -> Dict[str, Any]:
+    """rows: (price, qty, fee_ccy, fee_amt) -> VWAP fill dict."""
+    out = _empty_fills()
+    qty_sum = notional = 0.0
+    for px, qty, fee_ccy, fee_amt in rows:
+        qty_sum += qty
+        notional += px * qty
+        if fee_amt:
+            out["fees"].append((safe_str(fee_ccy).upper(), abs(fee_amt), px))
+    out["fill_qty"] = qty_sum
+    out["real_usdt"] = notional
+    out["fill_price"] = (notional / qty_sum) if qty_sum > 0 and notional > 0 else 0.0
+    return out
+
+def _fills_from_totals(qty: float, notional: float, fee_ccy: str = "", fee_amt: float = 0.0) -> Dict[str, Any]:
+    out = _empty_fills()
+    out["fill_qty"] = qty
+    out["real_usdt"] = notional
+    out["fill_price"] = (notional / qty) if qty > 0 and notional > 0 else 0.0
+    if fee_amt:
+        out["fees"].append((safe_str(fee_ccy).upper(), abs(fee_amt), out["fill_price"]))
+    return out
+
+def fill_event_push(ex: str, ord_id: str, fills: Dict[str, Any], done: bool) -> None:
+    """Private WS order update'i (kümülatif) -> bekleyen confirm_fills uyanır."""
+    key = (_ex_price_norm(ex), safe_str(ord_id))
+    if not key[1]:
+        return
+    with _FILL_COND:
+        _FILL_EVENTS[key] = (fills, bool(done))
+        _FILL_EVENTS.move_to_end(key)
+        while len(_FILL_EVENTS) > 512:
+            _FILL_EVENTS.popitem(last=False)
+        _FILL_COND.notify_all()
+
+def confirm_fills(adapter: "ExchangeAdapter", symbol: str, ord_id: str, raw: Any = None,
+                  deadline_sec: Optional[float] = None) -> Dict[str, Any]:
+    """Emir tam dolana (ya da iptal olana) kadar bekler; deadline'da eldeki en iyi kısmi veri döner."""
+    t0 = time.monotonic()
+    deadline = t0 + (FILL_CONFIRM_DEADLINE_SEC if deadline_sec is None else float(deadline_sec))
+    key = (adapter.name, safe_str(ord_id))
+    delay = max(0.005, min(FILL_CONFIRM_BASE_MS, FILL_CONFIRM_MAX_MS) / 1000.0)
+    best = _empty_fills()
+    src = "timeouts"
+    first = True
+    try:
+        while True:
+            with _FILL_COND:
+                ev = _FILL_EVENTS.get(key)
+            if ev is not None:
+                # terminal sonuç kesindir; max-qty kuralı sadece deadline'da kısmi sonuçlar arasında seçim için
+                if ev[1]:
+                    best = ev[0]
+                    src = "ws"
+                    break
+                if ev[0].get("fill_qty", 0.0) >= best["fill_qty"]:
+                    best = ev[0]
+            try:
+                fills, done = adapter._poll_fills(symbol, ord_id, raw if first else None)
+            except Exception:
+                fills, done = None, False
+            if not first or raw is None:
+                _FILL_STATS["polls"] += 1
+            if done:
+                if fills is not None:
+                    best = fills
+                src = "raw" if (first and raw is not None) else "poll"
+                break
+            if fills and fills.get("fill_qty", 0.0) >= best["fill_qty"]:
+                best = fills
+            first = False
+            remaining = deadline - time.monotonic()
+            if not ord_id or remaining <= 0:
+                break
+            with _FILL_COND:
+                _FILL_COND.wait_for(lambda: bool((_FILL_EVENTS.get(key) or ({}, False))[1]), timeout=min(delay, remaining))
+            delay = min(FILL_CONFIRM_MAX_MS / 1000.0, delay * 2)
+    finally:
+        with _FILL_COND:
+            _FILL_EVENTS.pop(key, None)
+        _FILL_STATS["confirms"] += 1
+        _FILL_STATS[src] += 1
+        _FILL_STATS["total_ms"] += (time.monotonic() - t0) * 1000.0
+    return best
+
+def exchange_adapter_stats() -> Dict[str, Any]:
+    with _ADAPTER_LOCK:
+        out: Dict[str, Any] = {"cached": len(_ADAPTERS)}
+        fc = dict(_FILL_STATS)
+        fc["avg_ms"] = round(fc["total_ms"] / fc["confirms"], 1) if fc["confirms"] else 0.0
+        fc["total_ms"] = round(fc["total_ms"], 1)
+        out["fill_confirm"] = fc
+        for ex, ops in _ADAPTER_STATS.items():
+            out[ex] = {
+                op: dict(st, avg_ms=round(st["total_ms"] / st["calls"], 1) if st["calls"] else 0.0,
+                         total_ms=round(st["total_ms"], 1), max_ms=round(st["max_ms"], 1))
+                for op, st in ops.items()
+            }
+        return out
+
+
+class ExchangeAdapter:
+    """Ortak iskelet: market_buy_quote / market_sell_base / fetch_fills / get_balance.
+
+    Alt sınıf _poll_fills(symbol, ord_id, raw) -> (fills, done) verir; raw sadece ilk denemede gelir.
+    """
+
+    name = ""
+    digest = hashlib.sha256
+    convert_coin_fees = True  # False: USDT dışı fee coin olarak kalır (TP manager sonra çevirir)
+    balance_delta_fees = False  # True: emir öncesi/sonrası bakiye farkından fee düzeltmesi
+    batch_max = 1  # toplu emir isteği başına max emir (1: toplu endpoint yok, sırayla)
+
+    def __init__(self, api_key: str, api_secret: str, api_passphrase: str = ""):
+        self.api_key = api_key
+        self.api_passphrase = api_passphrase
+        self._mac = hmac.new(api_secret.encode("utf-8"), digestmod=self.digest)
+        # balance tracker durumu: ccy -> (value, ts, src)
+        self.balances: Dict[str, Tuple[float, float, str]] = {}
+        self._bal_lock = threading.Lock()
+        self.last_used = 0.0
+        self._ws_started = False
+        self._ws_live = False
+
+    def _sign(self, msg: str) -> "hmac.HMAC":
+        m = self._mac.copy()
+        m.update(msg.encode("utf-8"))
+        return m
+
+    @contextmanager
+    def _measure(self, op: str):
+        t0 = time.monotonic()
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            _adapter_stat(self.name, op, (time.monotonic() - t0) * 1000.0, ok)
+
+    def market_buy_quote(self, symbol: str, quote_amount: float) -> Dict[str, Any]:
+        with self._measure("order"):
+            return self._market_order(symbol, "BUY", quote_amount)
+
+    def market_sell_base(self, symbol: str, base_qty: float) -> Dict[str, Any]:
+        with self._measure("order"):
+            return self._market_order(symbol, "SELL", base_qty)
+
+    def market_order_batch(self, orders: List[Tuple[str, str, float]]) -> List[Dict[str, Any]]:
+        """[(symbol, side, amount)] (en çok batch_max) -> emir başına _market_order sonucu, aynı sırada."""
+        with self._measure("batch_order"):
+            return self._market_order_batch(orders)
+
+    def fetch_fills(self, symbol: str, ord_id: str, raw: Any = None) -> Dict[str, Any]:
+        with self._measure("fills"):
+            return confirm_fills(self, symbol, ord_id, raw)
+
+    def get_balance(self, ccy: str = "USDT") -> float:
+        ccy = safe_str(ccy).strip().upper() or "USDT"
+        with self._measure("balance"):
+            v = self._get_balance(ccy)
+        _balance_track_set(self, ccy, v, "rest")
+        return v
+
+    def _market_order(self, symbol: str, side: str, amount: float) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    def _market_order_batch(self, orders: List[Tuple[str, str, float]]) -> List[Dict[str, Any]]:
+        return [self._market_order(sym, side, amt) for sym, side, amt in orders]
+
+    def _poll_fills(self, symbol: str, ord_id: str, raw: Any) -> Tuple[Dict[str, Any], bool]:
+        raise NotImplementedError
+
+    def _get_balance(self, ccy: str) -> float:
+        raise NotImplementedError
+
+
+class OkxAdapter(ExchangeAdapter):
+    name = "OKX"
+    convert_coin_fees = False
+    balance_delta_fees = True
+
+    def __init__(self, api_key: str, api_secret: str, api_passphrase: str = ""):
+        super().__init__(api_key, api_secret, api_passphrase)
+        self.base_url = os.getenv("OKX_BASE_URL", "https://www.okx.com").rstrip("/")
+        self._hdr = {"OK-ACCESS-KEY": api_key, "OK-ACCESS-PASSPHRASE": api_passphrase, "Content-Type": "application/json"}
+
+    def _req(self, method: str, path: str, query: str = "", body: str = "") -> Dict[str, Any]:
+        ts = datetime.now(timezone.utc).isoformat(timespec="milliseconds").replace("+00:00", "Z")
+        req_path = path + ("?" + query if query else "")
+        h = dict(self._hdr)
+        h["OK-ACCESS-SIGN"] = base64.b64encode(self._sign(ts + method + req_path + body).digest()).decode()
+        h["OK-ACCESS-TIMESTAMP"] = ts
+        r = http_request(method, self.base_url + req_path, headers=h,
+                         data=body.encode("utf-8") if body else None, timeout=EXCHANGE_HTTP_TIMEOUT)
+        return (r.json() if r is not None else {}) or {}
+
+    batch_max = 20  # /api/v5/trade/batch-orders
+
+    @staticmethod
+    def _order_body(symbol: str, side: str, amount: float) -> Dict[str, Any]:
+        body_obj: Dict[str, Any] = {
+            "instId": symbol.replace("/", "-").replace("_", "-").upper(),
+            "tdMode": "cash",
+            "side": "buy" if side == "BUY" else "sell",
+            "ordType": "market",
+        }
+        if side == "BUY":
+            body_obj["tgtCcy"] = "quote_ccy"
+        body_obj["sz"] = _fmt_amt(amount)
+        return body_obj
+
+    def _market_order(self, symbol: str, side: str, amount: float) -> Dict[str, Any]:
+        body_obj = self._order_body(symbol, side, amount)
+        j = self._req("POST", "/api/v5/trade/order", body=json.dumps(body_obj, separators=(",", ":"), ensure_ascii=False))
+        if safe_str(j.get("code")) != "0":
+            return {"ok": False, "reason": safe_str(j.get("msg") or "OKX emir hatası"), "raw": j}
+        try:
+            ord_id = safe_str((j.get("data") or [{}])[0].get("ordId") or "")
+        except Exception:
+            ord_id = ""
+        return {"ok": True, "ord_id": ord_id, "raw": j}
+
+    def _market_order_batch(self, orders: List[Tuple[str, str, float]]) -> List[Dict[str, Any]]:
+        # clOrdId ile emir <-> sonuç eşlemesi (code "1"/"2" = bazıları başarısız)
+        tag = f"b{int(time.time() * 1000)}"
+        reqs = [dict(self._order_body(*o), clOrdId=f"{tag}n{i}") for i, o in enumerate(orders)]
+        j = self._req("POST", "/api/v5/trade/batch-orders", body=json.dumps(reqs, separators=(",", ":"), ensure_ascii=False))
+        by_cl = {safe_str(d.get("clOrdId")): d for d in (j.get("data") or []) if isinstance(d, dict)}
+        out: List[Dict[str, Any]] = []
+        for rq in reqs:
+            d = by_cl.get(rq["clOrdId"]) or {}
+            if safe_str(d.get("sCode")) == "0" and d.get("ordId"):
+                out.append({"ok": True, "ord_id": safe_str(d.get("ordId")), "raw": d})
+            else:
+                out.append({"ok": False, "reason": safe_str(d.get("sMsg") or j.get("msg") or "OKX emir hatası"), "raw": d or j})
+        return out
+
+    @staticmethod
+    def _order_fills(d: Dict[str, Any]) -> Tuple[Dict[str, Any], bool]:
+        # order detail / WS orders kanalı: kümülatif accFillSz + avgPx (VWAP) + fee
+        qty = _to_float(d.get("accFillSz"), 0.0)
+        px = _to_float(d.get("avgPx"), 0.0)
+        fills = _fills_from_totals(qty, qty * px, safe_str(d.get("feeCcy")), _to_float(d.get("fee"), 0.0))
+        return fills, safe_str(d.get("state")) in ("filled", "canceled", "mmp_canceled")
+
+    def _poll_fills(self, symbol: str, ord_id: str, raw: Any) -> Tuple[Dict[str, Any], bool]:
+        if not ord_id:
+            return _empty_fills(), True
+        inst_id = symbol.replace("/", "-").replace("_", "-").upper()
+        j = self._req("GET", "/api/v5/trade/order", query=f"ordId={ord_id}&instId={inst_id}")
+        d = (j.get("data") or []) if safe_str(j.get("code")) == "0" else []
+        if not d:
+            return _empty_fills(), False
+        return self._order_fills(d[0])
+
+    def _get_balance(self, ccy: str) -> float:
+        j = self._req("GET", "/api/v5/account/balance", query=f"ccy={urllib.parse.quote(ccy)}")
+        data = j.get("data") or []
+        details = (data[0].get("details") or []) if data else []
+        if not details:
+            return 0.0
+        d0 = details[0] or {}
+        # cashBal genelde spot/free'yi verir, yoksa availEq/eq fallback
+        v = d0.get("cashBal")
+        if v is None:
+            v = d0.get("availEq")
+        if v is None:
+            v = d0.get("eq")
+        return _to_float(v, 0.0)
+
+
+class BinanceAdapter(ExchangeAdapter):
+    name = "BINANCE"
+    base_url = "https://api.binance.com"
+
+    def __init__(self, api_key: str, api_secret: str, api_passphrase: str = ""):
+        super().__init__(api_key, api_secret, api_passphrase)
+        self._hdr = {"X-MBX-APIKEY": api_key}
+
+    def _req(self, method: str, path: str, params: Dict[str, str]) -> requests.Response:
+        params = dict(params, recvWindow="5000", timestamp=str(int(time.time() * 1000)))
+        qs = urllib.parse.urlencode(params)
+        url = f"{self.base_url}{path}?{qs}&signature={self._sign(qs).hexdigest()}"
+        return http_request(method, url, headers=self._hdr, timeout=EXCHANGE_HTTP_TIMEOUT)
+
+    def _market_order(self, symbol: str, side: str, amount: float) -> Dict[str, Any]:
+        params = {"symbol": _sym_norm_for_price("BINANCE", symbol).replace("/", ""), "side": side, "type": "MARKET"}
+        params["quoteOrderQty" if side == "BUY" else "quantity"] = _fmt_amt(amount)
+        r = self._req("POST", "/api/v3/order", params)
+        j = (r.json() if r is not None else {}) or {}
+        if "code" in j and int(j.get("code") or 0) != 0:
+            return {"ok": False, "reason": safe_str(j.get("msg") or "Binance emir hatası"), "raw": j}
+        return {"ok": True, "ord_id": safe_str(j.get("orderId") or ""), "raw": j}
+
+    _DONE = ("FILLED", "CANCELED", "EXPIRED", "REJECTED", "EXPIRED_IN_MATCH")
+
+    def _poll_fills(self, symbol: str, ord_id: str, raw: Any) -> Tuple[Dict[str, Any], bool]:
+        if isinstance(raw, dict) and raw.get("status") in self._DONE:
+            # MARKET emir FULL yanıtı fill'leri zaten taşır; ekstra istek yok
+            executed_qty = _to_float(raw.get("executedQty"), 0.0)
+            rows = [(_to_float(f.get("price"), 0.0), _to_float(f.get("qty"), 0.0),
+                     safe_str(f.get("commissionAsset")), _to_float(f.get("commission"), 0.0)) for f in raw.get("fills") or []]
+            if rows or executed_qty <= 0:
+                out = _fills_from_trades(rows)
+                cquote = _to_float(raw.get("cummulativeQuoteQty"), 0.0)
+                if executed_qty > 0 and cquote > 0:
+                    out.update(fill_qty=executed_qty, real_usdt=cquote, fill_price=cquote / executed_qty)
+                return out, True
+        if not ord_id:
+            return _empty_fills(), True
+        sym = _sym_norm_for_price("BINANCE", symbol).replace("/", "")
+        r = self._req("GET", "/api/v3/order", {"symbol": sym, "orderId": ord_id})
+        o = (r.json() if r is not None else {}) or {}
+        executed_qty = _to_float(o.get("executedQty"), 0.0)
+        partial = _fills_from_totals(executed_qty, _to_float(o.get("cummulativeQuoteQty"), 0.0))
+        if o.get("status") not in self._DONE:
+            return partial, False
+        if executed_qty <= 0:
+            return partial, True
+        r = self._req("GET", "/api/v3/myTrades", {"symbol": sym, "orderId": ord_id})
+        trades = (r.json() if r is not None else []) or []
+        rows = [(_to_float(t.get("price"), 0.0), _to_float(t.get("qty"), 0.0),
+                 safe_str(t.get("commissionAsset")), _to_float(t.get("commission"), 0.0)) for t in trades if isinstance(t, dict)]
+        out = _fills_from_trades(rows)
+        if out["fill_qty"] < executed_qty * 0.999:
+            return partial, False  # trade listesi henüz tamamlanmadı
+        return out, True
+
+    def _get_balance(self, ccy: str) -> float:
+        r = self._req("GET", "/api/v3/account", {})
+        r.raise_for_status()
+        for b in (r.json() or {}).get("balances") or []:
+            if (b.get("asset") or "").upper() == ccy:
+                return _to_float(b.get("free"), 0) + _to_float(b.get("locked"), 0)
+        return 0.0
+
+
+class BybitAdapter(ExchangeAdapter):
+    name = "BYBIT"
+    base_url = "https://api.bybit.com"
+    recv_window = "5000"
+
+    def __init__(self, api_key: str, api_secret: str, api_passphrase: str = ""):
+        super().__init__(api_key, api_secret, api_passphrase)
+        self._hdr = {"X-BAPI-API-KEY": api_key, "X-BAPI-RECV-WINDOW": self.recv_window}
+
+    def _req(self, method: str, path: str, query: str = "", body: str = "") -> requests.Response:
+        ts = str(int(time.time() * 1000))
+        h = dict(self._hdr)
+        h["X-BAPI-TIMESTAMP"] = ts
+        h["X-BAPI-SIGN"] = self._sign(ts + self.api_key + self.recv_window + (body or query)).hexdigest()
+        if body:
+            h["Content-Type"] = "application/json"
+        url = f"{self.base_url}{path}" + ("?" + query if query else "")
+        return http_request(method, url, headers=h, data=body.encode("utf-8") if body else None, timeout=EXCHANGE_HTTP_TIMEOUT)
+
+    batch_max = 10  # /v5/order/create-batch, spot limiti
+
+    @staticmethod
+    def _order_body(symbol: str, side: str, amount: float) -> Dict[str, Any]:
+        return {
+            "symbol": _sym_norm_for_price("BYBIT", symbol).replace("/", ""),
+            "side": "Buy" if side == "BUY" else "Sell",
+            "orderType": "Market",
+            "qty": _fmt_amt(amount),
+            "marketUnit": "quoteCoin" if side == "BUY" else "baseCoin",
+        }
+
+    def _market_order_batch(self, orders: List[Tuple[str, str, float]]) -> List[Dict[str, Any]]:
+        tag = f"b{int(time.time() * 1000)}"
+        reqs = [dict(self._order_body(*o), orderLinkId=f"{tag}n{i}") for i, o in enumerate(orders)]
+        r = self._req("POST", "/v5/order/create-batch",
+                      body=json.dumps({"category": "spot", "request": reqs}, separators=(",", ":"), ensure_ascii=False))
+        j = (r.json() if r is not None else {}) or {}
+        if int(_to_float(j.get("retCode"), 0.0)) != 0:
+            return [{"ok": False, "reason": safe_str(j.get("retMsg") or "Bybit emir hatası"), "raw": j} for _ in reqs]
+        by_link = {safe_str(x.get("orderLinkId")): x for x in ((j.get("result") or {}).get("list") or []) if isinstance(x, dict)}
+        ext = (j.get("retExtInfo") or {}).get("list") or []  # istek sırasıyla code/msg
+        out: List[Dict[str, Any]] = []
+        for i, rq in enumerate(reqs):
+            x = by_link.get(rq["orderLinkId"]) or {}
+            e = ext[i] if i < len(ext) and isinstance(ext[i], dict) else {}
+            if int(_to_float(e.get("code"), 0.0)) == 0 and x.get("orderId"):
+                out.append({"ok": True, "ord_id": safe_str(x.get("orderId")), "raw": x})
+            else:
+                out.append({"ok": False, "reason": safe_str(e.get("msg") or "Bybit emir hatası"), "raw": x or e})
+        return out
+
+    def _market_order(self, symbol: str, side: str, amount: float) -> Dict[str, Any]:
+        body_obj = dict(category="spot", **self._order_body(symbol, side, amount))
+        r = self._req("POST", "/v5/order/create", body=json.dumps(body_obj, separators=(",", ":"), ensure_ascii=False))
+        j = (r.json() if r is not None else {}) or {}
+        if int(_to_float(j.get("retCode"), 0.0)) != 0:
+            return {"ok": False, "reason": safe_str(j.get("retMsg") or "Bybit emir hatası"), "raw": j}
+        return {"ok": True, "ord_id": safe_str(((j.get("result") or {}).get("orderId")) or ""), "raw": j}
+
+    _DONE = ("Filled", "PartiallyFilledCanceled", "Cancelled", "Rejected", "Deactivated")
+
+    def _get_list(self, path: str, query: str) -> List[Dict[str, Any]]:
+        r = self._req("GET", path, query=query)
+        j = (r.json() if r is not None else {}) or {}
+        if int(_to_float(j.get("retCode"), 0.0)) != 0:
+            return []
+        return ((j.get("result") or {}).get("list")) or []
+
+    def _poll_fills(self, symbol: str, ord_id: str, raw: Any) -> Tuple[Dict[str, Any], bool]:
+        if not ord_id:
+            return _empty_fills(), True
+        sym = _sym_norm_for_price("BYBIT", symbol).replace("/", "")
+        q = f"category=spot&orderId={ord_id}&symbol={sym}"
+        orders = self._get_list("/v5/order/realtime", q) or self._get_list("/v5/order/history", q)
+        if not orders:
+            return _empty_fills(), False
+        o = orders[0]
+        cum_qty = _to_float(o.get("cumExecQty"), 0.0)
+        partial = _fills_from_totals(cum_qty, _to_float(o.get("cumExecValue"), 0.0))
+        if safe_str(o.get("orderStatus")) not in self._DONE:
+            return partial, False
+        if cum_qty <= 0:
+            return partial, True
+        rows = []
+        for e in self._get_list("/v5/execution/list", q + "&limit=100"):
+            rows.append((_to_float(e.get("execPrice"), 0.0), _to_float(e.get("execQty"), 0.0),
+                         safe_str(e.get("feeCurrency")), _to_float(e.get("execFee"), 0.0)))
+        out = _fills_from_trades(rows)
+        if out["fill_qty"] < cum_qty * 0.999:
+            return partial, False  # execution listesi gecikmeli düşer
+        return out, True
+
+    def _get_balance(self, ccy: str) -> float:
+        r = self._req("GET", "/v5/account/wallet-balance", query="accountType=UNIFIED")
+        r.raise_for_status()
+        for acc in ((r.json() or {}).get("result") or {}).get("list") or []:
+            for c in acc.get("coin") or []:
+                if (c.get("coin") or "").upper() == ccy:
+                    v = c.get("walletBalance")
+                    if v is None:
+                        v = c.get("availableToWithdraw")
+                    if v is None:
+                        v = c.get("equity")
+                    return _to_float(v, 0.0)
+        return 0.0
+
+
+class GateAdapter(ExchangeAdapter):
+    name = "GATEIO"
+    base_url = "https://api.gateio.ws"
+    digest = hashlib.sha512
+    _EMPTY_BODY_HASH = hashlib.sha512(b"").hexdigest()
+
+    def __init__(self, api_key: str, api_secret: str, api_passphrase: str = ""):
+        super().__init__(api_key, api_secret, api_passphrase)
+        self._hdr = {"KEY": api_key}
+
+    def _req(self, method: str, path: str, query: str = "", body: str = "") -> requests.Response:
+        ts = str(int(time.time()))
+        body_hash = hashlib.sha512(body.encode("utf-8")).hexdigest() if body else self._EMPTY_BODY_HASH
+        h = dict(self._hdr)
+        h["Timestamp"] = ts
+        h["SIGN"] = self._sign(f"{method}\n{path}\n{query}\n{body_hash}\n{ts}").hexdigest()
+        if body:
+            h["Content-Type"] = "application/json"
+        url = f"{self.base_url}{path}" + ("?" + query if query else "")
+        return http_request(method, url, headers=h, data=body.encode("utf-8") if body else None, timeout=EXCHANGE_HTTP_TIMEOUT)
+
+    batch_max = 4  # /api/v4/spot/batch_orders: istek başına en çok 4 parite
+
+    @staticmethod
+    def _order_body(symbol: str, side: str, amount: float) -> Dict[str, Any]:
+        # Gate spot market: amount BUY'da quote, SELL'de base
+        return {
+            "currency_pair": _sym_norm_for_price("GATE", symbol).replace("/", "_"),
+            "side": "buy" if side == "BUY" else "sell",
+            "type": "market",
+            "amount": _fmt_amt(amount),
+        }
+
+    def _market_order_batch(self, orders: List[Tuple[str, str, float]]) -> List[Dict[str, Any]]:
+        # text (t-...) toplu istekte zorunlu; sonuç eşlemesi de onunla
+        tag = f"t-b{int(time.time() * 1000)}"
+        reqs = [dict(self._order_body(*o), text=f"{tag}n{i}") for i, o in enumerate(orders)]
+        r = self._req("POST", "/api/v4/spot/batch_orders", body=json.dumps(reqs, separators=(",", ":"), ensure_ascii=False))
+        j = (r.json() if r is not None else []) or []
+        if not isinstance(j, list):
+            return [{"ok": False, "reason": safe_str((j or {}).get("message") or "Gate emir hatası"), "raw": j} for _ in reqs]
+        by_text = {safe_str(x.get("text")): x for x in j if isinstance(x, dict)}
+        out: List[Dict[str, Any]] = []
+        for rq in reqs:
+            x = by_text.get(rq["text"]) or {}
+            if x.get("succeeded") and x.get("id"):
+                out.append({"ok": True, "ord_id": safe_str(x.get("id")), "raw": x})
+            else:
+                out.append({"ok": False, "reason": safe_str(x.get("message") or "Gate emir hatası"), "raw": x})
+        return out
+
+    def _market_order(self, symbol: str, side: str, amount: float) -> Dict[str, Any]:
+        body_obj = self._order_body(symbol, side, amount)
+        r = self._req("POST", "/api/v4/spot/orders", body=json.dumps(body_obj, separators=(",", ":"), ensure_ascii=False))
+        j = (r.json() if r is not None else {}) or {}
+        if isinstance(j, dict) and j.get("message") and j.get("label"):
+            return {"ok": False, "reason": safe_str(j.get("message")), "raw": j}
+        return {"ok": True, "ord_id": safe_str(j.get("id") or ""), "raw": j}
+
+    @staticmethod
+    def _order_fills(j: Dict[str, Any]) -> Dict[str, Any]:
+        # filled_amount = gerçekleşen base miktar (kümülatif), filled_total = quote. Eski yanıtlarda yoksa sadece
+        # kapanmış SELL için amount'a düş: market BUY'da amount quote (USDT) tutarıdır, base miktar değil.
+        fill_qty = _to_float(j.get("filled_amount"), 0.0)
+        if fill_qty <= 0 and safe_str(j.get("side")).lower() == "sell" and j.get("status") == "closed":
+            fill_qty = _to_float(j.get("amount"), 0.0)
+        return _fills_from_totals(fill_qty, _to_float(j.get("filled_total"), 0.0),
+                                  safe_str(j.get("fee_currency")), _to_float(j.get("fee"), 0.0))
+
+    def _poll_fills(self, symbol: str, ord_id: str, raw: Any) -> Tuple[Dict[str, Any], bool]:
+        if isinstance(raw, dict) and raw.get("status") in ("closed", "cancelled") and abs(_to_float(raw.get("fee"), 0.0)) > 0:
+            return self._order_fills(raw), True
+        if not ord_id:
+            return (self._order_fills(raw) if isinstance(raw, dict) else _empty_fills()), True
+        # create yanıtı açık / fee'siz ise emir detayından al
+        pair = _sym_norm_for_price("GATE", symbol).replace("/", "_")
+        r = self._req("GET", f"/api/v4/spot/orders/{ord_id}", query=f"currency_pair={pair}")
+        j = (r.json() if r is not None else {}) or {}
+        if not isinstance(j, dict) or not j.get("status"):
+            return (self._order_fills(raw) if isinstance(raw, dict) else _empty_fills()), False
+        return self._order_fills(j), j.get("status") != "open"
+
+    def _get_balance(self, ccy: str) -> float:
+        r = self._req("GET", "/api/v4/spot/accounts")
+        r.raise_for_status()
+        j = r.json()
+        if isinstance(j, list):
+            for row in j:
+                if (row.get("currency") or "").upper() == ccy:
+                    return _to_float(row.get("available"), 0) + _to_float(row.get("locked"), 0)
+        return 0.0
+
+
+_ADAPTER_CLASSES: Dict[str, type] = {
+    "OKX": OkxAdapter,
+    "BINANCE": BinanceAdapter,
+    "BYBIT": BybitAdapter,
+    "GATEIO": GateAdapter,
+}
+
+def exchange_adapter(exchange_id: str, api_key: str, api_secret: str, api_passphrase: str = "") -> Optional[ExchangeAdapter]:
+    """Credential seti başına cache'li adapter; desteklenmeyen borsada None."""
+    ex = _ex_price_norm(exchange_id)
+    cls = _ADAPTER_CLASSES.get(ex)
+    if cls is None:
+        return None
+    passphrase = safe_str(api_passphrase).strip() if ex == "OKX" else ""  # sadece OKX kullanır
+    key = (ex, safe_str(api_key).strip(), safe_str(api_secret).strip(), passphrase)
+    with _ADAPTER_LOCK:
+        ad = _ADAPTERS.get(key)
+        if ad is not None:
+            _ADAPTERS.move_to_end(key)
+            return ad
+    ad = cls(key[1], key[2], key[3])
+    with _ADAPTER_LOCK:
+        _ADAPTERS[key] = ad
+        while len(_ADAPTERS) > max(1, EXCHANGE_ADAPTER_CACHE_MAX):
+            _ADAPTERS.popitem(last=False)
+    return ad
+
+
+# =========================
+# Instrument registry (lot / tick / min-max notional)
+# =========================
+# Borsa başına tek public istekle tüm USDT spot paritelerinin emir kuralları; canonical sembolle
+# (BTC/USDT) indekslenir. Periyodik yenilenir, diske yazılır (restart'ta ağ beklemeden hazır).
+# place_order miktarı göndermeden önce lot adımına yuvarlar, min/max'a göre kontrol eder.
+INSTRUMENT_REFRESH_SEC = float(os.getenv("INSTRUMENT_REFRESH_SEC", "21600").strip() or "21600")
+INSTRUMENT_RETRY_SEC = float(os.getenv("INSTRUMENT_RETRY_SEC", "300").strip() or "300")
+INSTRUMENT_SNAPSHOT_PATH = os.getenv("INSTRUMENT_SNAPSHOT_PATH", "").strip()
+
+_INSTR_LOCK = threading.Lock()
+_INSTR: Dict[str, Dict[str, Any]] = {}  # ex -> {"ts": epoch, "items": {sym: rec}}
+_INSTR_FETCH_LOCKS: Dict[str, threading.Lock] = {ex: threading.Lock() for ex in ("OKX", "BINANCE", "BYBIT", "GATEIO")}
+_INSTR_STATE: Dict[str, Any] = {"started": False, "refreshes": 0, "errors": 0, "misses": 0, "fail_ts": {}}
+_INSTR_WANT: set = set()  # emir yolunun istediği borsa yenilemeleri (_INSTR_LOCK altında); loop tüketir
+_INSTR_WAKE = threading.Event()
+
+def _instr_rec(lot: float = 0.0, min_qty: float = 0.0, max_qty: float = 0.0, tick: float = 0.0,
+               min_notional: float = 0.0, max_notional: float = 0.0, quote_step: float = 0.0,
+               live: bool = True) -> Dict[str, Any]:
+    return {"lot": lot, "min_qty": min_qty, "max_qty": max_qty, "tick": tick, "min_notional": min_notional,
+            "max_notional": max_notional, "quote_step": quote_step, "live": bool(live)}
+
+def _instr_okx() -> Dict[str, Dict[str, Any]]:
+    r = http_get("https://www.okx.com/api/v5/public/instruments", params={"instType": "SPOT"}, timeout=15)
+    out: Dict[str, Dict[str, Any]] = {}
+    for t in ((r.json() or {}).get("data") or []):
+        sym = safe_str(t.get("instId")).upper().replace("-", "/")
+        if not sym.endswith("/USDT"):
+            continue
+        out[sym] = _instr_rec(lot=_to_float(t.get("lotSz"), 0.0), min_qty=_to_float(t.get("minSz"), 0.0),
+                              tick=_to_float(t.get("tickSz"), 0.0),
+                              # SPOT'ta maxMktSz de USDT cinsinden; market emri tavanı olarak maxMktAmt yeterli
+                              max_notional=_to_float(t.get("maxMktAmt"), 0.0), live=safe_str(t.get("state")) == "live")
+    return out
+
+def _instr_binance() -> Dict[str, Dict[str, Any]]:
+    r = http_get("https://api.binance.com/api/v3/exchangeInfo", params={"permissions": "SPOT"}, timeout=20)
+    out: Dict[str, Dict[str, Any]] = {}
+    for t in ((r.json() or {}).get("symbols") or []):
+        if safe_str(t.get("quoteAsset")).upper() != "USDT":
+            continue
+        f = {safe_str(x.get("filterType")): x for x in (t.get("filters") or [])}
+        lot, mlot = f.get("LOT_SIZE") or {}, f.get("MARKET_LOT_SIZE") or {}
+        notional = f.get("NOTIONAL") or {}
+        min_notional = _to_float(notional.get("minNotional"), 0.0) if notional.get("applyMinToMarket", True) else 0.0
+        max_notional = _to_float(notional.get("maxNotional"), 0.0) if notional.get("applyMaxToMarket", False) else 0.0
+        if not notional and (f.get("MIN_NOTIONAL") or {}).get("applyToMarket", True):
+            min_notional = _to_float((f.get("MIN_NOTIONAL") or {}).get("minNotional"), 0.0)
+        qprec = int(_to_float(t.get("quoteAssetPrecision"), 8.0))
+        out[f"{safe_str(t.get('baseAsset')).upper()}/USDT"] = _instr_rec(
+            lot=_to_float(mlot.get("stepSize"), 0.0) or _to_float(lot.get("stepSize"), 0.0),
+            min_qty=max(_to_float(mlot.get("minQty"), 0.0), _to_float(lot.get("minQty"), 0.0)),
+            max_qty=_to_float(mlot.get("maxQty"), 0.0) or _to_float(lot.get("maxQty"), 0.0),
+            tick=_to_float((f.get("PRICE_FILTER") or {}).get("tickSize"), 0.0),
+            min_notional=min_notional, max_notional=max_notional,
+            quote_step=10.0 ** -qprec if 0 <= qprec <= 12 else 0.0,
+            live=safe_str(t.get("status")) == "TRADING",
+        )
+    return out
+
+def _instr_bybit() -> Dict[str, Dict[str, Any]]:
+    r = http_get("https://api.bybit.com/v5/market/instruments-info", params={"category": "spot"}, timeout=15)
+    out: Dict[str, Dict[str, Any]] = {}
+    for t in ((((r.json() or {}).get("result") or {}).get("list")) or []):
+        if safe_str(t.get("quoteCoin")).upper() != "USDT":
+            continue
+        lf = t.get("lotSizeFilter") or {}
+        out[f"{safe_str(t.get('baseCoin')).upper()}/USDT"] = _instr_rec(
+            lot=_to_float(lf.get("basePrecision"), 0.0), min_qty=_to_float(lf.get("minOrderQty"), 0.0),
+            max_qty=_to_float(lf.get("maxMarketOrderQty"), 0.0) or _to_float(lf.get("maxOrderQty"), 0.0),
+            tick=_to_float((t.get("priceFilter") or {}).get("tickSize"), 0.0),
+            min_notional=_to_float(lf.get("minOrderAmt"), 0.0), max_notional=_to_float(lf.get("maxOrderAmt"), 0.0),
+            quote_step=_to_float(lf.get("quotePrecision"), 0.0), live=safe_str(t.get("status")) == "Trading",
+        )
+    return out
+
+def _instr_gate() -> Dict[str, Dict[str, Any]]:
+    r = http_get("https://api.gateio.ws/api/v4/spot/currency_pairs", timeout=15)
+    out: Dict[str, Dict[str, Any]] = {}
+    for t in (r.json() or []):
+        if safe_str(t.get("quote")).upper() != "USDT":
+            continue
+        aprec = int(_to_float(t.get("amount_precision"), -1.0))
+        pprec = int(_to_float(t.get("precision"), -1.0))
+        out[f"{safe_str(t.get('base')).upper()}/USDT"] = _instr_rec(
+            lot=10.0 ** -aprec if 0 <= aprec <= 12 else 0.0, min_qty=_to_float(t.get("min_base_amount"), 0.0),
+            tick=10.0 ** -pprec if 0 <= pprec <= 12 else 0.0,
+            min_notional=_to_float(t.get("min_quote_amount"), 0.0), max_notional=_to_float(t.get("max_quote_amount"), 0.0),
+            live=safe_str(t.get("trade_status")) == "tradable",
+        )
+    return out
+
+_INSTR_LOADERS: Dict[str, Callable[[], Dict[str, Dict[str, Any]]]] = {
+    "OKX": _instr_okx,
+    "BINANCE": _instr_binance,
+    "BYBIT": _instr_bybit,
+    "GATEIO": _instr_gate,
+}
+
+def _instr_snapshot_path() -> str:
+    if INSTRUMENT_SNAPSHOT_PATH:
+        return os.path.abspath(INSTRUMENT_SNAPSHOT_PATH)
+    return os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), "instruments_snapshot.json")
+
+def _instr_load_snapshot() -> bool:
+    try:
+        with open(_instr_snapshot_path(), "r", encoding="utf-8") as f:
+            snap = json.load(f)
+    except Exception:
+        return False
+    loaded = False
+    with _INSTR_LOCK:
+        for ex, v in (snap or {}).items():
+            if ex in _INSTR_LOADERS and (v or {}).get("items") and float(v.get("ts") or 0) > float((_INSTR.get(ex) or {}).get("ts") or 0):
+                _INSTR[ex] = {"ts": float(v.get("ts") or 0), "items": dict(v["items"])}
+                loaded = True
+    return loaded
+
+def _instr_save_snapshot() -> None:
+    path = _instr_snapshot_path()
+    tmp = path + ".tmp"
+    with _INSTR_LOCK:
+        snap = {ex: {"ts": v["ts"], "items": v["items"]} for ex, v in _INSTR.items()}
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(snap, f, separators=(",", ":"))
+        os.replace(tmp, path)
+    except Exception:
+        pass
+
+def instrument_refresh(exchange_id: str) -> bool:
+    """Borsanın enstrüman listesini yeniden yükler; başarısız denemeden sonra INSTRUMENT_RETRY_SEC bekler."""
+    ex = _ex_price_norm(exchange_id)
+    loader = _INSTR_LOADERS.get(ex)
+    if loader is None:
+        return False
+    with _INSTR_FETCH_LOCKS[ex]:
+        if (time.time() - float(_INSTR_STATE["fail_ts"].get(ex) or 0.0)) < INSTRUMENT_RETRY_SEC:
+            return False
+        try:
+            items = loader()
+        except Exception:
+            items = {}
+        if not items:
+            _INSTR_STATE["errors"] += 1
+            _INSTR_STATE["fail_ts"][ex] = time.time()
+            return False
+        with _INSTR_LOCK:
+            _INSTR[ex] = {"ts": time.time(), "items": items}
+        _INSTR_STATE["refreshes"] += 1
+        _INSTR_STATE["fail_ts"].pop(ex, None)
+    _instr_save_snapshot()
+    return True
+
+def _instr_loop() -> None:
+    _instr_load_snapshot()  # disk snapshot: ağ beklemeden hazır
+    while True:
+        with _INSTR_LOCK:
+            want = set(_INSTR_WANT)
+            _INSTR_WANT.clear()
+            ages = {ex: time.time() - float((_INSTR.get(ex) or {}).get("ts") or 0.0) for ex in _INSTR_LOADERS}
+        for ex, age in ages.items():
+            # istek üzerine (bilinmeyen sembol / borsa) en fazla INSTRUMENT_RETRY_SEC'te bir
+            if age >= INSTRUMENT_REFRESH_SEC or (ex in want and age >= INSTRUMENT_RETRY_SEC):
+                try:
+                    instrument_refresh(ex)
+                except Exception:
+                    pass
+        _INSTR_WAKE.wait(60.0)
+        _INSTR_WAKE.clear()
+
+def instrument_registry_start() -> None:
+    with _INSTR_LOCK:
+        if _INSTR_STATE["started"]:
+            return
+        _INSTR_STATE["started"] = True
+    threading.Thread(target=_instr_loop, daemon=True, name="instruments").start()
+
+def get_instrument(exchange_id: str, symbol: str) -> Optional[Dict[str, Any]]:
+    """Canonical sembolün emir kuralları (bellekten, network yok). Bilinmiyorsa None döner, arka planda yenileme ister."""
+    ex = _ex_price_norm(exchange_id)
+    if ex not in _INSTR_LOADERS:
+        return None
+    if not _INSTR_STATE["started"]:
+        instrument_registry_start()
+    with _INSTR_LOCK:
+        inst = ((_INSTR.get(ex) or {}).get("items") or {}).get(canon_symbol(symbol))
+        if inst is None:
+            _INSTR_STATE["misses"] += 1
+            _INSTR_WANT.add(ex)
+    if inst is None:
+        _INSTR_WAKE.set()
+    return inst
+
+def _floor_step(x: float, step: float) -> float:
+    if step <= 0:
+        return x
+    d = Decimal(str(step))
+    return float((Decimal(str(x)) / d).to_integral_value(rounding=ROUND_FLOOR) * d)
+
+def instrument_adjust(exchange_id: str, action: str, symbol: str, amount: float,
+                      price_hint: float = 0.0) -> Tuple[float, str]:
+    """
+    Emir miktarını enstrüman kurallarına göre ayarlar -> (miktar, hata). Hata doluysa emir gönderilmez.
+    SELL: base qty lot adımına aşağı yuvarlanır, max'ı aşarsa hata (kırpılmış satış tam kapanış sayılmasın);
+    BUY: quote tutar quote adımına yuvarlanır, max'a kırpılır.
+    Enstrüman bilinmiyorsa miktar aynen döner. Network'e çıkmaz: fiyat cache'te yoksa notional kontrolü atlanır.
+    """
+    inst = get_instrument(exchange_id, symbol)
+    if not inst:
+        return amount, ""
+    if not inst.get("live", True):
+        return amount, f"{symbol} şu an işleme kapalı"
+    px = price_hint
+    if px <= 0 and (inst.get("min_notional") or inst.get("min_qty") or inst.get("max_notional")):
+        px = _to_float(price_peek(exchange_id, symbol)[0], 0.0)
+    min_qty = _to_float(inst.get("min_qty"), 0.0)
+    min_notional = _to_float(inst.get("min_notional"), 0.0)
+    if action == "SELL":
+        qty = _floor_step(amount, _to_float(inst.get("lot"), 0.0))
+        max_qty = _to_float(inst.get("max_qty"), 0.0)
+        max_notional = _to_float(inst.get("max_notional"), 0.0)
+        if qty <= 0 or (min_qty > 0 and qty < min_qty):
+            return qty, f"Miktar minimumun altında ({symbol} min {_fmt_amt(min_qty)})"
+        if min_notional > 0 and px > 0 and qty * px < min_notional:
+            return qty, f"Tutar minimumun altında ({symbol} min {_fmt_amt(min_notional)} USDT)"
+        if max_qty > 0 and qty > max_qty:
+            return qty, f"Miktar maksimumun üstünde ({symbol} max {_fmt_amt(max_qty)})"
+        if max_notional > 0 and px > 0 and qty * px > max_notional:
+            return qty, f"Tutar maksimumun üstünde ({symbol} max {_fmt_amt(max_notional)} USDT)"
+        return qty, ""
+    quote = _floor_step(amount, _to_float(inst.get("quote_step"), 0.0))
+    if _to_float(inst.get("max_notional"), 0.0) > 0:
+        quote = min(quote, _to_float(inst.get("max_notional"), 0.0))
+    if quote <= 0 or (min_notional > 0 and quote < min_notional):
+        return quote, f"Tutar minimumun altında ({symbol} min {_fmt_amt(min_notional)} USDT)"
+    if min_qty > 0 and px > 0 and quote / px < min_qty:
+        return quote, f"Miktar minimumun altında ({symbol} min {_fmt_amt(min_qty)})"
+    return quote, ""
+
+def instrument_stats() -> Dict[str, Any]:
+    out: Dict[str, Any] = {"refreshes": _INSTR_STATE["refreshes"], "errors": _INSTR_STATE["errors"],
+                           "misses": _INSTR_STATE["misses"]}
+    now = time.time()
+    with _INSTR_LOCK:
+        for ex, v in _INSTR.items():
+            out[ex] = {"count": len(v.get("items") or {}), "age_sec": round(now - float(v.get("ts") or 0.0), 1)}
+    return out
+
+
+# =========================
+# Balance tracker (per credential set, in-memory)
+# =========================
+# Emir kritik yolunda REST bakiye çağrısı yok: bakiyeler fill'lerden güncellenir, emirden kısa süre sonra
+# ve periyodik olarak REST ile uzlaştırılır (reconcile). İsteğe bağlı OKX private WS (account kanalı)
+# bakiyeyi anlık iter. place_order ve sell-all akışları snapshot'ı bellekten okur.
+BALANCE_SNAPSHOT_MAX_AGE_SEC = float(os.getenv("BALANCE_SNAPSHOT_MAX_AGE_SEC", "120").strip() or "120")
+BALANCE_DELTA_MAX_AGE_SEC = float(os.getenv("BALANCE_DELTA_MAX_AGE_SEC", "30").strip() or "30")  # fee delta fix için
+BALANCE_RECONCILE_SEC = float(os.getenv("BALANCE_RECONCILE_SEC", "60").strip() or "60")
+BALANCE_RECONCILE_DELAY_SEC = float(os.getenv("BALANCE_RECONCILE_DELAY_SEC", "3").strip() or "3")
+BALANCE_TRACK_IDLE_SEC = float(os.getenv("BALANCE_TRACK_IDLE_SEC", "3600").strip() or "3600")
+OKX_PRIVATE_WS_ENABLED = (os.getenv("OKX_PRIVATE_WS_ENABLED", "0").strip() or "0") == "1"
+OKX_PRIVATE_WS_URL = os.getenv("OKX_PRIVATE_WS_URL", "wss://ws.okx.com:8443/ws/v5/private").strip()
+
+_BAL_TRACK_STATE: Dict[str, Any] = {"started": False, "reconciles": 0, "fills": 0, "ws_updates": 0}
+_BAL_TRACK_LOCK = threading.Lock()  # started / adapter._ws_started bayrakları
+# Emir sonrası uzlaştırma kuyruğu: id(adapter) -> (adapter, {ccy}, due monotonic); reconcile loop'u tüketir
+_BAL_RECONCILE_DUE: Dict[int, Tuple["ExchangeAdapter", set, float]] = {}
+_BAL_RECONCILE_COND = threading.Condition()
+
+def balance_snapshot(adapter: "ExchangeAdapter", ccy: str, max_age: Optional[float] = None) -> Optional[float]:
+    """Bellekteki bakiye; yoksa / max_age'den eskiyse None (network yok)."""
+    max_age = BALANCE_SNAPSHOT_MAX_AGE_SEC if max_age is None else float(max_age)
+    with adapter._bal_lock:
+        v = adapter.balances.get(safe_str(ccy).upper())
+    if not v or (time.time() - v[1]) > max_age:
+        return None
+    return v[0]
+
+def _balance_track_set(adapter: "ExchangeAdapter", ccy: str, value: float, src: str) -> None:
+    with adapter._bal_lock:
+        adapter.balances[safe_str(ccy).upper()] = (float(value), time.time(), src)
+
+def balance_track_fill(adapter: "ExchangeAdapter", action: str, base_ccy: str, fill_qty: float, real_usdt: float,
+                       fee_usdt: float = 0.0, fee_coin: float = 0.0, fee_coin_ccy: str = "") -> None:
+    """Fill'i bilinen bakiyelere uygula (bilinmeyen asset'e dokunmaz; reconcile doldurur)."""
+    sign = 1.0 if action == "BUY" else -1.0
+    deltas = {"USDT": -sign * real_usdt - fee_usdt}
+    if base_ccy:
+        deltas[base_ccy] = deltas.get(base_ccy, 0.0) + sign * fill_qty
+    if fee_coin > 0 and fee_coin_ccy:
+        deltas[fee_coin_ccy] = deltas.get(fee_coin_ccy, 0.0) - fee_coin
+    now = time.time()
+    with adapter._bal_lock:
+        for ccy, d in deltas.items():
+            v = adapter.balances.get(ccy)
+            if v is not None:
+                adapter.balances[ccy] = (max(0.0, v[0] + d), now, "fill")
+    _BAL_TRACK_STATE["fills"] += 1
+
+def _balance_reconcile(adapter: "ExchangeAdapter", ccys: Optional[List[str]] = None) -> None:
+    with adapter._bal_lock:
+        todo = [c for c in (ccys or list(adapter.balances)) if c]
+    for ccy in dict.fromkeys(todo):
+        try:
+            adapter.get_balance(ccy)  # get_balance tracker'ı kendisi günceller
+        except Exception:
+            pass
+    _BAL_TRACK_STATE["reconciles"] += 1
+
+def balance_reconcile_soon(adapter: "ExchangeAdapter", ccys: List[str]) -> None:
+    """BALANCE_RECONCILE_DELAY_SEC sonra REST uzlaştırması planlar (aynı hesap için bekleyenle birleşir)."""
+    balance_tracker_start()
+    due = time.monotonic() + max(0.0, BALANCE_RECONCILE_DELAY_SEC)
+    with _BAL_RECONCILE_COND:
+        prev = _BAL_RECONCILE_DUE.get(id(adapter))
+        if prev is not None:
+            _BAL_RECONCILE_DUE[id(adapter)] = (adapter, prev[1] | set(ccys), min(prev[2], due))
+        else:
+            _BAL_RECONCILE_DUE[id(adapter)] = (adapter, set(ccys), due)
+        _BAL_RECONCILE_COND.notify()
+
+def _balance_reconcile_loop() -> None:
+    next_sweep = time.monotonic() + max(5.0, BALANCE_RECONCILE_SEC)
+    while True:
+        with _BAL_RECONCILE_COND:
+            while True:
+                now_m = time.monotonic()
+                due = [k for k, v in _BAL_RECONCILE_DUE.items() if v[2] <= now_m]
+                if due or now_m >= next_sweep:
+                    break
+                wake = min([next_sweep] + [v[2] for v in _BAL_RECONCILE_DUE.values()])
+                _BAL_RECONCILE_COND.wait(max(0.01, wake - now_m))
+            jobs = [_BAL_RECONCILE_DUE.pop(k)[:2] for k in due]
+        for ad, ccys in jobs:
+            _balance_reconcile(ad, sorted(ccys))
+        if time.monotonic() < next_sweep:
+            continue
+        next_sweep = time.monotonic() + max(5.0, BALANCE_RECONCILE_SEC)
+        cutoff = time.time() - BALANCE_TRACK_IDLE_SEC
+        with _ADAPTER_LOCK:
+            adapters = [a for a in _ADAPTERS.values() if a.balances and a.last_used >= cutoff]
+        for ad in adapters:
+            if ad._ws_live:
+                continue  # WS zaten iteliyor
+            _balance_reconcile(ad)
+
+def balance_tracker_start() -> None:
+    with _BAL_TRACK_LOCK:
+        if _BAL_TRACK_STATE["started"]:
+            return
+        _BAL_TRACK_STATE["started"] = True
+    threading.Thread(target=_balance_reconcile_loop, daemon=True, name="balance-reconcile").start()
+
+def tracked_asset_balance(exchange_id: str, api_key: str, api_secret: str, api_passphrase: str, ccy: str) -> float:
+    """Sell-all / tüm bakiye akışları için: taze snapshot varsa bellekten, yoksa tek REST (tracker'ı da doldurur)."""
+    ad = exchange_adapter(exchange_id, api_key, api_secret, api_passphrase)
+    if ad is None:
+        return 0.0
+    ad.last_used = time.time()
+    v = balance_snapshot(ad, ccy)
+    if v is not None:
+        return v
+    try:
+        return ad.get_balance(ccy)
+    except Exception:
+        return 0.0
+
+def balance_tracker_stats() -> Dict[str, Any]:
+    out = dict(_BAL_TRACK_STATE)
+    with _ADAPTER_LOCK:
+        ads = list(_ADAPTERS.values())
+    out["tracked_accounts"] = sum(1 for a in ads if a.balances)
+    out["ws_live"] = sum(1 for a in ads if a._ws_live)
+    with _BAL_RECONCILE_COND:
+        out["reconcile_pending"] = len(_BAL_RECONCILE_DUE)
+    return out
+
+
+def _okx_private_ws_session(ad: "ExchangeAdapter") -> None:
+    ws = _WSConn(OKX_PRIVATE_WS_URL)
+    try:
+        ts = str(int(time.time()))
+        sign = base64.b64encode(ad._sign(ts + "GET" + "/users/self/verify").digest()).decode()
+        ws.send_text(json.dumps({"op": "login", "args": [{"apiKey": ad.api_key, "passphrase": ad.api_passphrase,
+                                                          "timestamp": ts, "sign": sign}]}))
+        deadline = time.monotonic() + 10
+        while True:
+            if time.monotonic() > deadline:
+                raise ConnectionError("okx private ws: login timeout")
+            if not ws.readable(1.0):
+                continue
+            m = json.loads(ws.recv_text() or "{}")
+            if m.get("event") == "login":
+                if safe_str(m.get("code")) != "0":
+                    raise ConnectionError(f"okx private ws login: {m.get('msg')}")
+                break
+            if m.get("event") == "error":
+                raise ConnectionError(f"okx private ws: {m.get('msg')}")
+        ws.send_text(json.dumps({"op": "subscribe", "args": [{"channel": "account"}, {"channel": "orders", "instType": "SPOT"}]}))
+        ad._ws_live = True
+        last_ping = last_msg = time.monotonic()
+        while time.time() - ad.last_used <= BALANCE_TRACK_IDLE_SEC:
+            now_m = time.monotonic()
+            if now_m - last_ping >= MARKET_WS_PING_SEC:
+                ws.send_text("ping")
+                last_ping = now_m
+            if now_m - last_msg > MARKET_WS_IDLE_SEC:
+                raise ConnectionError("okx private ws idle timeout")
+            if not ws.readable(1.0):
+                continue
+            text = ws.recv_text()
+            last_msg = time.monotonic()
+            if not text or text == "pong":
+                continue
+            try:
+                m = json.loads(text)
+            except Exception:
+                continue
+            channel = (m.get("arg") or {}).get("channel")
+            if channel == "orders":
+                for d in m.get("data") or []:
+                    fills, done = OkxAdapter._order_fills(d)
+                    fill_event_push("OKX", safe_str(d.get("ordId")), fills, done)
+                continue
+            if channel != "account":
+                continue
+            for acc in m.get("data") or []:
+                for d in acc.get("details") or []:
+                    ccy = safe_str(d.get("ccy")).upper()
+                    v = d.get("cashBal")
+                    if v is None:
+                        v = d.get("availBal")
+                    if ccy and v is not None:
+                        _balance_track_set(ad, ccy, _to_float(v, 0.0), "ws")
+                        _BAL_TRACK_STATE["ws_updates"] += 1
+    finally:
+        ad._ws_live = False
+        ws.close()
+
+def _okx_private_ws_loop(ad: "ExchangeAdapter") -> None:
+    backoff = 1.0
+    try:
+        while time.time() - ad.last_used <= BALANCE_TRACK_IDLE_SEC:
+            t0 = time.monotonic()
+            try:
+                _okx_private_ws_session(ad)
+            except Exception:
+                pass
+            if time.monotonic() - t0 > 60:
+                backoff = 1.0
+            time.sleep(backoff * (0.5 + random.random()))
+            backoff = min(MARKET_WS_BACKOFF_MAX_SEC, backoff * 2)
+    finally:
+        with _BAL_TRACK_LOCK:
+            ad._ws_started = False
+
+def okx_private_ws_ensure(ad: "ExchangeAdapter") -> None:
+    if not OKX_PRIVATE_WS_ENABLED or ad.name != "OKX":
+        return
+    with _BAL_TRACK_LOCK:
+        if ad._ws_started:
+            return
+        ad._ws_started = True
+    threading.Thread(target=_okx_private_ws_loop, args=(ad,), daemon=True, name="okx-private-ws").start()
+
+
 # =========================
 # Balance APIs (Binance/Bybit/Gate/OKX)
 # =========================
 def binance_get_usdt_balance(api_key: str, api_secret: str) -> float:
     if not api_key or not api_secret:
         return 0.0
-    base = "https://api.binance.com"
-    ts = int(time.time() * 1000)
-    qs = f"recvWindow=5000&timestamp={ts}"
-    sig = hmac.new(api_secret.encode(), qs.encode(), hashlib.sha256).hexdigest()
-    url = f"{base}/api/v3/account?{qs}&signature={sig}"
-    j = http_get_json(url, {"X-MBX-APIKEY": api_key})
-    bals = j.get("balances") or []
-    for b in bals:
-        if (b.get("asset") or "").upper() == "USDT":
-            return _to_float(b.get("free"), 0) + _to_float(b.get("locked"), 0)
-    return 0.0
+    return exchange_adapter("BINANCE", api_key, api_secret).get_balance("USDT")
 
 def bybit_get_usdt_balance(api_key: str, api_secret: str) -> float:
     if not api_key or not api_secret:
         return 0.0
-    base = "https://api.bybit.com"
-    path = "/v5/account/wallet-balance"
-    recv = "5000"
-    ts = str(int(time.time() * 1000))
-    qs = "accountType=UNIFIED"
-    prehash = ts + api_key + recv + qs
-    sign = hmac.new(api_secret.encode(), prehash.encode(), hashlib.sha256).hexdigest()
-    url = f"{base}{path}?{qs}"
-    headers = {
-        "X-BAPI-API-KEY": api_key,
-        "X-BAPI-TIMESTAMP": ts,
-        "X-BAPI-RECV-WINDOW": recv,
-        "X-BAPI-SIGN": sign,
-    }
-    j = http_get_json(url, headers)
-    result = (j.get("result") or {})
-    lst = result.get("list") or []
-    for acc in lst:
-        coins = acc.get("coin") or []
-        for c in coins:
-            if (c.get("coin") or "").upper() == "USDT":
-                v = c.get("walletBalance")
-                if v is None:
-                    v = c.get("availableToWithdraw")
-                if v is None:
-                    v = c.get("equity")
-                return _to_float(v, 0.0)
-    return 0.0
+    return exchange_adapter("BYBIT", api_key, api_secret).get_balance("USDT")
 
 def gateio_get_usdt_balance(api_key: str, api_secret: str) -> float:
     if not api_key or not api_secret:
         return 0.0
-    base = "https://api.gateio.ws"
-    path = "/api/v4/spot/accounts"
-    method = "GET"
-    query = ""
-    body = ""
-    ts = str(int(time.time()))
-    body_hash = hashlib.sha512(body.encode()).hexdigest()
-    prehash = method + "\n" + path + "\n" + query + "\n" + body_hash + "\n" + ts
-    sign = hmac.new(api_secret.encode(), prehash.encode(), hashlib.sha512).hexdigest()
-    url = f"{base}{path}"
-    headers = {"KEY": api_key, "Timestamp": ts, "SIGN": sign}
-    j = http_get_json(url, headers)
-    if isinstance(j, list):
-        for row in j:
-            if (row.get("currency") or "").upper() == "USDT":
-                return _to_float(row.get("available"), 0) + _to_float(row.get("locked"), 0)
-    return 0.0
+    return exchange_adapter("GATEIO", api_key, api_secret).get_balance("USDT")
 
 def okx_get_usdt_balance(api_key: str, api_secret: str, api_passphrase: str) -> float:
     """
     OKX v5 account balance (USDT).
     Hata olursa 0.0 döner, UI asla çökmez.
     """
-    if not api_key or not api_secret or not api_passphrase:
-        return 0.0
-    try:
-        import requests
-        base = "https://www.okx.com"
-        path = "/api/v5/account/balance"
-        query = "ccy=USDT"
-        url = f"{base}{path}?{query}"
-        ts = datetime.utcnow().isoformat(timespec="milliseconds") + "Z"
-        method = "GET"
-        body = ""
-        prehash = ts + method + path + "?" + query + body
-        sign = base64.b64encode(hmac.new(api_secret.encode(), prehash.encode(), hashlib.sha256).digest()).decode()
-        headers = {
-            "OK-ACCESS-KEY": api_key,
-            "OK-ACCESS-SIGN": sign,
-            "OK-ACCESS-TIMESTAMP": ts,
-            "OK-ACCESS-PASSPHRASE": api_passphrase,
-        }
-        r = requests.get(url, headers=headers, timeout=15)
-        j = r.json() if r is not None else {}
-        data = j.get("data") or []
-        if not data:
-            return 0.0
-        details = (data[0].get("details") or [])
-        if not details:
-            return 0.0
-        d0 = details[0] or {}
-        # cashBal genelde USDT spot/free'yi verir, yoksa availEq/eq fallback
-        v = d0.get("cashBal")
-        if v is None:
-            v = d0.get("availEq")
-        if v is None:
-            v = d0.get("eq")
-        return _to_float(v, 0.0)
-    except Exception:
-        return 0.0
+    return okx_get_asset_balance("USDT", api_key, api_secret, api_passphrase)
 
 
 def okx_get_asset_balance(ccy: str, api_key: str, api_secret: str, api_passphrase: str) -> float:
@@ -2162,37 +3251,7 @@ def okx_get_asset_balance(ccy: str, api_key: str, api_secret: str, api_passphras
     if not api_key or not api_secret or not api_passphrase:
         return 0.0
     try:
-        import requests
-        base = "https://www.okx.com"
-        path = "/api/v5/account/balance"
-        query = f"ccy={urllib.parse.quote(ccy)}"
-        url = f"{base}{path}?{query}"
-        ts = datetime.utcnow().isoformat(timespec="milliseconds") + "Z"
-        method = "GET"
-        body = ""
-        prehash = f"{ts}{method}{path}?{query}{body}"
-        sign = base64.b64encode(hmac.new(api_secret.encode("utf-8"), prehash.encode("utf-8"), hashlib.sha256).digest()).decode("utf-8")
-        headers = {
-            "OK-ACCESS-KEY": api_key,
-            "OK-ACCESS-SIGN": sign,
-            "OK-ACCESS-TIMESTAMP": ts,
-            "OK-ACCESS-PASSPHRASE": api_passphrase,
-        }
-        r = requests.get(url, headers=headers, timeout=15)
-        j = r.json() if r is not None else {}
-        data = j.get("data") or []
-        if not data:
-            return 0.0
-        details = (data[0].get("details") or [])
-        if not details:
-            return 0.0
-        d0 = details[0] or {}
-        v = d0.get("cashBal")
-        if v is None:
-            v = d0.get("availEq")
-        if v is None:
-            v = d0.get("eq")
-        return _to_float(v, 0.0)
+        return exchange_adapter("OKX", api_key, api_secret, api_passphrase).get_balance(ccy)
     except Exception:
         return 0.0
 
@@ -2264,46 +3323,114 @@ def _sum_sell_fees_usdt(exchange_id: str, symbol: str, fill_price: float, res: D
         return float(total)
     except Exception:
         return 0.0
-def get_user_exchange_usdt_balances(user: dict) -> dict:
-    """
-    UI için: 4 borsanın USDT bakiyesini aynı anda döner.
-    API yoksa / hata varsa 0.0 döner.
-    """
-    out = {"OKX": 0.0, "BINANCE": 0.0, "BYBIT": 0.0, "GATE": 0.0}
-    if user and not isinstance(user, dict):
-        user = dict(user)
+# =========================
+# Dashboard balances (paralel + TTL cache)
+# =========================
+# 4 borsa aynı anda, sınırlı bir executor'da sorgulanır; sayfa en fazla BALANCE_FETCH_DEADLINE_SEC bekler.
+# Süreyi aşan istekler arka planda bitip cache'i doldurur; UI son bilinen değeri + yaşını gösterir.
+# Emir sonrası (commit_fill) kullanıcının cache'i bayat işaretlenir: değer yeniden çekilir ama gelene kadar
+# son bilinen değer yaşıyla gösterilmeye devam eder.
+BALANCE_FETCH_WORKERS = int(os.getenv("BALANCE_FETCH_WORKERS", "8").strip() or "8")
+BALANCE_FETCH_DEADLINE_SEC = float(os.getenv("BALANCE_FETCH_DEADLINE_SEC", "2.5").strip() or "2.5")
+BALANCE_CACHE_TTL_SEC = float(os.getenv("BALANCE_CACHE_TTL_SEC", "30").strip() or "30")
+
+_BALANCE_POOL = ThreadPoolExecutor(max_workers=max(1, BALANCE_FETCH_WORKERS), thread_name_prefix="balance")
+_BALANCE_CACHE: Dict[str, Dict[str, Dict[str, Any]]] = {}  # username -> ex -> {"value", "ts", "cred", "stale"}
+_BALANCE_INFLIGHT: Dict[Tuple[str, str, str], Any] = {}  # (username, ex, cred) -> Future
+_BALANCE_GEN: Dict[str, int] = {}  # username -> invalidation sayacı (eski fetch sonucu geri yazılmasın)
+_BALANCE_LOCK = threading.Lock()
+
+def _balance_fetchers(user: dict) -> Dict[str, Tuple[str, Optional[Callable[[], float]]]]:
+    """ex -> (credential parmak izi, fetch fn | None=API yok)."""
+    def cred(*parts: str) -> str:
+        return hashlib.sha1("|".join(parts).encode("utf-8")).hexdigest()[:16]
+
+    ok_k, ok_s, ok_p = (safe_str(user.get(c)) for c in ("api_key", "api_secret", "api_passphrase"))
+    bn_k, bn_s = safe_str(user.get("binance_api_key")), safe_str(user.get("binance_api_secret"))
+    by_k, by_s = safe_str(user.get("bybit_api_key")), safe_str(user.get("bybit_api_secret"))
+    gt_k, gt_s = safe_str(user.get("gate_api_key")), safe_str(user.get("gate_api_secret"))
+    return {
+        "OKX": (cred(ok_k, ok_s, ok_p), (lambda: okx_get_usdt_balance(ok_k, ok_s, ok_p)) if (ok_k and ok_s and ok_p) else None),
+        "BINANCE": (cred(bn_k, bn_s), (lambda: binance_get_usdt_balance(bn_k, bn_s)) if (bn_k and bn_s) else None),
+        "BYBIT": (cred(by_k, by_s), (lambda: bybit_get_usdt_balance(by_k, by_s)) if (by_k and by_s) else None),
+        "GATE": (cred(gt_k, gt_s), (lambda: gateio_get_usdt_balance(gt_k, gt_s)) if (gt_k and gt_s) else None),
+    }
 
+def _balance_store(username: str, ex: str, cred: str, gen: int, fut: Any) -> None:
     try:
-        out["OKX"] = okx_get_usdt_balance(
-            safe_str(user.get("api_key")),
-            safe_str(user.get("api_secret")),
-            safe_str(user.get("api_passphrase")),
-        )
+        value = float(fut.result())
     except Exception:
-        out["OKX"] = 0.0
+        value = None
+    with _BALANCE_LOCK:
+        _BALANCE_INFLIGHT.pop((username, ex, cred), None)
+        if value is None or _BALANCE_GEN.get(username, 0) != gen:
+            return
+        _BALANCE_CACHE.setdefault(username, {})[ex] = {"value": value, "ts": time.time(), "cred": cred, "stale": False}
 
-    try:
-        k = safe_str(user.get("binance_api_key"))
-        s = safe_str(user.get("binance_api_secret"))
-        out["BINANCE"] = binance_get_usdt_balance(k, s) if (k and s) else 0.0
-    except Exception:
-        out["BINANCE"] = 0.0
+def get_user_balances_cached(user: dict, deadline_sec: Optional[float] = None) -> Dict[str, Dict[str, Any]]:
+    """
+    ex -> {"value": float|None, "age_sec": float|None, "has_api": bool, "pending": bool, "stale": bool}
+    Taze cache varsa network yok; yoksa paralel fetch en fazla deadline kadar beklenir.
+    """
+    if user and not isinstance(user, dict):
+        user = dict(user)
+    user = user or {}
+    username = safe_str(user.get("username"))
+    deadline = BALANCE_FETCH_DEADLINE_SEC if deadline_sec is None else float(deadline_sec)
+    fetchers = _balance_fetchers(user)
+    now = time.time()
 
-    try:
-        k = safe_str(user.get("bybit_api_key"))
-        s = safe_str(user.get("bybit_api_secret"))
-        out["BYBIT"] = bybit_get_usdt_balance(k, s) if (k and s) else 0.0
-    except Exception:
-        out["BYBIT"] = 0.0
+    waits = []
+    started = []
+    with _BALANCE_LOCK:
+        gen = _BALANCE_GEN.get(username, 0)
+        cached = _BALANCE_CACHE.get(username) or {}
+        for ex, (cred, fn) in fetchers.items():
+            ent = cached.get(ex)
+            if fn is None or (ent and ent["cred"] == cred and not ent.get("stale") and (now - ent["ts"]) < BALANCE_CACHE_TTL_SEC):
+                continue
+            fut = _BALANCE_INFLIGHT.get((username, ex, cred))
+            if fut is None:
+                fut = _BALANCE_POOL.submit(fn)
+                _BALANCE_INFLIGHT[(username, ex, cred)] = fut
+                started.append((ex, cred, fut))
+            waits.append(fut)
+    # callback lock dışında: future zaten bittiyse add_done_callback hemen bu thread'de çalışır
+    for ex, cred, fut in started:
+        fut.add_done_callback(lambda f, ex=ex, cred=cred: _balance_store(username, ex, cred, gen, f))
+    if waits and deadline > 0:
+        futures_wait(waits, timeout=deadline)
+
+    out: Dict[str, Dict[str, Any]] = {}
+    now = time.time()
+    with _BALANCE_LOCK:
+        cached = _BALANCE_CACHE.get(username) or {}
+        for ex, (cred, fn) in fetchers.items():
+            ent = cached.get(ex)
+            if ent and ent["cred"] != cred:
+                ent = None
+            out[ex] = {
+                "value": (ent["value"] if ent else (0.0 if fn is None else None)),
+                "age_sec": (round(now - ent["ts"], 1) if ent else None),
+                "has_api": fn is not None,
+                "pending": (username, ex, cred) in _BALANCE_INFLIGHT,
+                "stale": bool(ent and (ent.get("stale") or (now - ent["ts"]) >= BALANCE_CACHE_TTL_SEC)),
+            }
+    return out
 
-    try:
-        k = safe_str(user.get("gate_api_key"))
-        s = safe_str(user.get("gate_api_secret"))
-        out["GATE"] = gateio_get_usdt_balance(k, s) if (k and s) else 0.0
-    except Exception:
-        out["GATE"] = 0.0
+def balance_cache_invalidate(username: str) -> None:
+    with _BALANCE_LOCK:
+        _BALANCE_GEN[username] = _BALANCE_GEN.get(username, 0) + 1
+        # değeri silme: yeni fetch gelene kadar UI son bilinen değeri + yaşını gösterir
+        for ent in (_BALANCE_CACHE.get(username) or {}).values():
+            ent["stale"] = True
 
-    return out
+def get_user_exchange_usdt_balances(user: dict) -> dict:
+    """
+    UI için: 4 borsanın USDT bakiyesini aynı anda döner (cache + paralel fetch).
+    API yoksa / hata varsa / henüz gelmediyse 0.0 döner.
+    """
+    return {ex: float(v["value"] or 0.0) for ex, v in get_user_balances_cached(user).items()}
 
 def format_balances_line(bals: dict) -> str:
     return (
@@ -2327,19 +3454,7 @@ def set_last_msg(username: str, msg: str) -> None:
         if not m:
             return
 
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        cur = conn.cursor()
-
-        # users tablosunda last_msg kolonu yoksa ekle
-        cur.execute("PRAGMA table_info(users)")
-        cols = [r[1] for r in cur.fetchall()]  # name
-        if "last_msg" not in cols:
-            cur.execute("ALTER TABLE users ADD COLUMN last_msg TEXT")
-
-        cur.execute("UPDATE users SET last_msg=? WHERE username=?", (m, uname))
-        conn.commit()
-        conn.close()
+        db_write("UPDATE users SET last_msg=? WHERE username=?", (m, uname))
     except Exception as e:
         try:
             log_line("WARN", "system", f"set_last_msg failed: {e}")
@@ -2351,18 +3466,109 @@ def set_last_msg(username: str, msg: str) -> None:
 # Public price helpers (UI)
 # =========================
 
-_PRICE_CACHE: Dict[str, Dict[str, Any]] = {}
-
-def _cache_get(key: str, ttl: int = 8) -> Optional[float]:
-    v = _PRICE_CACHE.get(key)
-    if not v:
-        return None
-    if int(time.time()) - int(v.get("ts", 0)) > ttl:
-        return None
-    return v.get("price")
+# Fiyat cache'i: thread-safe, monotonic TTL, LRU sınırı, anahtar başına single-flight.
+# Aynı (borsa, sembol) için TTL dolduğunda sadece BİR HTTP isteği gider; diğer çağıranlar
+# onun sonucunu bekler (TP manager + /api/positions + dashboard + fee çevirimi aynı anda düşse bile).
+PRICE_CACHE_TTL_SEC = float(os.getenv("PRICE_CACHE_TTL_SEC", "8").strip() or "8")
+PRICE_CACHE_MAX = int(os.getenv("PRICE_CACHE_MAX", "16384").strip() or "16384")  # 4 borsanın tüm USDT pariteleri sığar
+PRICE_FETCH_WAIT_SEC = float(os.getenv("PRICE_FETCH_WAIT_SEC", "8").strip() or "8")
+
+_PRICE_CACHE: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()  # key -> {"ts": monotonic, "price", "bid", "ask", "src", "ex_ts"}
+_PRICE_INFLIGHT: Dict[str, Dict[str, Any]] = {}  # key -> {"ev": Event, "price": Optional[float]}
+_PRICE_LOCK = threading.Lock()
+_PRICE_STATS: Dict[str, int] = {"hits": 0, "misses": 0, "coalesced": 0, "errors": 0, "evictions": 0}
+
+def _cache_put_locked(key: str, price: float, bid: Optional[float] = None, ask: Optional[float] = None,
+                      src: str = "rest", ex_ts: int = 0) -> None:
+    ts = time.monotonic()
+    _PRICE_CACHE[key] = {"ts": ts, "price": float(price), "bid": bid, "ask": ask, "src": src, "ex_ts": int(ex_ts or 0)}
+    _ref_index_put_locked(key, float(price), ts)
+    _PRICE_CACHE.move_to_end(key)
+    while len(_PRICE_CACHE) > max(1, PRICE_CACHE_MAX):
+        _PRICE_CACHE.popitem(last=False)
+        _PRICE_STATS["evictions"] += 1
+
+def _cache_get(key: str, ttl: Optional[float] = None) -> Optional[float]:
+    ttl = PRICE_CACHE_TTL_SEC if ttl is None else float(ttl)
+    with _PRICE_LOCK:
+        v = _PRICE_CACHE.get(key)
+        if not v or (time.monotonic() - v["ts"]) > ttl:
+            return None
+        _PRICE_CACHE.move_to_end(key)
+        return v["price"]
 
 def _cache_set(key: str, price: float) -> None:
-    _PRICE_CACHE[key] = {"ts": int(time.time()), "price": float(price)}
+    with _PRICE_LOCK:
+        _cache_put_locked(key, price)
+
+def get_price_quote(exchange_id: str, symbol: str, ttl: Optional[float] = None) -> Optional[Dict[str, Any]]:
+    """Cache'teki son tick: {price, bid, ask, src ("ws"/"rest"), ex_ts (ms), age_sec}. Network'e çıkmaz."""
+    ex = _ex_price_norm(exchange_id)
+    ttl = PRICE_CACHE_TTL_SEC if ttl is None else float(ttl)
+    with _PRICE_LOCK:
+        v = _PRICE_CACHE.get(f"{ex}:{_sym_norm_for_price(ex, symbol)}")
+        if not v:
+            return None
+        age = time.monotonic() - v["ts"]
+        if age > ttl:
+            return None
+        out = dict(v)
+    out.pop("ts", None)
+    out["age_sec"] = round(age, 3)
+    return out
+
+def _price_single_flight(key: str, fetch: Callable[[], Optional[float]], ttl: Optional[float] = None) -> Optional[float]:
+    ttl = PRICE_CACHE_TTL_SEC if ttl is None else float(ttl)
+    with _PRICE_LOCK:
+        v = _PRICE_CACHE.get(key)
+        if v and (time.monotonic() - v["ts"]) <= ttl:
+            _PRICE_CACHE.move_to_end(key)
+            _PRICE_STATS["hits"] += 1
+            return v["price"]
+        fl = _PRICE_INFLIGHT.get(key)
+        leader = fl is None
+        if leader:
+            fl = {"ev": threading.Event(), "price": None}
+            _PRICE_INFLIGHT[key] = fl
+            _PRICE_STATS["misses"] += 1
+        else:
+            _PRICE_STATS["coalesced"] += 1
+
+    if not leader:
+        fl["ev"].wait(PRICE_FETCH_WAIT_SEC)
+        return fl["price"]
+
+    p: Optional[float] = None
+    try:
+        p = fetch()
+        p = float(p) if p is not None else None
+    except Exception:
+        p = None
+    finally:
+        with _PRICE_LOCK:
+            if p is not None:
+                _cache_put_locked(key, p)
+            else:
+                _PRICE_STATS["errors"] += 1
+            fl["price"] = p
+            _PRICE_INFLIGHT.pop(key, None)
+        fl["ev"].set()
+    return p
+
+def price_cache_stats() -> Dict[str, Any]:
+    with _PRICE_LOCK:
+        out: Dict[str, Any] = dict(_PRICE_STATS)
+        out["size"] = len(_PRICE_CACHE)
+        out["inflight"] = len(_PRICE_INFLIGHT)
+        out["recent"] = len(_PRICE_RECENT)
+        out["ref_assets"] = len(_REF_INDEX)
+    out["refresher"] = dict(_PRICE_REFRESHER)
+    now_m = time.monotonic()
+    out["snapshots"] = {
+        ex: {"count": int(st.get("count") or 0), "age_sec": (round(now_m - st["ts"], 1) if st.get("ts") else None)}
+        for ex, st in list(_SNAPSHOT_STATE.items())
+    }
+    return out
 
 def _sym_norm_for_price(ex: str, symbol: str) -> str:
     s = (symbol or "").strip().upper()
@@ -2371,10 +3577,9 @@ def _sym_norm_for_price(ex: str, symbol: str) -> str:
 
 def _public_price_okx(symbol: str) -> Optional[float]:
     # OKX uses instId like BTC-USDT
-    import requests
     s = _sym_norm_for_price("OKX", symbol).replace("/", "-")
     url = f"https://www.okx.com/api/v5/market/ticker?instId={s}"
-    r = requests.get(url, timeout=6)
+    r = http_get(url, timeout=6)
     j = r.json()
     data = (j or {}).get("data") or []
     if not data:
@@ -2383,20 +3588,18 @@ def _public_price_okx(symbol: str) -> Optional[float]:
     return float(last) if last is not None else None
 
 def _public_price_binance(symbol: str) -> Optional[float]:
-    import requests
     s = _sym_norm_for_price("BINANCE", symbol).replace("/", "")
     url = f"https://api.binance.com/api/v3/ticker/price?symbol={s}"
-    r = requests.get(url, timeout=6)
+    r = http_get(url, timeout=6)
     j = r.json()
     p = (j or {}).get("price")
     return float(p) if p is not None else None
 
 def _public_price_bybit(symbol: str) -> Optional[float]:
-    import requests
     # Bybit v5: category=spot, symbol=BTCUSDT
     s = _sym_norm_for_price("BYBIT", symbol).replace("/", "")
     url = f"https://api.bybit.com/v5/market/tickers?category=spot&symbol={s}"
-    r = requests.get(url, timeout=6)
+    r = http_get(url, timeout=6)
     j = r.json()
     lst = (((j or {}).get("result") or {}).get("list") or [])
     if not lst:
@@ -2405,40 +3608,40 @@ def _public_price_bybit(symbol: str) -> Optional[float]:
     return float(last) if last is not None else None
 
 def _public_price_gate(symbol: str) -> Optional[float]:
-    import requests
     # Gate spot: currency_pair=BTC_USDT
     s = _sym_norm_for_price("GATE", symbol).replace("/", "_")
     url = f"https://api.gateio.ws/api/v4/spot/tickers?currency_pair={s}"
-    r = requests.get(url, timeout=6)
+    r = http_get(url, timeout=6)
     j = r.json()
     if isinstance(j, list) and j:
         last = j[0].get("last")
         return float(last) if last is not None else None
     return None
 
+def _public_price_fetch(ex: str, symbol: str) -> Optional[float]:
+    if ex == "OKX":
+        return _public_price_okx(symbol)
+    if ex == "BINANCE":
+        return _public_price_binance(symbol)
+    if ex == "BYBIT":
+        return _public_price_bybit(symbol)
+    if ex in ("GATE", "GATEIO", "GATE.IO"):
+        return _public_price_gate(symbol)
+    return None
+
+def _ex_price_norm(exchange_id: str) -> str:
+    ex = safe_str(exchange_id).strip().upper()
+    return "GATEIO" if ex in ("GATE", "GATE.IO") else ex
+
 def get_public_price(exchange_id: str, symbol: str) -> Optional[float]:
-    ex = (exchange_id or "").strip().upper()
+    ex = _ex_price_norm(exchange_id)
     key = f"{ex}:{_sym_norm_for_price(ex, symbol)}"
-    cached = _cache_get(key)
-    if cached is not None:
-        return cached
-    try:
-        if ex == "OKX":
-            p = _public_price_okx(symbol)
-        elif ex == "BINANCE":
-            p = _public_price_binance(symbol)
-        elif ex == "BYBIT":
-            p = _public_price_bybit(symbol)
-        elif ex in ("GATE", "GATEIO", "GATE.IO"):
-            p = _public_price_gate(symbol)
-        else:
-            p = None
-        if p is None:
-            return None
-        _cache_set(key, float(p))
-        return float(p)
-    except Exception:
-        return None
+    _price_mark_recent(key)
+    # SWR: refresher çalışıyorsa stale değer hemen döner, tazeleme arka planda
+    p = _cache_get(key, ttl=_price_read_ttl())
+    if p is not None:
+        return p
+    return _price_single_flight(key, lambda: _public_price_fetch(ex, symbol))
 
 
 # Backward compatible alias
@@ -2446,6 +3649,739 @@ def public_price(exchange_id: str, symbol: str) -> Optional[float]:
     return get_public_price(exchange_id, symbol)
 
 
+# =========================
+# Cross-exchange reference price
+# =========================
+# Her cache yazımı (REST, snapshot, WS tick) base varlık başına borsa fiyatını günceller. Referans =
+# taze kaynakların medyanı; medyandan REF_OUTLIER_PCT'ten fazla sapanlar atılıp medyan yeniden alınır.
+# Network'e çıkmaz: dry-run fill ve UI PnL için tek bir borsadaki spike'a karşı tampon.
+REF_MAX_AGE_SEC = float(os.getenv("REF_MAX_AGE_SEC", "30").strip() or "30")
+REF_OUTLIER_PCT = float(os.getenv("REF_OUTLIER_PCT", "2.0").strip() or "2.0")
+
+_REF_INDEX: Dict[str, Dict[str, Tuple[float, float]]] = {}  # "BTC" -> {"OKX": (price, monotonic)}; _PRICE_LOCK altında
+
+def _ref_index_put_locked(key: str, price: float, ts: float) -> None:
+    ex, _, sym = key.partition(":")
+    base, _, quote = sym.partition("/")
+    if quote == PRICE_SNAPSHOT_QUOTE and base and price > 0:
+        _REF_INDEX.setdefault(base, {})[ex] = (price, ts)
+
+def _median(xs: List[float]) -> float:
+    xs = sorted(xs)
+    n = len(xs)
+    return xs[n // 2] if n % 2 else (xs[n // 2 - 1] + xs[n // 2]) / 2.0
+
+def get_reference_price(symbol: str, max_age: Optional[float] = None) -> Optional[Dict[str, Any]]:
+    """{price, sources, used, rejected, age_sec, spread_pct} ya da taze kaynak yoksa None."""
+    base = _sym_norm_for_price("", normalize_symbol(symbol)).split("/")[0]
+    max_age = REF_MAX_AGE_SEC if max_age is None else float(max_age)
+    now_m = time.monotonic()
+    with _PRICE_LOCK:
+        quotes = {ex: v for ex, v in (_REF_INDEX.get(base) or {}).items() if (now_m - v[1]) <= max_age}
+    if not quotes:
+        return None
+    med = _median([p for p, _ in quotes.values()])
+    used = {ex: v for ex, v in quotes.items() if abs(v[0] - med) / med * 100.0 <= REF_OUTLIER_PCT}
+    if not used:
+        used = quotes
+    prices = [p for p, _ in used.values()]
+    ref = _median(prices)
+    return {
+        "price": ref,
+        "sources": len(used),
+        "used": sorted(used),
+        "rejected": sorted(set(quotes) - set(used)),
+        "age_sec": round(now_m - min(t for _, t in used.values()), 3),
+        "spread_pct": round((max(prices) - min(prices)) / ref * 100.0, 4) if ref > 0 else 0.0,
+    }
+
+def reference_price(exchange_id: str, symbol: str) -> float:
+    """Referans fiyat; index boşsa borsanın kendi fiyatı (cache/SWR üzerinden). Yoksa 0.0."""
+    ref = get_reference_price(symbol)
+    if ref:
+        return float(ref["price"])
+    return _to_float(get_public_price(exchange_id, symbol), 0.0)
+
+
+# =========================
+# Bulk ticker snapshot (borsa başına tek istek)
+# =========================
+# Her borsanın all-tickers endpoint'i tek çağrıda tüm USDT paritelerini döner; sonuç price cache'e
+# yazılır. TP manager / /api/positions her döngüde borsa başına 1 HTTP isteği öder.
+PRICE_SNAPSHOT_MIN_SEC = float(os.getenv("PRICE_SNAPSHOT_MIN_SEC", "4").strip() or "4")  # iki snapshot arası min süre
+PRICE_SNAPSHOT_QUOTE = "USDT"
+
+_SNAPSHOT_STATE: Dict[str, Dict[str, Any]] = {}  # ex -> {"ts": monotonic, "count": int, "fail_ts": monotonic}
+_SNAPSHOT_LOCKS: Dict[str, threading.Lock] = {ex: threading.Lock() for ex in ("OKX", "BINANCE", "BYBIT", "GATEIO")}
+
+def _split_quote_suffix(raw: str) -> str:
+    """BTCUSDT -> BTC/USDT (sadece USDT paritesi, aksi halde "")."""
+    s = safe_str(raw).strip().upper()
+    if s.endswith(PRICE_SNAPSHOT_QUOTE) and len(s) > len(PRICE_SNAPSHOT_QUOTE):
+        return s[:-len(PRICE_SNAPSHOT_QUOTE)] + "/" + PRICE_SNAPSHOT_QUOTE
+    return ""
+
+def _snapshot_okx() -> Dict[str, float]:
+    r = http_get("https://www.okx.com/api/v5/market/tickers", params={"instType": "SPOT"}, timeout=10)
+    out: Dict[str, float] = {}
+    for t in ((r.json() or {}).get("data") or []):
+        sym = safe_str(t.get("instId")).upper().replace("-", "/")
+        if sym.endswith("/" + PRICE_SNAPSHOT_QUOTE):
+            px = _to_float(t.get("last"), 0.0)
+            if px > 0:
+                out[sym] = px
+    return out
+
+def _snapshot_binance() -> Dict[str, float]:
+    r = http_get("https://api.binance.com/api/v3/ticker/price", timeout=10)
+    out: Dict[str, float] = {}
+    for t in (r.json() or []):
+        sym = _split_quote_suffix(t.get("symbol"))
+        px = _to_float(t.get("price"), 0.0)
+        if sym and px > 0:
+            out[sym] = px
+    return out
+
+def _snapshot_bybit() -> Dict[str, float]:
+    r = http_get("https://api.bybit.com/v5/market/tickers", params={"category": "spot"}, timeout=10)
+    out: Dict[str, float] = {}
+    for t in ((((r.json() or {}).get("result") or {}).get("list")) or []):
+        sym = _split_quote_suffix(t.get("symbol"))
+        px = _to_float(t.get("lastPrice"), 0.0)
+        if sym and px > 0:
+            out[sym] = px
+    return out
+
+def _snapshot_gate() -> Dict[str, float]:
+    r = http_get("https://api.gateio.ws/api/v4/spot/tickers", timeout=10)
+    out: Dict[str, float] = {}
+    for t in (r.json() or []):
+        sym = safe_str(t.get("currency_pair")).upper().replace("_", "/")
+        if sym.endswith("/" + PRICE_SNAPSHOT_QUOTE):
+            px = _to_float(t.get("last"), 0.0)
+            if px > 0:
+                out[sym] = px
+    return out
+
+_SNAPSHOT_LOADERS: Dict[str, Callable[[], Dict[str, float]]] = {
+    "OKX": _snapshot_okx,
+    "BINANCE": _snapshot_binance,
+    "BYBIT": _snapshot_bybit,
+    "GATEIO": _snapshot_gate,
+}
+
+def refresh_price_snapshot(exchange_id: str, min_age: Optional[float] = None) -> bool:
+    """Borsanın tüm USDT tickers'ını tek istekle çekip cache'e yazar. Eşzamanlı çağıranlar aynı isteği bekler."""
+    ex = _ex_price_norm(exchange_id)
+    loader = _SNAPSHOT_LOADERS.get(ex)
+    if loader is None:
+        return False
+    min_age = PRICE_SNAPSHOT_MIN_SEC if min_age is None else float(min_age)
+    st = _SNAPSHOT_STATE.get(ex) or {}
+    if (time.monotonic() - float(st.get("ts") or -1e9)) < min_age:
+        return True
+    with _SNAPSHOT_LOCKS[ex]:
+        st = _SNAPSHOT_STATE.get(ex) or {}
+        now_m = time.monotonic()
+        if (now_m - float(st.get("ts") or -1e9)) < min_age:
+            return True  # biz beklerken başka thread yeniledi
+        if (now_m - float(st.get("fail_ts") or -1e9)) < min_age:
+            return False  # son deneme patladı; borsayı dövme
+        try:
+            prices = loader()
+        except Exception:
+            prices = {}
+        if not prices:
+            _SNAPSHOT_STATE[ex] = dict(st, fail_ts=time.monotonic())
+            return False
+        with _PRICE_LOCK:
+            for sym, px in prices.items():
+                _cache_put_locked(f"{ex}:{sym}", px)
+        _SNAPSHOT_STATE[ex] = {"ts": time.monotonic(), "count": len(prices), "fail_ts": 0.0}
+        return True
+
+def get_public_prices(exchange_id: str, symbols: List[str]) -> Dict[str, Optional[float]]:
+    """Toplu fiyat: cache'te olmayanlar için önce tek snapshot isteği, hâlâ eksik kalanlar tekil fetch."""
+    ex = _ex_price_norm(exchange_id)
+    out: Dict[str, Optional[float]] = {}
+    missing: List[str] = []
+    for s in symbols or []:
+        if s in out:
+            continue
+        key = f"{ex}:{_sym_norm_for_price(ex, s)}"
+        _price_mark_recent(key)
+        p = _cache_get(key, ttl=_price_read_ttl())
+        out[s] = p
+        if p is None:
+            missing.append(s)
+    if missing and refresh_price_snapshot(ex):
+        still = []
+        for s in missing:
+            p = _cache_get(f"{ex}:{_sym_norm_for_price(ex, s)}")
+            out[s] = p
+            if p is None:
+                still.append(s)
+        missing = still
+    for s in missing:
+        out[s] = get_public_price(ex, s)
+    return out
+
+
+# =========================
+# Market-data WebSocket feed (stdlib RFC6455 client)
+# =========================
+# Borsa başına tek public WS: açık pozisyon + aktif auto_rules sembollerine abone olur,
+# last/bid/ask'ı tick zamanıyla price cache'e yazar. Soket düşerse cache TTL dolar ve
+# okuyucular otomatik REST yoluna düşer; loop backoff ile yeniden bağlanıp yeniden abone olur.
+MARKET_WS_ENABLED = (os.getenv("MARKET_WS_ENABLED", "1").strip() or "1") == "1"
+MARKET_WS_RESYNC_SEC = float(os.getenv("MARKET_WS_RESYNC_SEC", "15").strip() or "15")  # abonelik listesi yenileme
+MARKET_WS_IDLE_SEC = float(os.getenv("MARKET_WS_IDLE_SEC", "60").strip() or "60")  # bu kadar mesaj yoksa reconnect
+MARKET_WS_PING_SEC = float(os.getenv("MARKET_WS_PING_SEC", "20").strip() or "20")
+MARKET_WS_BACKOFF_MAX_SEC = float(os.getenv("MARKET_WS_BACKOFF_MAX_SEC", "60").strip() or "60")
+
+_WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+def _ws_encode_frame(opcode: int, payload: bytes, mask: bool) -> bytes:
+    n = len(payload)
+    head = bytearray([0x80 | (opcode & 0x0F)])
+    mbit = 0x80 if mask else 0
+    if n < 126:
+        head.append(mbit | n)
+    elif n < 65536:
+        head.append(mbit | 126)
+        head += n.to_bytes(2, "big")
+    else:
+        head.append(mbit | 127)
+        head += n.to_bytes(8, "big")
+    if not mask:
+        return bytes(head) + payload
+    key = os.urandom(4)
+    return bytes(head) + key + bytes(b ^ key[i % 4] for i, b in enumerate(payload))
+
+def _ws_read_frame(read_exact: Callable[[int], bytes]) -> Tuple[bool, int, bytes]:
+    """(fin, opcode, payload) — maskeli/maskesiz her iki yön için."""
+    b0, b1 = read_exact(2)
+    n = b1 & 0x7F
+    if n == 126:
+        n = int.from_bytes(read_exact(2), "big")
+    elif n == 127:
+        n = int.from_bytes(read_exact(8), "big")
+    key = read_exact(4) if (b1 & 0x80) else b""
+    data = read_exact(n) if n else b""
+    if key:
+        data = bytes(b ^ key[i % 4] for i, b in enumerate(data))
+    return bool(b0 & 0x80), b0 & 0x0F, data
+
+def _ws_accept_key(key: str) -> str:
+    return base64.b64encode(hashlib.sha1((key + _WS_GUID).encode()).digest()).decode()
+
+
+class _WSConn:
+    """Minimal RFC6455 client: ws:// ve wss://, text mesajları, ping/pong, close."""
+
+    def __init__(self, url: str, timeout: float = 10.0):
+        u = urllib.parse.urlsplit(url)
+        secure = u.scheme == "wss"
+        host = u.hostname or ""
+        port = u.port or (443 if secure else 80)
+        sock = socket.create_connection((host, port), timeout=timeout)
+        if secure:
+            sock = ssl.create_default_context().wrap_socket(sock, server_hostname=host)
+        self.sock = sock
+        self._buf = b""
+        key = base64.b64encode(os.urandom(16)).decode()
+        path = (u.path or "/") + (("?" + u.query) if u.query else "")
+        req = (
+            f"GET {path} HTTP/1.1\r\nHost: {host}:{port}\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+            f"Sec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\nUser-Agent: autotrade-md\r\n\r\n"
+        )
+        sock.sendall(req.encode())
+        while b"\r\n\r\n" not in self._buf:
+            chunk = sock.recv(4096)
+            if not chunk:
+                raise ConnectionError("ws handshake: connection closed")
+            self._buf += chunk
+            if len(self._buf) > 65536:
+                raise ConnectionError("ws handshake: header too large")
+        head, self._buf = self._buf.split(b"\r\n\r\n", 1)
+        lines = head.decode("latin-1").split("\r\n")
+        if " 101 " not in (lines[0] + " "):
+            raise ConnectionError(f"ws handshake: {lines[0]}")
+        hdr = {k.strip().lower(): v.strip() for k, _, v in (ln.partition(":") for ln in lines[1:])}
+        if hdr.get("sec-websocket-accept") != _ws_accept_key(key):
+            raise ConnectionError("ws handshake: bad accept key")
+
+    def _read_exact(self, n: int) -> bytes:
+        while len(self._buf) < n:
+            chunk = self.sock.recv(max(4096, n - len(self._buf)))
+            if not chunk:
+                raise ConnectionError("ws closed")
+            self._buf += chunk
+        out, self._buf = self._buf[:n], self._buf[n:]
+        return out
+
+    def readable(self, timeout: float) -> bool:
+        if self._buf:
+            return True
+        if isinstance(self.sock, ssl.SSLSocket) and self.sock.pending():
+            return True
+        r, _, _ = select.select([self.sock], [], [], max(0.0, timeout))
+        return bool(r)
+
+    def send_text(self, text: str) -> None:
+        self.sock.sendall(_ws_encode_frame(0x1, text.encode("utf-8"), mask=True))
+
+    def recv_text(self) -> Optional[str]:
+        """Bir data mesajı döner; control frame'lerde None. Close gelirse ConnectionError."""
+        parts: List[bytes] = []
+        while True:
+            fin, op, data = _ws_read_frame(self._read_exact)
+            if op == 0x9:  # ping -> pong
+                self.sock.sendall(_ws_encode_frame(0xA, data, mask=True))
+                if not parts:
+                    return None
+                continue
+            if op == 0xA:
+                if not parts:
+                    return None
+                continue
+            if op == 0x8:
+                raise ConnectionError("ws closed by server")
+            parts.append(data)
+            if fin:
+                return b"".join(parts).decode("utf-8", "replace")
+
+    def close(self) -> None:
+        try:
+            self.sock.sendall(_ws_encode_frame(0x8, b"", mask=True))
+        except Exception:
+            pass
+        try:
+            self.sock.close()
+        except Exception:
+            pass
+
+
+def _md_f(v: Any) -> Optional[float]:
+    x = _to_float(v, 0.0)
+    return x if x > 0 else None
+
+def _md_sub_okx(syms: List[str], on: bool) -> List[str]:
+    args = [{"channel": "tickers", "instId": s.replace("/", "-")} for s in syms]
+    return [json.dumps({"op": "subscribe" if on else "unsubscribe", "args": args[i:i + 50]}) for i in range(0, len(args), 50)]
+
+def _md_parse_okx(m: Any) -> List[Tuple[str, Optional[float], Optional[float], Optional[float], int]]:
+    if not isinstance(m, dict) or (m.get("arg") or {}).get("channel") != "tickers":
+        return []
+    return [(safe_str(d.get("instId")).upper().replace("-", "/"), _md_f(d.get("last")), _md_f(d.get("bidPx")),
+             _md_f(d.get("askPx")), int(_to_float(d.get("ts"), 0.0))) for d in (m.get("data") or [])]
+
+def _md_sub_binance(syms: List[str], on: bool) -> List[str]:
+    params = [s.replace("/", "").lower() + "@ticker" for s in syms]
+    return [json.dumps({"method": "SUBSCRIBE" if on else "UNSUBSCRIBE", "params": params[i:i + 100], "id": int(time.time() * 1000) + i})
+            for i in range(0, len(params), 100)]
+
+def _md_parse_binance(m: Any) -> List[Tuple[str, Optional[float], Optional[float], Optional[float], int]]:
+    if not isinstance(m, dict) or m.get("e") != "24hrTicker":
+        return []
+    sym = _split_quote_suffix(m.get("s"))
+    return [(sym, _md_f(m.get("c")), _md_f(m.get("b")), _md_f(m.get("a")), int(_to_float(m.get("E"), 0.0)))] if sym else []
+
+def _md_sub_bybit(syms: List[str], on: bool) -> List[str]:
+    args = ["tickers." + s.replace("/", "") for s in syms]
+    return [json.dumps({"op": "subscribe" if on else "unsubscribe", "args": args[i:i + 10]}) for i in range(0, len(args), 10)]
+
+def _md_parse_bybit(m: Any) -> List[Tuple[str, Optional[float], Optional[float], Optional[float], int]]:
+    if not isinstance(m, dict) or not safe_str(m.get("topic")).startswith("tickers."):
+        return []
+    d = m.get("data") or {}
+    sym = _split_quote_suffix(d.get("symbol"))
+    return [(sym, _md_f(d.get("lastPrice")), _md_f(d.get("bid1Price")), _md_f(d.get("ask1Price")),
+             int(_to_float(m.get("ts"), 0.0)))] if sym else []
+
+def _md_sub_gate(syms: List[str], on: bool) -> List[str]:
+    return [json.dumps({"time": int(time.time()), "channel": "spot.tickers", "event": "subscribe" if on else "unsubscribe",
+                        "payload": [s.replace("/", "_") for s in syms]})]
+
+def _md_parse_gate(m: Any) -> List[Tuple[str, Optional[float], Optional[float], Optional[float], int]]:
+    if not isinstance(m, dict) or m.get("channel") != "spot.tickers" or m.get("event") != "update":
+        return []
+    d = m.get("result") or {}
+    return [(safe_str(d.get("currency_pair")).upper().replace("_", "/"), _md_f(d.get("last")), _md_f(d.get("highest_bid")),
+             _md_f(d.get("lowest_ask")), int(_to_float(m.get("time_ms"), 0.0)))]
+
+# ex -> (varsayılan url, subscribe builder, parser, uygulama seviyesi ping payload)
+_MD_WS_SPECS: Dict[str, Dict[str, Any]] = {
+    "OKX": {"url": "wss://ws.okx.com:8443/ws/v5/public", "sub": _md_sub_okx, "parse": _md_parse_okx,
+            "ping": lambda: "ping"},
+    "BINANCE": {"url": "wss://stream.binance.com:9443/ws", "sub": _md_sub_binance, "parse": _md_parse_binance,
+                "ping": None},  # Binance ping frame gönderir, biz pong'larız
+    "BYBIT": {"url": "wss://stream.bybit.com/v5/public/spot", "sub": _md_sub_bybit, "parse": _md_parse_bybit,
+              "ping": lambda: json.dumps({"op": "ping"})},
+    "GATEIO": {"url": "wss://api.gateio.ws/ws/v4/", "sub": _md_sub_gate, "parse": _md_parse_gate,
+               "ping": lambda: json.dumps({"time": int(time.time()), "channel": "spot.ping"})},
+}
+
+_MD_WS_STATE: Dict[str, Dict[str, Any]] = {}  # ex -> {"connected", "subs", "ticks", "reconnects", "last_msg", "error"}
+
+def _md_ws_url(ex: str) -> str:
+    # Test / stand-in için: MARKET_WS_URL_OKX=ws://127.0.0.1:8765/okx
+    return (os.getenv(f"MARKET_WS_URL_{ex}", "").strip() or _MD_WS_SPECS[ex]["url"])
+
+def _md_wanted_symbols() -> Dict[str, set]:
+    """Açık pozisyonlar + aktif auto_rules: borsa -> {BASE/USDT}."""
+    out: Dict[str, set] = {ex: set() for ex in _MD_WS_SPECS}
+    try:
+        conn = db()
+        rows = conn.execute("""
+            SELECT exchange_id, symbol FROM open_positions
+            UNION
+            SELECT exchange_id, symbol FROM auto_rules WHERE enabled=1
+        """).fetchall()
+        conn.close()
+    except Exception:
+        return out
+    for r in rows or []:
+        ex = _ex_price_norm(r[0])
+        sym = _sym_norm_for_price(ex, normalize_symbol(safe_str(r[1])))
+        if ex in out and sym.endswith("/" + PRICE_SNAPSHOT_QUOTE):
+            out[ex].add(sym)
+    return out
+
+def _md_on_tick(ex: str, sym: str, last: Optional[float], bid: Optional[float], ask: Optional[float], ex_ts: int) -> None:
+    px = last or ((bid + ask) / 2.0 if (bid and ask) else None)
+    if not sym or px is None:
+        return
+    with _PRICE_LOCK:
+        _cache_put_locked(f"{ex}:{sym}", px, bid=bid, ask=ask, src="ws", ex_ts=ex_ts)
+
+def _md_ws_session(ex: str, st: Dict[str, Any]) -> None:
+    spec = _MD_WS_SPECS[ex]
+    ws = _WSConn(_md_ws_url(ex))
+    subs: set = set()
+    try:
+        st.update(connected=True, error="", connected_at=now_ts())
+        last_ping = last_sync = 0.0
+        last_msg = time.monotonic()
+        while True:
+            now_m = time.monotonic()
+            if now_m - last_sync >= MARKET_WS_RESYNC_SEC:
+                want = _md_wanted_symbols().get(ex) or set()
+                add, drop = sorted(want - subs), sorted(subs - want)
+                for msg in (spec["sub"](add, True) if add else []) + (spec["sub"](drop, False) if drop else []):
+                    ws.send_text(msg)
+                subs = set(want)
+                st["subs"] = len(subs)
+                last_sync = now_m
+            if spec["ping"] and now_m - last_ping >= MARKET_WS_PING_SEC:
+                ws.send_text(spec["ping"]())
+                last_ping = now_m
+            if now_m - last_msg > MARKET_WS_IDLE_SEC:
+                raise ConnectionError("ws idle timeout")
+            if not ws.readable(1.0):
+                continue
+            text = ws.recv_text()
+            last_msg = time.monotonic()
+            st["last_msg"] = now_ts()
+            if not text or text == "pong":
+                continue
+            try:
+                m = json.loads(text)
+            except Exception:
+                continue
+            for sym, last, bid, ask, ex_ts in spec["parse"](m):
+                _md_on_tick(ex, sym, last, bid, ask, ex_ts)
+                st["ticks"] = int(st.get("ticks") or 0) + 1
+    finally:
+        st.update(connected=False, subs=0)
+        ws.close()
+
+def _md_ws_loop(ex: str) -> None:
+    st = _MD_WS_STATE.setdefault(ex, {"connected": False, "subs": 0, "ticks": 0, "reconnects": 0, "last_msg": 0, "error": ""})
+    backoff = 1.0
+    while True:
+        if not _md_wanted_symbols().get(ex):
+            time.sleep(MARKET_WS_RESYNC_SEC)  # izlenecek sembol yok; soket açma
+            continue
+        t0 = time.monotonic()
+        try:
+            _md_ws_session(ex, st)
+        except Exception as e:
+            st["error"] = safe_str(e)[:200]
+        st["reconnects"] = int(st.get("reconnects") or 0) + 1
+        if time.monotonic() - t0 > 60:
+            backoff = 1.0  # uzun süre ayakta kaldıysa sıfırdan başla
+        time.sleep(backoff * (0.5 + random.random()))
+        backoff = min(MARKET_WS_BACKOFF_MAX_SEC, backoff * 2)
+
+def market_ws_start() -> None:
+    if not MARKET_WS_ENABLED:
+        return
+    for ex in _MD_WS_SPECS:
+        threading.Thread(target=_md_ws_loop, args=(ex,), daemon=True, name=f"md-ws-{ex}").start()
+
+def market_ws_stats() -> Dict[str, Any]:
+    return {ex: dict(st) for ex, st in list(_MD_WS_STATE.items())}
+
+
+# =========================
+# Stale-while-revalidate price refresher
+# =========================
+# Hot set = açık pozisyonlar + aktif auto_rules + bekleyen deferred sell'ler + son PRICE_HOT_RECENT_SEC içinde
+# okunan semboller. Refresher bunları TTL dolmadan tazeler; okuyucular (refresher çalışırken) son değeri
+# PRICE_STALE_MAX_SEC'e kadar bekletmeden alır, yani request thread'i neredeyse hiç HTTP beklemez.
+PRICE_REFRESH_ENABLED = (os.getenv("PRICE_REFRESH_ENABLED", "1").strip() or "1") == "1"
+PRICE_REFRESH_SEC = float(os.getenv("PRICE_REFRESH_SEC", "2").strip() or "2")  # döngü aralığı
+PRICE_REFRESH_AHEAD = float(os.getenv("PRICE_REFRESH_AHEAD", "0.6").strip() or "0.6")  # TTL'in bu oranında tazele
+PRICE_REFRESH_SNAPSHOT_MIN = int(os.getenv("PRICE_REFRESH_SNAPSHOT_MIN", "3").strip() or "3")  # >= bu kadar sembol -> snapshot
+PRICE_STALE_MAX_SEC = float(os.getenv("PRICE_STALE_MAX_SEC", "30").strip() or "30")
+PRICE_HOT_RECENT_SEC = float(os.getenv("PRICE_HOT_RECENT_SEC", "120").strip() or "120")
+
+_PRICE_RECENT: Dict[str, float] = {}  # "EX:SYM" -> son okuma (monotonic); _PRICE_LOCK altında
+_PRICE_REFRESHER: Dict[str, Any] = {"running": False, "cycles": 0, "refreshed": 0, "hot": 0, "last_cycle_ms": 0}
+
+def _price_read_ttl() -> float:
+    # Refresher yoksa stale değer servis etmek güvenli değil: normal TTL'e dön
+    return max(PRICE_CACHE_TTL_SEC, PRICE_STALE_MAX_SEC) if _PRICE_REFRESHER["running"] else PRICE_CACHE_TTL_SEC
+
+def _price_mark_recent(key: str) -> None:
+    with _PRICE_LOCK:
+        _PRICE_RECENT[key] = time.monotonic()
+
+def price_peek(exchange_id: str, symbol: str) -> Tuple[Optional[float], Optional[float]]:
+    """(fiyat, yaş_sn) — network'e çıkmaz; sembolü hot set'e ekler."""
+    q = get_price_quote(exchange_id, symbol, ttl=max(PRICE_CACHE_TTL_SEC, PRICE_STALE_MAX_SEC))
+    ex = _ex_price_norm(exchange_id)
+    _price_mark_recent(f"{ex}:{_sym_norm_for_price(ex, symbol)}")
+    if not q:
+        return None, None
+    return q["price"], q["age_sec"]
+
+def _price_hot_set() -> Dict[str, set]:
+    hot: Dict[str, set] = {ex: set(syms) for ex, syms in _md_wanted_symbols().items()}
+    try:
+        with _DEFERRED_SELLS_LOCK:
+            items = list(_DEFERRED_SELLS.values())
+        for d in items:
+            ex = _ex_price_norm(d.get("exchange_id"))
+            hot.setdefault(ex, set()).add(_sym_norm_for_price(ex, safe_str(d.get("symbol"))))
+    except Exception:
+        pass
+    cutoff = time.monotonic() - PRICE_HOT_RECENT_SEC
+    with _PRICE_LOCK:
+        for key, t in list(_PRICE_RECENT.items()):
+            if t < cutoff:
+                _PRICE_RECENT.pop(key, None)
+                continue
+            ex, _, sym = key.partition(":")
+            hot.setdefault(ex, set()).add(sym)
+    return hot
+
+def _price_refresh_cycle() -> int:
+    ahead = max(0.5, PRICE_CACHE_TTL_SEC * PRICE_REFRESH_AHEAD)
+    hot = _price_hot_set()
+    _PRICE_REFRESHER["hot"] = sum(len(v) for v in hot.values())
+    n = 0
+    for ex, syms in hot.items():
+        due = [s for s in syms if s and _cache_get(f"{ex}:{s}", ttl=ahead) is None]  # WS ile taze olanlar atlanır
+        if not due:
+            continue
+        if len(due) >= PRICE_REFRESH_SNAPSHOT_MIN and refresh_price_snapshot(ex):
+            n += len(due)
+            due = [s for s in due if _cache_get(f"{ex}:{s}", ttl=ahead) is None]
+        for s in due:
+            if _price_single_flight(f"{ex}:{s}", lambda ex=ex, s=s: _public_price_fetch(ex, s), ttl=ahead) is not None:
+                n += 1
+    return n
+
+def _price_refresher_loop() -> None:
+    _PRICE_REFRESHER["running"] = True
+    try:
+        while True:
+            t0 = time.monotonic()
+            try:
+                _PRICE_REFRESHER["refreshed"] += _price_refresh_cycle()
+            except Exception:
+                pass
+            _PRICE_REFRESHER["cycles"] += 1
+            _PRICE_REFRESHER["last_cycle_ms"] = int((time.monotonic() - t0) * 1000)
+            time.sleep(max(0.2, PRICE_REFRESH_SEC - (time.monotonic() - t0)))
+    finally:
+        _PRICE_REFRESHER["running"] = False
+
+def price_refresher_start() -> None:
+    if PRICE_REFRESH_ENABLED:
+        threading.Thread(target=_price_refresher_loop, daemon=True, name="price-refresher").start()
+
+
+# =========================
+# Market-data WS stand-in server (local tests)
+# =========================
+# python server.py ws-standin [port]  -> ws://127.0.0.1:8765/{okx,binance,bybit,gate,okx-private}
+# Her path kendi borsasının subscribe/tick formatını konuşur; abone olunan sembollere
+# rastgele yürüyüşle tick basar. MARKET_WS_URL_<EX> ile client buraya yönlendirilir.
+_WS_STANDIN_ACCOUNT: Dict[str, float] = {"USDT": 1000.0, "BTC": 0.5}  # /okx-private account push
+
+def _ws_standin_tick(ex: str, sym: str, px: float) -> str:
+    bid, ask = px * 0.9999, px * 1.0001
+    ms = int(time.time() * 1000)
+    if ex == "OKX":
+        return json.dumps({"arg": {"channel": "tickers", "instId": sym.replace("/", "-")},
+                           "data": [{"instId": sym.replace("/", "-"), "last": str(px), "bidPx": str(bid), "askPx": str(ask), "ts": str(ms)}]})
+    if ex == "BINANCE":
+        return json.dumps({"e": "24hrTicker", "E": ms, "s": sym.replace("/", ""), "c": str(px), "b": str(bid), "a": str(ask)})
+    if ex == "BYBIT":
+        return json.dumps({"topic": "tickers." + sym.replace("/", ""), "ts": ms, "type": "snapshot",
+                           "data": {"symbol": sym.replace("/", ""), "lastPrice": str(px), "bid1Price": str(bid), "ask1Price": str(ask)}})
+    return json.dumps({"time": ms // 1000, "time_ms": ms, "channel": "spot.tickers", "event": "update",
+                       "result": {"currency_pair": sym.replace("/", "_"), "last": str(px), "highest_bid": str(bid), "lowest_ask": str(ask)}})
+
+def _ws_standin_subs(ex: str, m: Any) -> Tuple[List[str], bool]:
+    """Client mesajından (semboller, subscribe mı) çıkarır."""
+    if not isinstance(m, dict):
+        return [], True
+    if ex == "OKX":
+        return [safe_str(a.get("instId")).replace("-", "/") for a in (m.get("args") or [])], m.get("op") == "subscribe"
+    if ex == "BINANCE":
+        return [_split_quote_suffix(p.split("@")[0]) for p in (m.get("params") or [])], m.get("method") == "SUBSCRIBE"
+    if ex == "BYBIT":
+        return [_split_quote_suffix(safe_str(a).split(".", 1)[-1]) for a in (m.get("args") or [])], m.get("op") == "subscribe"
+    if m.get("channel") == "spot.tickers":
+        return [safe_str(p).replace("_", "/") for p in (m.get("payload") or [])], m.get("event") == "subscribe"
+    return [], True
+
+def _ws_standin_client(sock: socket.socket, tick_sec: float) -> None:
+    buf = b""
+    try:
+        while b"\r\n\r\n" not in buf:
+            chunk = sock.recv(4096)
+            if not chunk:
+                return
+            buf += chunk
+        head, buf = buf.split(b"\r\n\r\n", 1)
+        lines = head.decode("latin-1").split("\r\n")
+        path = (lines[0].split(" ") + ["", ""])[1].strip("/").lower()
+        ex = {"okx": "OKX", "okx-private": "OKX_PRIVATE", "binance": "BINANCE", "bybit": "BYBIT",
+              "gate": "GATEIO", "gateio": "GATEIO"}.get(path.split("/")[0], "OKX")
+        hdr = {k.strip().lower(): v.strip() for k, _, v in (ln.partition(":") for ln in lines[1:])}
+        sock.sendall((
+            "HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+            f"Sec-WebSocket-Accept: {_ws_accept_key(hdr.get('sec-websocket-key', ''))}\r\n\r\n"
+        ).encode())
+
+        def read_exact(n: int) -> bytes:
+            nonlocal buf
+            while len(buf) < n:
+                chunk = sock.recv(4096)
+                if not chunk:
+                    raise ConnectionError("closed")
+                buf += chunk
+            out, buf = buf[:n], buf[n:]
+            return out
+
+        prices: Dict[str, float] = {}
+        account_sub = False
+        next_tick = time.monotonic()
+        while True:
+            wait = max(0.0, next_tick - time.monotonic())
+            if buf or select.select([sock], [], [], wait)[0]:
+                _fin, op, data = _ws_read_frame(read_exact)
+                if op == 0x8:
+                    return
+                if op == 0x9:
+                    sock.sendall(_ws_encode_frame(0xA, data, mask=False))
+                    continue
+                text = data.decode("utf-8", "replace")
+                if text == "ping":
+                    sock.sendall(_ws_encode_frame(0x1, b"pong", mask=False))
+                    continue
+                try:
+                    m = json.loads(text)
+                except Exception:
+                    continue
+                if ex == "OKX_PRIVATE":
+                    # private: her login kabul, account aboneliği sonrası bakiye push
+                    if m.get("op") == "login":
+                        sock.sendall(_ws_encode_frame(0x1, b'{"event":"login","code":"0","msg":""}', mask=False))
+                    elif m.get("op") == "subscribe":
+                        account_sub = True
+                        sock.sendall(_ws_encode_frame(0x1, b'{"event":"subscribe","arg":{"channel":"account"}}', mask=False))
+                    continue
+                syms, on = _ws_standin_subs(ex, m)
+                for s in syms:
+                    if not s:
+                        continue
+                    if on:
+                        prices.setdefault(s.upper(), 100.0)
+                    else:
+                        prices.pop(s.upper(), None)
+                continue
+            for s in list(prices):
+                prices[s] = max(0.0001, prices[s] * (1.0 + random.uniform(-0.002, 0.002)))
+                sock.sendall(_ws_encode_frame(0x1, _ws_standin_tick(ex, s, prices[s]).encode(), mask=False))
+            if account_sub:
+                details = [{"ccy": c, "cashBal": str(v)} for c, v in _WS_STANDIN_ACCOUNT.items()]
+                sock.sendall(_ws_encode_frame(0x1, json.dumps({"arg": {"channel": "account"}, "data": [{"details": details}]}).encode(), mask=False))
+            next_tick = time.monotonic() + tick_sec
+    except Exception:
+        pass
+    finally:
+        try:
+            sock.close()
+        except Exception:
+            pass
+
+def ws_standin_start(port: int = 0, host: str = "127.0.0.1", tick_sec: float = 0.5) -> Dict[str, Any]:
+    """
+    Stand-in'i arka planda başlatır -> {"port", "stop"}. port=0: boş port seçilir.
+    stop() dinleyiciyi ve açık client soketlerini kapatır (testlerde soket düşmesi simülasyonu).
+    """
+    srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    srv.bind((host, int(port)))
+    srv.listen(16)
+    clients: set = set()
+    lock = threading.Lock()
+    stopped = threading.Event()
+
+    def accept_loop() -> None:
+        while not stopped.is_set():
+            try:
+                c, _addr = srv.accept()
+            except Exception:
+                return
+            with lock:
+                if stopped.is_set():
+                    c.close()
+                    return
+                clients.add(c)
+            threading.Thread(target=_ws_standin_client, args=(c, tick_sec), daemon=True).start()
+
+    def stop() -> None:
+        stopped.set()
+        with lock:
+            socks = [srv] + list(clients)
+            clients.clear()
+        for sk in socks:
+            try:
+                sk.shutdown(socket.SHUT_RDWR)
+            except Exception:
+                pass
+            try:
+                sk.close()
+            except Exception:
+                pass
+
+    threading.Thread(target=accept_loop, daemon=True, name="ws-standin").start()
+    return {"port": srv.getsockname()[1], "stop": stop}
+
+def run_ws_standin(port: int = 8765, host: str = "127.0.0.1", tick_sec: float = 0.5) -> None:
+    ws_standin_start(port, host, tick_sec)
+    print("WS STANDIN", f"ws://{host}:{port}/{{okx,binance,bybit,gate,okx-private}}")
+    while True:
+        time.sleep(3600)
+
+
 # =========================
 # Open positions (manual BUY stays visible)
 # =========================
@@ -2482,11 +4418,8 @@ def positions_for_user(username: str) -> List[Dict[str, Any]]:
 
 
 
-def position_add(username: str, exchange_id: str, symbol: str, qty: float, entry_price: float, entry_usdt: float, dry_run: bool, buy_fee_usdt: float = 0.0, buy_fee_coin: float = 0.0, buy_fee_coin_ccy: str = '', buy_ord_id: str = '') -> int:
-    """Always INSERT a new open position (each BUY becomes a new row). Returns position id."""
-    conn = db()
-    cur = conn.cursor()
-    cur.execute(
+def _position_insert(conn: sqlite3.Connection, username: str, exchange_id: str, symbol: str, qty: float, entry_price: float, entry_usdt: float, dry_run: bool, buy_fee_usdt: float = 0.0, buy_fee_coin: float = 0.0, buy_fee_coin_ccy: str = '', buy_ord_id: str = '') -> int:
+    cur = conn.execute(
         """
         INSERT INTO open_positions(username, exchange_id, symbol, qty, entry_price, entry_usdt, buy_fee_usdt, buy_fee_coin, buy_fee_coin_ccy, buy_ord_id, dry_run, created_at)
         VALUES(?,?,?,?,?,?,?,?,?,?,?,?)
@@ -2506,24 +4439,13 @@ def position_add(username: str, exchange_id: str, symbol: str, qty: float, entry
             now_ts(),
         ),
     )
-    pid = int(cur.lastrowid)
-    # users tablosuna AUTO regime kolonları ekle (yoksa)
-    try:
-        cur.execute("PRAGMA table_info(users)")
-        cols = [r[1] for r in cur.fetchall()]
-        if "auto_gate" not in cols:
-            cur.execute("ALTER TABLE users ADD COLUMN auto_gate INTEGER NOT NULL DEFAULT 1")
-        if "auto_mode" not in cols:
-            cur.execute("ALTER TABLE users ADD COLUMN auto_mode TEXT NOT NULL DEFAULT 'NORMAL'")
-        if "auto_gate_reason" not in cols:
-            cur.execute("ALTER TABLE users ADD COLUMN auto_gate_reason TEXT NOT NULL DEFAULT ''")
-    except Exception:
-        pass
-
+    return int(cur.lastrowid)
 
-    conn.commit()
-    conn.close()
-    return pid
+def position_add(username: str, exchange_id: str, symbol: str, qty: float, entry_price: float, entry_usdt: float, dry_run: bool, buy_fee_usdt: float = 0.0, buy_fee_coin: float = 0.0, buy_fee_coin_ccy: str = '', buy_ord_id: str = '') -> int:
+    """Always INSERT a new open position (each BUY becomes a new row). Returns position id."""
+    with db_session() as conn:
+        return _position_insert(conn, username, exchange_id, symbol, qty, entry_price, entry_usdt, dry_run,
+                                buy_fee_usdt, buy_fee_coin, buy_fee_coin_ccy, buy_ord_id)
 
 def get_position(pid: int, username: str | None = None) -> dict | None:
     # Backward compatible: allow get_position(username, pid)
@@ -2571,17 +4493,291 @@ def hash_password(pw: str, salt: str) -> str:
 def verify_password(pw: str, salt: str, pw_hash: str) -> bool:
     return hash_password(pw, salt) == pw_hash
 
-def db() -> sqlite3.Connection:
-    conn = sqlite3.connect(DB_PATH, timeout=30)
+# =========================
+# DB connection manager (kalıcı bağlantı havuzu, WAL)
+# =========================
+# Bağlantılar açık tutulur ve db() çağrıları arasında (thread'ler dahil) yeniden kullanılır.
+# Her db() kendi bağlantısını alır: iç içe db() çağrısının commit/rollback'i dıştaki
+# transaction'a dokunmaz. close() bağlantıyı kapatmaz; commit edilmemiş işi geri alıp havuza iade eder.
+_DB_POOL_LOCK = threading.Lock()
+_DB_POOL: List[sqlite3.Connection] = []
+_DB_POOL_STATS: Dict[str, int] = {"opened": 0, "reused": 0, "discarded": 0}
+
+
+def _db_open() -> sqlite3.Connection:
+    # check_same_thread=False: havuzdaki bağlantı başka thread'e geçebilir (aynı anda tek kullanıcı)
+    conn = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT_MS / 1000.0, check_same_thread=False)
     conn.row_factory = sqlite3.Row
+    conn.execute(f"PRAGMA busy_timeout={int(DB_BUSY_TIMEOUT_MS)}")
+    # WAL: okuyucular yazanı beklemez (ayar DB dosyasında kalıcıdır)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute(f"PRAGMA cache_size=-{int(DB_CACHE_SIZE_KB)}")
+    if DB_MMAP_SIZE > 0:
+        conn.execute(f"PRAGMA mmap_size={int(DB_MMAP_SIZE)}")
     return conn
 
 
+def _db_checkout() -> sqlite3.Connection:
+    with _DB_POOL_LOCK:
+        if _DB_POOL:
+            _DB_POOL_STATS["reused"] += 1
+            return _DB_POOL.pop()
+        _DB_POOL_STATS["opened"] += 1
+    return _db_open()
+
+
+def _db_checkin(conn: sqlite3.Connection) -> None:
+    try:
+        if conn.in_transaction:
+            conn.rollback()
+        conn.row_factory = sqlite3.Row
+    except Exception:
+        # bozuk bağlantıyı havuza geri koyma
+        with _DB_POOL_LOCK:
+            _DB_POOL_STATS["discarded"] += 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+        return
+    with _DB_POOL_LOCK:
+        if len(_DB_POOL) < max(0, DB_POOL_MAX):
+            _DB_POOL.append(conn)
+            return
+        _DB_POOL_STATS["discarded"] += 1
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+
+def db_pool_close_all() -> None:
+    """Boştaki bağlantıları kapatır (shutdown / restore öncesi)."""
+    with _DB_POOL_LOCK:
+        conns = list(_DB_POOL)
+        _DB_POOL.clear()
+    for conn in conns:
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
+def db_pool_stats() -> Dict[str, int]:
+    with _DB_POOL_LOCK:
+        return {"idle": len(_DB_POOL), **_DB_POOL_STATS}
+
+
+class _PooledConn:
+    """db() shim'i: havuzdan alınan bağlantıya delege eder; close() rollback + havuza iade."""
+
+    __slots__ = ("_conn",)
+
+    def __init__(self, conn: sqlite3.Connection):
+        object.__setattr__(self, "_conn", conn)
+
+    def __getattr__(self, name):
+        conn = object.__getattribute__(self, "_conn")
+        if conn is None:
+            raise sqlite3.ProgrammingError("Cannot operate on a closed database.")
+        return getattr(conn, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._conn, name, value)
+
+    def __enter__(self):
+        return self._conn.__enter__()
+
+    def __exit__(self, *exc):
+        return self._conn.__exit__(*exc)
+
+    def close(self) -> None:
+        conn = object.__getattribute__(self, "_conn")
+        if conn is None:
+            return
+        object.__setattr__(self, "_conn", None)
+        # Eski davranış: commit edilmeyen iş close() ile atılırdı
+        _db_checkin(conn)
+
+
+def db() -> sqlite3.Connection:
+    return _PooledConn(_db_checkout())
+
+
 # Backward compatible alias (some older parts called db_connect)
 def db_connect() -> sqlite3.Connection:
     return db()
 
 
+@contextmanager
+def db_session():
+    """
+    Transaction context manager:
+        with db_session() as conn:
+            conn.execute(...)
+    Başarıda commit, hata olursa rollback.
+    """
+    conn = db()
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+        raise
+    finally:
+        conn.close()
+
+# =========================
+# DB group-commit writer (log/audit yazıları)
+# =========================
+# Kritik olmayan yazılar (log_line, set_last_msg, record_trade, add_user_pnl) tek bir
+# writer thread'e kuyruklanır; N ms veya M satırda bir tek transaction ile commit edilir.
+# Böylece order akışı her yazı için ayrı fsync beklemez.
+_DB_WRITE_Q: "queue.Queue[Any]" = queue.Queue(maxsize=max(1, DB_WRITER_QUEUE_MAX))
+_DB_WRITER_LOCK = threading.Lock()
+_DB_WRITER: Dict[str, Any] = {
+    "thread": None,
+    "sync": DB_WRITER_SYNC,
+    "batches": 0,
+    "rows": 0,
+    "sync_fallback": 0,
+    "errors": 0,
+}
+
+
+def _db_writer_count(**inc: int) -> None:
+    with _DB_WRITER_LOCK:
+        for k, v in inc.items():
+            _DB_WRITER[k] += v
+
+
+def _db_write_now(stmts: List[Tuple[str, tuple]]) -> None:
+    with db_session() as conn:
+        for sql, params in stmts:
+            conn.execute(sql, params)
+
+
+def _db_writer_commit(batch: List[List[Tuple[str, tuple]]]) -> None:
+    try:
+        with db_session() as conn:
+            for stmts in batch:
+                for sql, params in stmts:
+                    conn.execute(sql, params)
+        _db_writer_count(batches=1, rows=len(batch))
+        return
+    except Exception as e:
+        print("DB WRITER BATCH FAIL", len(batch), e)
+
+    # Toplu commit patladıysa tek tek dene: bozuk bir satır diğerlerini düşürmesin
+    for stmts in batch:
+        try:
+            _db_write_now(stmts)
+            _db_writer_count(rows=1)
+        except Exception as e:
+            _db_writer_count(errors=1)
+            print("DB WRITER DROP", stmts[0][0][:80] if stmts else "", e)
+
+
+def _db_writer_loop() -> None:
+    while True:
+        item = _DB_WRITE_Q.get()
+        batch: List[List[Tuple[str, tuple]]] = []
+        waiters: List[threading.Event] = []
+        deadline = time.monotonic() + max(0.0, DB_WRITER_BATCH_MS) / 1000.0
+        while True:
+            if isinstance(item, threading.Event):
+                waiters.append(item)  # flush işareti: önceki her şey commit edilince set edilir
+            else:
+                batch.append(item)
+            if waiters or len(batch) >= DB_WRITER_BATCH_ROWS:
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = _DB_WRITE_Q.get(timeout=remaining)
+            except queue.Empty:
+                break
+        if batch:
+            _db_writer_commit(batch)
+        for ev in waiters:
+            ev.set()
+
+
+def _db_writer_ensure_started() -> None:
+    t = _DB_WRITER.get("thread")
+    if t is not None and t.is_alive():
+        return
+    with _DB_WRITER_LOCK:
+        t = _DB_WRITER.get("thread")
+        if t is not None and t.is_alive():
+            return
+        t = threading.Thread(target=_db_writer_loop, daemon=True, name="db-writer")
+        t.start()
+        _DB_WRITER["thread"] = t
+
+
+def db_write_many(stmts: List[Tuple[str, tuple]]) -> None:
+    """Birlikte commit edilmesi gereken (sql, params) listesini writer kuyruğuna atar."""
+    stmts = [(sql, tuple(params or ())) for sql, params in stmts]
+    if not stmts:
+        return
+    if _DB_WRITER["sync"]:
+        _db_write_now(stmts)
+        return
+    _db_writer_ensure_started()
+    try:
+        _DB_WRITE_Q.put_nowait(stmts)
+    except queue.Full:
+        # Kuyruk dolu (sinyal fırtınası): yazıyı kaybetme, çağıran thread'de yaz
+        _db_writer_count(sync_fallback=1)
+        _db_write_now(stmts)
+
+
+def db_write(sql: str, params: tuple = ()) -> None:
+    db_write_many([(sql, params)])
+
+
+def db_writer_flush(timeout: float = 5.0) -> bool:
+    """Kuyruktaki her şey commit edilene kadar bekler (shutdown / testler)."""
+    t = _DB_WRITER.get("thread")
+    if t is None or not t.is_alive():
+        return _DB_WRITE_Q.empty()
+    ev = threading.Event()
+    try:
+        _DB_WRITE_Q.put(ev, timeout=timeout)
+    except queue.Full:
+        return False
+    return ev.wait(timeout)
+
+
+def db_writer_set_sync(enabled: bool) -> None:
+    """Sync mod: yazılar çağıran thread'de hemen commit edilir (testler için)."""
+    if enabled:
+        db_writer_flush()
+    _DB_WRITER["sync"] = bool(enabled)
+
+
+def db_writer_stats() -> Dict[str, Any]:
+    with _DB_WRITER_LOCK:
+        return {
+            "sync": bool(_DB_WRITER["sync"]),
+            "queued": _DB_WRITE_Q.qsize(),
+            "batches": int(_DB_WRITER["batches"]),
+            "rows": int(_DB_WRITER["rows"]),
+            "sync_fallback": int(_DB_WRITER["sync_fallback"]),
+            "errors": int(_DB_WRITER["errors"]),
+        }
+
+
+atexit.register(db_writer_flush)
+
+
 def package_limit_for(name: str) -> int:
     for p in PACKAGES:
         if p["name"].lower() == safe_str(name).lower():
@@ -2606,6 +4802,28 @@ def is_expired(u) -> bool:
         return False
     return now_ts() > exp
 
+# =========================
+# Usage quota (atomik sayaç + bellek aynası)
+# =========================
+# DB tek doğru kaynak; artış tek bir UPSERT ... RETURNING ile atomik yapılır (kayıp increment yok).
+# _USAGE_MIRROR write-through ayna: may_trade / badge hot path'te DB'ye gitmez.
+# Birden fazla process varsa ayna en fazla USAGE_MIRROR_TTL_SEC kadar eski kalabilir.
+USAGE_MIRROR_TTL_SEC = float(os.getenv("USAGE_MIRROR_TTL_SEC", "30").strip() or "30")
+_USAGE_MIRROR: Dict[str, Tuple[int, float]] = {}  # username -> (used_count, monotonic ts)
+_USAGE_LOCK = threading.Lock()
+
+def _usage_mirror_set(username: str, used_count: int, only_up: bool = False) -> None:
+    with _USAGE_LOCK:
+        cur = _USAGE_MIRROR.get(username)
+        # eşzamanlı increment'ler sıra dışı dönebilir: aynayı geri sarma
+        if only_up and cur is not None and cur[0] > int(used_count):
+            return
+        _USAGE_MIRROR[username] = (int(used_count), time.monotonic())
+
+def usage_forget(username: str) -> None:
+    with _USAGE_LOCK:
+        _USAGE_MIRROR.pop(safe_str(username), None)
+
 def get_usage(username: str) -> Dict[str, Any]:
     conn = db()
     try:
@@ -2613,11 +4831,22 @@ def get_usage(username: str) -> Dict[str, Any]:
         if not row:
             conn.execute("INSERT OR IGNORE INTO usage (username, used_count, updated_at) VALUES (?,0,?)", (username, now_ts()))
             conn.commit()
+            _usage_mirror_set(username, 0)
             return {"used_count": 0, "updated_at": now_ts()}
+        _usage_mirror_set(username, int(row["used_count"] or 0))
         return dict(row)
     finally:
         conn.close()
 
+def usage_count(username: str) -> int:
+    """Kullanılan işlem sayısı; aynadan (TTL içinde) yoksa DB'den."""
+    username = safe_str(username)
+    with _USAGE_LOCK:
+        cur = _USAGE_MIRROR.get(username)
+    if cur is not None and (time.monotonic() - cur[1]) < USAGE_MIRROR_TTL_SEC:
+        return cur[0]
+    return int(get_usage(username)["used_count"] or 0)
+
 def set_usage(username: str, used_count: int) -> None:
     conn = db()
     try:
@@ -2629,28 +4858,38 @@ def set_usage(username: str, used_count: int) -> None:
         conn.commit()
     finally:
         conn.close()
+    _usage_mirror_set(username, used_count)
+
+def usage_inc_conn(conn: sqlite3.Connection, username: str) -> int:
+    """Çağıranın transaction'ında atomik +1; yeni değeri döner. Commit sonrası _usage_mirror_set çağrılmalı."""
+    row = conn.execute("""
+        INSERT INTO usage (username, used_count, updated_at)
+        VALUES (?,1,?)
+        ON CONFLICT(username) DO UPDATE SET used_count=used_count+1, updated_at=excluded.updated_at
+        RETURNING used_count
+    """, (username, now_ts())).fetchone()
+    return int(row[0] or 0)
 
 def inc_usage(username: str) -> int:
-    u = get_usage(username)
-    new_used = int(u["used_count"]) + 1
-    set_usage(username, new_used)
+    with db_session() as conn:
+        new_used = usage_inc_conn(conn, username)
+    _usage_mirror_set(username, new_used, only_up=True)
     return new_used
 
 def usage_blocked(u) -> bool:
     limit_v = int((u["package_limit"] if not isinstance(u, dict) else u.get("package_limit")) or 300)
     if limit_v < 0:
         return False
-    used = int(get_usage((u["username"] if not isinstance(u, dict) else u.get("username")) or "")["used_count"])
+    used = usage_count((u["username"] if not isinstance(u, dict) else u.get("username")) or "")
     return used >= limit_v
 
 def format_usage_badge(u) -> str:
     limit_v = int((u["package_limit"] if not isinstance(u, dict) else u.get("package_limit")) or 300)
-    used = int(get_usage((u["username"] if not isinstance(u, dict) else u.get("username")) or "")["used_count"])
+    used = usage_count((u["username"] if not isinstance(u, dict) else u.get("username")) or "")
     if limit_v < 0:
         return f"{used} / ∞"
     return f"{used} / {limit_v}"
 
-
 def get_daily_loss_limit(u) -> float:
     try:
         if not u:
@@ -2725,13 +4964,8 @@ def may_trade(u) -> bool:
     return True
 
 def log_line(username: str, level: str, message: str) -> None:
-    conn = db()
-    try:
-        conn.execute("INSERT INTO logs (username, level, message, created_at) VALUES (?,?,?,?)",
-                     (username, level, message, now_ts()))
-        conn.commit()
-    finally:
-        conn.close()
+    db_write("INSERT INTO logs (username, level, message, created_at) VALUES (?,?,?,?)",
+             (username, level, message, now_ts()))
 
 def get_user(username: str) -> Optional[Dict[str, Any]]:
     conn = db()
@@ -2768,8 +5002,7 @@ def _now():
     return int(time.time())
 
 def get_okx_usdt_symbols():
-    import requests
-    r = requests.get(
+    r = http_get(
         "https://www.okx.com/api/v5/public/instruments",
         params={"instType": "SPOT"},
         timeout=10
@@ -2782,8 +5015,7 @@ def get_okx_usdt_symbols():
     ])
 
 def get_binance_usdt_symbols():
-    import requests
-    r = requests.get("https://api.binance.com/api/v3/exchangeInfo", timeout=10)
+    r = http_get("https://api.binance.com/api/v3/exchangeInfo", timeout=10)
     out = []
     for s in r.json().get("symbols", []):
         if s.get("status") == "TRADING" and s.get("quoteAsset") == "USDT":
@@ -2791,8 +5023,7 @@ def get_binance_usdt_symbols():
     return sorted(out)
 
 def get_gateio_usdt_symbols():
-    import requests
-    r = requests.get("https://api.gateio.ws/api/v4/spot/currency_pairs", timeout=10)
+    r = http_get("https://api.gateio.ws/api/v4/spot/currency_pairs", timeout=10)
     out = []
     for p in r.json():
         if p.get("quote") == "USDT" and p.get("trade_status") == "tradable":
@@ -2800,8 +5031,7 @@ def get_gateio_usdt_symbols():
     return sorted(out)
 
 def get_bybit_usdt_symbols():
-    import requests
-    r = requests.get(
+    r = http_get(
         "https://api.bybit.com/v5/market/instruments-info",
         params={"category": "spot"},
         timeout=10
@@ -2918,6 +5148,18 @@ def get_market_price(exchange: str, symbol: str) -> float:
 
 
 
+@app.get("/api/order-jobs/<int:jid>")
+def api_order_job(jid: int):
+    rr = require_login()
+    if rr:
+        return rr
+    job = order_job_get(jid)
+    if not job or (job.get("username") != session.get("username") and not session.get("is_admin")):
+        return jsonify({"ok": False, "error": "Bulunamadı"}), 404
+    job.pop("dedupe_key", None)
+    return jsonify({"ok": True, "job": job})
+
+
 @app.get("/api/positions")
 def api_positions():
     rr = require_login()
@@ -3010,17 +5252,34 @@ def api_positions():
     out = list(groups.values())
 
     # canlı fiyat + pnl: API her refresh'te "—" göstermesin diye server tarafında dolduruyoruz
+    # (borsa başına tek toplu istek)
+    by_ex: Dict[str, List[str]] = {}
+    for g in out:
+        ex = safe_str(g.get("exchange_id") or DEFAULT_EXCHANGE).strip().upper()
+        by_ex.setdefault(ex, []).append(safe_str(g.get("symbol") or "").strip().upper())
+    px_map: Dict[Tuple[str, str], Optional[float]] = {}
+    for ex, syms in by_ex.items():
+        try:
+            for sym, px in get_public_prices(ex, syms).items():
+                px_map[(ex, sym)] = px
+        except Exception:
+            pass
+
     for g in out:
         ex = safe_str(g.get("exchange_id") or DEFAULT_EXCHANGE).strip().upper()
         sym = safe_str(g.get("symbol") or "").strip().upper()
         qty = _to_float(g.get("qty"), 0.0)
         entry_price = _to_float(g.get("entry_price"), 0.0)
 
-        cur = 0.0
-        try:
-            cur = float(public_price(ex, sym) or 0.0)
-        except Exception:
-            cur = 0.0
+        cur = _to_float(px_map.get((ex, sym)), 0.0)
+
+        # cross-exchange referans (network yok): tek borsa spike'ına karşı PnL_ref
+        ref = get_reference_price(sym)
+        g["ref_price"] = ref["price"] if ref else None
+        g["ref_sources"] = ref["sources"] if ref else 0
+        g["ref_pnl_usdt"] = ((ref["price"] - entry_price) * qty) if (ref and qty > 0 and entry_price > 0) else None
+        if cur <= 0 and ref:
+            cur = float(ref["price"])
 
         if cur <= 0:
             g["current_price"] = None
@@ -3189,7 +5448,6 @@ def telegram_send_to(chat_id: str, text: str) -> None:
         pass
 
     try:
-        import requests
         url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
         payload = {"chat_id": cid, "text": text}
 
@@ -3202,7 +5460,7 @@ def telegram_send_to(chat_id: str, text: str) -> None:
         except Exception:
             pass
 
-        r = requests.post(url, json=payload, timeout=20)
+        r = http_post(url, json=payload, timeout=20)
 
         # Telegram hata dönerse loga yaz (en kritik kısım)
         try:
@@ -3428,8 +5686,10 @@ def ensure_paper_test_schema(conn):
         cur.execute("CREATE INDEX IF NOT EXISTS idx_paper_tr_user_ts ON paper_test_trades(username, ts_close)")
     except Exception:
         pass
-def init_db() -> None:
-    conn = db()
+
+
+def _migration_0001_baseline(conn: sqlite3.Connection) -> None:
+    """v1: eski init_db + runtime ALTER'ların birleşimi. Idempotent; eski DB'lerde de güvenle çalışır."""
     cur = conn.cursor()
 
     # Global settings (admin-only)
@@ -3440,14 +5700,10 @@ def init_db() -> None:
         updated_at INTEGER NOT NULL DEFAULT 0
     )
     """)
-    try:
-        cur.execute(
-            "INSERT OR IGNORE INTO app_settings(key,value,updated_at) VALUES (?,?,?)",
-            ("AUTO_MODE", safe_str(os.getenv("AUTO_MODE", "NORMAL")).upper() or "NORMAL", now_ts()),
-        )
-    except Exception:
-        pass
-
+    cur.execute(
+        "INSERT OR IGNORE INTO app_settings(key,value,updated_at) VALUES (?,?,?)",
+        ("AUTO_MODE", safe_str(os.getenv("AUTO_MODE", "NORMAL")).upper() or "NORMAL", now_ts()),
+    )
 
     cur.execute("""
     CREATE TABLE IF NOT EXISTS users (
@@ -3473,35 +5729,41 @@ def init_db() -> None:
     )
     """)
 
-    # ---- Contract columns (safe ALTER) ----
-    try:
-        cur.execute("ALTER TABLE users ADD COLUMN contract_accepted_at INTEGER NOT NULL DEFAULT 0")
-    except Exception:
-        pass
-    try:
-        cur.execute("ALTER TABLE users ADD COLUMN contract_full_name TEXT NOT NULL DEFAULT ''")
-    except Exception:
-        pass
-    try:
-        cur.execute("ALTER TABLE users ADD COLUMN contract_tc TEXT NOT NULL DEFAULT ''")
-    except Exception:
-        pass
-    try:
-        cur.execute("ALTER TABLE users ADD COLUMN contract_ip TEXT NOT NULL DEFAULT ''")
-    except Exception:
-        pass
-
-    # ---- Telegram columns (safe ALTER) ----
-    try:
-        cur.execute("ALTER TABLE users ADD COLUMN telegram_chat_id TEXT NOT NULL DEFAULT ''")
-    except Exception:
-        pass
-
-    # ---- Take Profit (safe ALTER) ----
-    try:
-        cur.execute("ALTER TABLE users ADD COLUMN tp_pct REAL NOT NULL DEFAULT 0.005")
-    except Exception:
-        pass
+    for col, ddl in [
+        # Contract
+        ("contract_accepted_at", "INTEGER NOT NULL DEFAULT 0"),
+        ("contract_full_name", "TEXT NOT NULL DEFAULT ''"),
+        ("contract_tc", "TEXT NOT NULL DEFAULT ''"),
+        ("contract_ip", "TEXT NOT NULL DEFAULT ''"),
+        # Take Profit
+        ("tp_pct", "REAL NOT NULL DEFAULT 0.005"),
+        # OKX (zorunlu) alanları
+        ("api_key", "TEXT NOT NULL DEFAULT ''"),
+        ("api_secret", "TEXT NOT NULL DEFAULT ''"),
+        ("api_passphrase", "TEXT NOT NULL DEFAULT ''"),
+        # Telegram
+        ("telegram_chat_id", "TEXT NOT NULL DEFAULT ''"),
+        # Daily loss limit (user-defined, USDT). 0 = kapalı
+        ("daily_loss_limit_usdt", "REAL NOT NULL DEFAULT 0.0"),
+        ("force_dry_run", "INTEGER NOT NULL DEFAULT 0"),
+        ("trial_real_enabled", "INTEGER NOT NULL DEFAULT 0"),
+        ("trial_expires_at", "INTEGER NOT NULL DEFAULT 0"),
+        # 3 borsa ayrı alanlar (opsiyonel)
+        ("binance_api_key", "TEXT NOT NULL DEFAULT ''"),
+        ("binance_api_secret", "TEXT NOT NULL DEFAULT ''"),
+        ("bybit_api_key", "TEXT NOT NULL DEFAULT ''"),
+        ("bybit_api_secret", "TEXT NOT NULL DEFAULT ''"),
+        ("gate_api_key", "TEXT NOT NULL DEFAULT ''"),
+        ("gate_api_secret", "TEXT NOT NULL DEFAULT ''"),
+        # Eskiden set_last_msg / position_add içinde runtime ekleniyordu
+        ("last_msg", "TEXT"),
+        ("auto_gate", "INTEGER NOT NULL DEFAULT 1"),
+        ("auto_mode", "TEXT NOT NULL DEFAULT 'NORMAL'"),
+        ("auto_gate_reason", "TEXT NOT NULL DEFAULT ''"),
+        # _set_auto_gate_for_all bu kolonu güncelliyor
+        ("updated_at", "INTEGER NOT NULL DEFAULT 0"),
+    ]:
+        _ensure_column(conn, "users", col, ddl)
 
     # Contract records (admin list + download + delete)
     cur.execute("""
@@ -3527,7 +5789,6 @@ def init_db() -> None:
     )
     """)
 
-
     cur.execute("""
     CREATE TABLE IF NOT EXISTS usage (
         username TEXT PRIMARY KEY,
@@ -3558,161 +5819,25 @@ def init_db() -> None:
         message TEXT NOT NULL,
         created_at INTEGER NOT NULL DEFAULT 0
     )
-    """)
-
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS trades (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        username TEXT NOT NULL,
-        exchange_id TEXT NOT NULL,
-        action TEXT NOT NULL,
-        symbol TEXT NOT NULL,
-        real_usdt REAL NOT NULL DEFAULT 0.0,
-        pnl_usdt REAL NOT NULL DEFAULT 0.0,
-        dry_run INTEGER NOT NULL DEFAULT 1,
-        created_at INTEGER NOT NULL DEFAULT 0
-    )
-    """)
-
-    # Açık pozisyonlar (Manuel/Auto BUY sonrası burada kalır; panelden SELL'e alırsın)
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS open_positions (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        username TEXT NOT NULL,
-        exchange_id TEXT NOT NULL,
-        symbol TEXT NOT NULL,
-        qty REAL NOT NULL DEFAULT 0.0,
-        entry_price REAL NOT NULL DEFAULT 0.0,
-        entry_usdt REAL NOT NULL DEFAULT 0.0,
-        dry_run INTEGER NOT NULL DEFAULT 1,
-        created_at INTEGER NOT NULL DEFAULT 0
-    )
-    """)
-
-    
-    # ---- open_positions fee/order columns (safe ALTER) ----
-    # Eski DB'lerde bu kolonlar yoksa otomatik ekler (PNL ve Telegram fee için)
-    for _sql in [
-        "ALTER TABLE open_positions ADD COLUMN buy_fee_usdt REAL NOT NULL DEFAULT 0.0",
-        "ALTER TABLE open_positions ADD COLUMN buy_fee_coin REAL NOT NULL DEFAULT 0.0",
-        "ALTER TABLE open_positions ADD COLUMN buy_fee_coin_ccy TEXT NOT NULL DEFAULT ''",
-        "ALTER TABLE open_positions ADD COLUMN buy_ord_id TEXT NOT NULL DEFAULT ''",
-        "ALTER TABLE open_positions ADD COLUMN sell_fee_usdt REAL NOT NULL DEFAULT 0.0",
-        "ALTER TABLE open_positions ADD COLUMN sell_fee_coin REAL NOT NULL DEFAULT 0.0",
-        "ALTER TABLE open_positions ADD COLUMN sell_fee_coin_ccy TEXT NOT NULL DEFAULT ''",
-        "ALTER TABLE open_positions ADD COLUMN sell_ord_id TEXT NOT NULL DEFAULT ''",
-    ]:
-        try:
-            cur.execute(_sql)
-        except Exception:
-            pass
-
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS auto_rules (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        username TEXT NOT NULL,
-        exchange_id TEXT NOT NULL,
-        symbol TEXT NOT NULL,
-        usdt REAL NOT NULL DEFAULT 0.0,
-        enabled INTEGER NOT NULL DEFAULT 1,
-        created_at INTEGER NOT NULL DEFAULT 0
-    )
-    """)
-
-    
-    # TEST (paper) schema - safe migrations
-    ensure_paper_test_schema(conn)
-    conn.commit()
-
-    # OKX (zorunlu) alanları: mevcut kolonlar
-    _ensure_column(conn, "users", "api_key", "TEXT NOT NULL DEFAULT ''")
-    _ensure_column(conn, "users", "api_secret", "TEXT NOT NULL DEFAULT ''")
-    _ensure_column(conn, "users", "api_passphrase", "TEXT NOT NULL DEFAULT ''")
-
-    # Telegram
-    _ensure_column(conn, "users", "telegram_chat_id", "TEXT NOT NULL DEFAULT ''")
-
-    # Daily loss limit (user-defined, USDT). 0 = kapalı
-    _ensure_column(conn, "users", "daily_loss_limit_usdt", "REAL NOT NULL DEFAULT 0.0")
-    _ensure_column(conn, "users", "force_dry_run", "INTEGER NOT NULL DEFAULT 0")
-    _ensure_column(conn, "users", "trial_real_enabled", "INTEGER NOT NULL DEFAULT 0")
-    _ensure_column(conn, "users", "trial_expires_at", "INTEGER NOT NULL DEFAULT 0")
-
-
-
-    # 3 borsa ayrı alanlar (opsiyonel)
-    _ensure_column(conn, "users", "binance_api_key", "TEXT NOT NULL DEFAULT ''")
-    _ensure_column(conn, "users", "binance_api_secret", "TEXT NOT NULL DEFAULT ''")
-    _ensure_column(conn, "users", "bybit_api_key", "TEXT NOT NULL DEFAULT ''")
-    _ensure_column(conn, "users", "bybit_api_secret", "TEXT NOT NULL DEFAULT ''")
-    _ensure_column(conn, "users", "gate_api_key", "TEXT NOT NULL DEFAULT ''")
-    _ensure_column(conn, "users", "gate_api_secret", "TEXT NOT NULL DEFAULT ''")
-
-    conn.commit()
-
-    row = conn.execute("SELECT username FROM users WHERE username='admin'").fetchone()
-    if not row:
-        salt = secrets.token_hex(16)
-        pw = "admin"
-        conn.execute("""
-            INSERT INTO users
-            (username, display_name, salt, password_hash, is_admin,
-             trade_enabled, disable_on_limit, exchange_id, webhook_secret,
-             package_name, package_limit, package_months, expires_at,
-             api_key, api_secret, api_passphrase, telegram_chat_id,
-             binance_api_key, binance_api_secret,
-             bybit_api_key, bybit_api_secret,
-             gate_api_key, gate_api_secret,
-             total_pnl, created_at)
-            VALUES (?,?,?,?,1, 1,1, ?,?, ?,?,?, ?, '', '', '', '', '', '', '', '', '', '', 0.0, ?)
-        """, (
-            "admin", "Admin", salt, hash_password(pw, salt),
-            DEFAULT_EXCHANGE, "",
-            "Ultra", -1, 12, now_ts() + 3650 * 24 * 3600,
-            now_ts()
-        ))
-        conn.execute(
-            "INSERT OR IGNORE INTO usage (username, used_count, updated_at) VALUES (?,0,?)",
-            ("admin", now_ts())
-        )
-        conn.commit()
-
+    """)
 
-    # =========================
-    # Paper Test (Simülasyon) tabloları
-    # =========================
     cur.execute("""
-    CREATE TABLE IF NOT EXISTS paper_test_state (
-        username TEXT PRIMARY KEY,
-        usdt REAL NOT NULL DEFAULT 0.0,
-        pnl REAL NOT NULL DEFAULT 0.0,
-        fee REAL NOT NULL DEFAULT 0.0,
-        last_px REAL NOT NULL DEFAULT 0.0,
-        updated_at INTEGER NOT NULL DEFAULT 0
+    CREATE TABLE IF NOT EXISTS trades (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT NOT NULL,
+        exchange_id TEXT NOT NULL,
+        action TEXT NOT NULL,
+        symbol TEXT NOT NULL,
+        real_usdt REAL NOT NULL DEFAULT 0.0,
+        pnl_usdt REAL NOT NULL DEFAULT 0.0,
+        dry_run INTEGER NOT NULL DEFAULT 1,
+        created_at INTEGER NOT NULL DEFAULT 0
     )
     """)
 
-    # Şema migrasyonu: Eski kurulumlarda paper_test_state farklı kolonlarla oluşmuş olabilir.
-    # Bu blok eksik kolonları idempotent şekilde ekler (CREATE TABLE mevcut tabloyu değiştirmez).
-    try:
-        curx = conn.cursor()
-        cols = {r[1] for r in curx.execute("PRAGMA table_info(paper_test_state)").fetchall()}
-        need = {
-            "usdt": "REAL NOT NULL DEFAULT 0.0",
-            "pnl": "REAL NOT NULL DEFAULT 0.0",
-            "fee": "REAL NOT NULL DEFAULT 0.0",
-            "last_px": "REAL NOT NULL DEFAULT 0.0",
-            "updated_at": "INTEGER NOT NULL DEFAULT 0",
-        }
-        for c, ddl in need.items():
-            if c not in cols:
-                curx.execute(f"ALTER TABLE paper_test_state ADD COLUMN {c} {ddl}")
-        conn.commit()
-    except Exception:
-        # Migrasyon başarısız olsa bile test sayfası çökmesin (sonraki çağrıda tekrar dener)
-        pass
+    # Açık pozisyonlar (Manuel/Auto BUY sonrası burada kalır; panelden SELL'e alırsın)
     cur.execute("""
-    CREATE TABLE IF NOT EXISTS paper_test_positions (
+    CREATE TABLE IF NOT EXISTS open_positions (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         username TEXT NOT NULL,
         exchange_id TEXT NOT NULL,
@@ -3720,51 +5845,50 @@ def init_db() -> None:
         qty REAL NOT NULL DEFAULT 0.0,
         entry_price REAL NOT NULL DEFAULT 0.0,
         entry_usdt REAL NOT NULL DEFAULT 0.0,
-        buy_fee_usdt REAL NOT NULL DEFAULT 0.0,
-        opened_at INTEGER NOT NULL DEFAULT 0
+        dry_run INTEGER NOT NULL DEFAULT 1,
+        created_at INTEGER NOT NULL DEFAULT 0
     )
     """)
+
+    # open_positions fee/order kolonları (PNL ve Telegram fee için)
+    for col, ddl in [
+        ("buy_fee_usdt", "REAL NOT NULL DEFAULT 0.0"),
+        ("buy_fee_coin", "REAL NOT NULL DEFAULT 0.0"),
+        ("buy_fee_coin_ccy", "TEXT NOT NULL DEFAULT ''"),
+        ("buy_ord_id", "TEXT NOT NULL DEFAULT ''"),
+        ("sell_fee_usdt", "REAL NOT NULL DEFAULT 0.0"),
+        ("sell_fee_coin", "REAL NOT NULL DEFAULT 0.0"),
+        ("sell_fee_coin_ccy", "TEXT NOT NULL DEFAULT ''"),
+        ("sell_ord_id", "TEXT NOT NULL DEFAULT ''"),
+    ]:
+        _ensure_column(conn, "open_positions", col, ddl)
+
     cur.execute("""
-    CREATE TABLE IF NOT EXISTS paper_test_trades (
+    CREATE TABLE IF NOT EXISTS auto_rules (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         username TEXT NOT NULL,
         exchange_id TEXT NOT NULL,
         symbol TEXT NOT NULL,
-        entry_price REAL NOT NULL,
-        exit_price REAL NOT NULL,
-        qty REAL NOT NULL,
-        invested_usdt REAL NOT NULL,
-        received_usdt REAL NOT NULL,
-        fee_total_usdt REAL NOT NULL,
-        pnl_net_usdt REAL NOT NULL,
-        opened_at INTEGER NOT NULL,
-        closed_at INTEGER NOT NULL
+        usdt REAL NOT NULL DEFAULT 0.0,
+        enabled INTEGER NOT NULL DEFAULT 1,
+        created_at INTEGER NOT NULL DEFAULT 0
     )
     """)
 
-    # paper_test_trades kolon migrasyonu (eski DB'lerde eksik kolon olabilir)
-    try:
-        curx.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='paper_test_trades'").fetchone()
-        cols = [r[1] for r in curx.execute("PRAGMA table_info(paper_test_trades)").fetchall()]
-        def _add_col(col_sql):
-            try:
-                curx.execute(col_sql)
-            except Exception:
-                pass
-        if "opened_at" not in cols:
-            _add_col("ALTER TABLE paper_test_trades ADD COLUMN opened_at INTEGER NOT NULL DEFAULT 0")
-        if "closed_at" not in cols:
-            _add_col("ALTER TABLE paper_test_trades ADD COLUMN closed_at INTEGER NOT NULL DEFAULT 0")
-        if "invested_usdt" not in cols:
-            _add_col("ALTER TABLE paper_test_trades ADD COLUMN invested_usdt REAL NOT NULL DEFAULT 0.0")
-        if "received_usdt" not in cols:
-            _add_col("ALTER TABLE paper_test_trades ADD COLUMN received_usdt REAL NOT NULL DEFAULT 0.0")
-        if "fee_total_usdt" not in cols:
-            _add_col("ALTER TABLE paper_test_trades ADD COLUMN fee_total_usdt REAL NOT NULL DEFAULT 0.0")
-        if "pnl_net_usdt" not in cols:
-            _add_col("ALTER TABLE paper_test_trades ADD COLUMN pnl_net_usdt REAL NOT NULL DEFAULT 0.0")
-    except Exception:
-        pass
+    # =========================
+    # Paper Test (Simülasyon) tabloları
+    # =========================
+    ensure_paper_test_schema(conn)
+
+    # Eski kurulumlarda paper_test_state / paper_test_trades farklı kolonlarla oluşmuş olabilir.
+    for col, ddl in [
+        ("pnl", "REAL NOT NULL DEFAULT 0.0"),
+        ("fee", "REAL NOT NULL DEFAULT 0.0"),
+        ("last_px", "REAL NOT NULL DEFAULT 0.0"),
+        ("updated_at", "INTEGER NOT NULL DEFAULT 0"),
+    ]:
+        _ensure_column(conn, "paper_test_state", col, ddl)
+    _ensure_column(conn, "paper_test_trades", "fee_total_usdt", "REAL NOT NULL DEFAULT 0.0")
 
     cur.execute("""
     CREATE TABLE IF NOT EXISTS paper_test_autorules (
@@ -3779,16 +5903,391 @@ def init_db() -> None:
     )
     """)
 
-    conn.commit()
-    conn.close()
+    # Security (ip ban / login fail / admin flags) - eskiden her request'te oluşturuluyordu
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS ip_bans (
+            ip TEXT PRIMARY KEY,
+            banned_until INTEGER,
+            reason TEXT,
+            created_at INTEGER
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS login_fails (
+            ip TEXT PRIMARY KEY,
+            fails INTEGER,
+            first_ts INTEGER,
+            last_ts INTEGER
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS admin_flags (
+            k TEXT PRIMARY KEY,
+            v TEXT,
+            updated_at INTEGER
+        )
+    """)
+
+
+def _migration_0002_indexes(conn: sqlite3.Connection) -> None:
+    """v2: sıcak sorgular için ikincil index'ler (TP manager, stats_for_user, auto sell, pending)."""
+    for ddl in [
+        # _auto_sell_execute_now: username+exchange_id+symbol(+dry_run) SELECT/DELETE
+        "CREATE INDEX IF NOT EXISTS idx_open_pos_user_ex_sym ON open_positions(username, exchange_id, symbol, dry_run)",
+        # positions_for_user: WHERE username ORDER BY created_at DESC
+        "CREATE INDEX IF NOT EXISTS idx_open_pos_user_created ON open_positions(username, created_at)",
+        # stats_for_user: covering (COUNT/SUM index'ten okunur, tabloya dönmez)
+        "CREATE INDEX IF NOT EXISTS idx_trades_user_dry_created ON trades(username, dry_run, created_at, pnl_usdt, real_usdt)",
+        # son işlemler: WHERE username ORDER BY id DESC (rowid index'in sonunda)
+        "CREATE INDEX IF NOT EXISTS idx_trades_user ON trades(username)",
+        # auto_upsert_rule / auto_get_enabled_match: UPPER(symbol) eşleşmesi
+        "CREATE INDEX IF NOT EXISTS idx_auto_rules_user_ex_sym ON auto_rules(username, exchange_id, UPPER(symbol))",
+        "CREATE INDEX IF NOT EXISTS idx_pending_user_status ON pending_signals(username, status)",
+        "CREATE INDEX IF NOT EXISTS idx_pending_status ON pending_signals(status)",
+        "CREATE INDEX IF NOT EXISTS idx_contracts_user_accepted ON contracts(username, accepted_at)",
+        "CREATE INDEX IF NOT EXISTS idx_contracts_accepted ON contracts(accepted_at)",
+        "CREATE INDEX IF NOT EXISTS idx_paper_rules_user ON paper_test_autorules(username)",
+    ]:
+        conn.execute(ddl)
+
+
+def _migration_0003_pnl_rollups(conn: sqlite3.Connection) -> None:
+    """v3: stats_for_user için artımlı PnL özet tablosu + mevcut trades'ten backfill."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS pnl_rollups (
+            username TEXT NOT NULL,
+            bucket_kind TEXT NOT NULL,
+            bucket_start INTEGER NOT NULL,
+            dry_run INTEGER NOT NULL DEFAULT 0,
+            trade_count INTEGER NOT NULL DEFAULT 0,
+            pnl_usdt REAL NOT NULL DEFAULT 0.0,
+            vol_usdt REAL NOT NULL DEFAULT 0.0,
+            updated_at INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (username, bucket_kind, bucket_start, dry_run)
+        ) WITHOUT ROWID
+    """)
+    rebuild_pnl_rollups(conn)
+    # init_db'nin TZ kontrolü aynı tabloyu ilk açılışta ikinci kez kurmasın
+    conn.execute(
+        "INSERT INTO app_settings(key,value,updated_at) VALUES (?,?,?) "
+        "ON CONFLICT(key) DO UPDATE SET value=excluded.value, updated_at=excluded.updated_at",
+        ("PNL_ROLLUP_TZ", str(TZ_OFFSET_HOURS), now_ts()),
+    )
+
+
+def _migration_0004_log_indexes(conn: sqlite3.Connection) -> None:
+    """v4: logs retention (created_at) ve /admin/logs filtreleri için index'ler; rowid (id) index'in sonunda."""
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_logs_created ON logs(created_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_logs_user ON logs(username)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_logs_level ON logs(level)")
+
+
+def _migration_0005_logs_fts(conn: sqlite3.Connection) -> None:
+    """v5: logs için FTS5 (external content) + trigger'lar + backfill. FTS5 yoksa atlanır (LIKE fallback)."""
+    try:
+        conn.execute("CREATE VIRTUAL TABLE temp._fts5_probe USING fts5(x)")
+        conn.execute("DROP TABLE temp._fts5_probe")
+    except Exception:
+        print("DB MIGRATION logs_fts: FTS5 yok, LIKE fallback kullanılacak")
+        return
+    conn.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS logs_fts USING fts5(
+            message,
+            content='logs',
+            content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS logs_fts_ai AFTER INSERT ON logs BEGIN
+            INSERT INTO logs_fts(rowid, message) VALUES (new.id, new.message);
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS logs_fts_ad AFTER DELETE ON logs BEGIN
+            INSERT INTO logs_fts(logs_fts, rowid, message) VALUES ('delete', old.id, old.message);
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS logs_fts_au AFTER UPDATE OF message ON logs BEGIN
+            INSERT INTO logs_fts(logs_fts, rowid, message) VALUES ('delete', old.id, old.message);
+            INSERT INTO logs_fts(rowid, message) VALUES (new.id, new.message);
+        END
+    """)
+    conn.execute("INSERT INTO logs_fts(logs_fts) VALUES ('rebuild')")
+
+
+def _migration_0006_order_jobs(conn: sqlite3.Connection) -> None:
+    """v6: order engine kuyruğu (order_jobs) + claim / kullanıcı / dedupe index'leri."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS order_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            username TEXT NOT NULL DEFAULT '',
+            exchange_id TEXT NOT NULL DEFAULT '',
+            symbol TEXT NOT NULL DEFAULT '',
+            priority INTEGER NOT NULL DEFAULT 20,
+            status TEXT NOT NULL DEFAULT 'QUEUED',
+            dedupe_key TEXT NOT NULL DEFAULT '',
+            payload_json TEXT NOT NULL DEFAULT '{}',
+            result_json TEXT NOT NULL DEFAULT '',
+            error TEXT NOT NULL DEFAULT '',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            run_after REAL NOT NULL DEFAULT 0,
+            created_at INTEGER NOT NULL,
+            started_at INTEGER NOT NULL DEFAULT 0,
+            finished_at INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_order_jobs_claim ON order_jobs(status, priority, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_order_jobs_user ON order_jobs(username, id)")
+    # aynı iş (ör. aynı stack'in SELL'i) kuyrukta/çalışırken ikinci kez eklenmez
+    conn.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_order_jobs_dedupe ON order_jobs(dedupe_key)
+        WHERE dedupe_key <> '' AND status IN ('QUEUED', 'RUNNING')
+    """)
+
+
+def _migration_0007_order_job_keys(conn: sqlite3.Connection) -> None:
+    """v7: job sahibi + heartbeat (crash recovery) ve stack anahtarları (aynı sembolde sıralı çalışma)."""
+    _ensure_column(conn, "order_jobs", "owner", "TEXT NOT NULL DEFAULT ''")
+    _ensure_column(conn, "order_jobs", "heartbeat_at", "INTEGER NOT NULL DEFAULT 0")
+    # key = kullanıcı:BORSA:BASE/QUOTE; batch job'lar birden çok key taşır
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS order_job_keys (
+            job_id INTEGER NOT NULL,
+            key TEXT NOT NULL,
+            PRIMARY KEY (job_id, key)
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_order_job_keys_key ON order_job_keys(key, job_id)")
+
+
+def _fts_fold_sql(expr: str) -> str:
+    # unicode61 ı/İ'yi i'ye katlamaz (İ -> i̇ olur): indexlenen metin ve sorgu aynı şekilde katlanır
+    return f"replace(replace({expr}, 'ı', 'i'), 'İ', 'i')"
+
+
+def _migration_0008_logs_fts_fold(conn: sqlite3.Connection) -> None:
+    """v8: logs_fts içeriği ı/İ -> i katlanmış indexlenir (trigger'lar + yeniden index)."""
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='logs_fts'").fetchone() is None:
+        return
+    for t in ("logs_fts_ai", "logs_fts_ad", "logs_fts_au"):
+        conn.execute(f"DROP TRIGGER IF EXISTS {t}")
+    new_msg, old_msg = _fts_fold_sql("new.message"), _fts_fold_sql("old.message")
+    conn.execute(f"""
+        CREATE TRIGGER logs_fts_ai AFTER INSERT ON logs BEGIN
+            INSERT INTO logs_fts(rowid, message) VALUES (new.id, {new_msg});
+        END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER logs_fts_ad AFTER DELETE ON logs BEGIN
+            INSERT INTO logs_fts(logs_fts, rowid, message) VALUES ('delete', old.id, {old_msg});
+        END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER logs_fts_au AFTER UPDATE OF message ON logs BEGIN
+            INSERT INTO logs_fts(logs_fts, rowid, message) VALUES ('delete', old.id, {old_msg});
+            INSERT INTO logs_fts(rowid, message) VALUES (new.id, {new_msg});
+        END
+    """)
+    # 'rebuild' content tablosunu katlamadan okur: index elle yeniden doldurulur
+    conn.execute("INSERT INTO logs_fts(logs_fts) VALUES ('delete-all')")
+    conn.execute(f"INSERT INTO logs_fts(rowid, message) SELECT id, {_fts_fold_sql('message')} FROM logs")
+
+
+# (version, name, fn) - sadece sona ekle; yayınlanmış bir migration'ı asla değiştirme.
+SCHEMA_MIGRATIONS: List[Tuple[int, str, Callable[[sqlite3.Connection], None]]] = [
+    (1, "baseline", _migration_0001_baseline),
+    (2, "indexes", _migration_0002_indexes),
+    (3, "pnl_rollups", _migration_0003_pnl_rollups),
+    (4, "log_indexes", _migration_0004_log_indexes),
+    (5, "logs_fts", _migration_0005_logs_fts),
+    (6, "order_jobs", _migration_0006_order_jobs),
+    (7, "order_job_keys", _migration_0007_order_job_keys),
+    (8, "logs_fts_fold", _migration_0008_logs_fts_fold),
+]
+
+
+def db_schema_version(conn: sqlite3.Connection) -> int:
+    try:
+        return int(conn.execute("PRAGMA user_version").fetchone()[0] or 0)
+    except Exception:
+        return 0
+
+
+def run_migrations() -> int:
+    """Bekleyen migration'ları sırayla uygular (PRAGMA user_version ile takip edilir).
+    Her adım kendi BEGIN IMMEDIATE transaction'ında çalışır; aynı anda açılan
+    birden fazla worker aynı adımı iki kez uygulamaz. Güncel sürümü döndürür."""
+    conn = db()
+    try:
+        version = db_schema_version(conn)
+        for ver, name, fn in SCHEMA_MIGRATIONS:
+            if ver <= version:
+                continue
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Lock alındıktan sonra tekrar oku (başka process uygulamış olabilir)
+                version = db_schema_version(conn)
+                if ver <= version:
+                    conn.rollback()
+                    continue
+                fn(conn)
+                conn.execute(f"PRAGMA user_version={int(ver)}")
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            version = ver
+            print("DB MIGRATION APPLIED", ver, name)
+        return version
+    finally:
+        conn.close()
+
+
+def init_db() -> None:
+    run_migrations()
+
+    # pnl_rollups bucket'ları TZ_OFFSET_HOURS'a göre; offset değiştiyse yeniden kur
+    try:
+        tz = str(TZ_OFFSET_HOURS)
+        if get_app_setting("PNL_ROLLUP_TZ", "") != tz:
+            with db_session() as conn:
+                rebuild_pnl_rollups(conn)
+            set_app_setting("PNL_ROLLUP_TZ", tz)
+    except Exception as e:
+        print("PNL ROLLUP REBUILD FAIL", e)
+
+    conn = db()
+    try:
+        row = conn.execute("SELECT username FROM users WHERE username='admin'").fetchone()
+        if not row:
+            salt = secrets.token_hex(16)
+            pw = "admin"
+            conn.execute("""
+                INSERT INTO users
+                (username, display_name, salt, password_hash, is_admin,
+                 trade_enabled, disable_on_limit, exchange_id, webhook_secret,
+                 package_name, package_limit, package_months, expires_at,
+                 api_key, api_secret, api_passphrase, telegram_chat_id,
+                 binance_api_key, binance_api_secret,
+                 bybit_api_key, bybit_api_secret,
+                 gate_api_key, gate_api_secret,
+                 total_pnl, created_at)
+                VALUES (?,?,?,?,1, 1,1, ?,?, ?,?,?, ?, '', '', '', '', '', '', '', '', '', '', 0.0, ?)
+            """, (
+                "admin", "Admin", salt, hash_password(pw, salt),
+                DEFAULT_EXCHANGE, "",
+                "Ultra", -1, 12, now_ts() + 3650 * 24 * 3600,
+                now_ts()
+            ))
+            conn.execute(
+                "INSERT OR IGNORE INTO usage (username, used_count, updated_at) VALUES (?,0,?)",
+                ("admin", now_ts())
+            )
+            conn.commit()
+    finally:
+        conn.close()
+
+
+# =========================
+# DB index usage report (EXPLAIN QUERY PLAN)
+# =========================
+_SQL_PREFIXES = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")
+
+
+def _module_sql_statements() -> List[Tuple[int, str]]:
+    """Bu dosyadaki sabit SQL string'lerini (satır, sql) olarak döner. f-string'ler atlanır."""
+    try:
+        with open(os.path.abspath(__file__), "r", encoding="utf-8") as f:
+            tree = ast.parse(f.read())
+    except Exception:
+        return []
+    # f-string parçaları tek başına geçerli SQL değil
+    fparts = {id(v) for n in ast.walk(tree) if isinstance(n, ast.JoinedStr) for v in n.values}
+    out: List[Tuple[int, str]] = []
+    seen = set()
+    for node in ast.walk(tree):
+        if not (isinstance(node, ast.Constant) and isinstance(node.value, str)) or id(node) in fparts:
+            continue
+        sql = " ".join(node.value.split())
+        words = sql.split(" ")
+        if len(words) < 3 or words[0].upper() not in _SQL_PREFIXES or sql in seen:
+            continue
+        seen.add(sql)
+        out.append((int(getattr(node, "lineno", 0) or 0), sql))
+    out.sort()
+    return out
+
+
+def db_index_report() -> Dict[str, Any]:
+    """
+    Modüldeki her SQL için EXPLAIN QUERY PLAN çalıştırır. Tam tablo taramaları (SCAN t) "scans",
+    tam index taramaları (SCAN t USING [COVERING] INDEX / VIRTUAL TABLE INDEX) "index_scans" olarak işaretlenir.
+    """
+    items: List[Dict[str, Any]] = []
+    conn = db()
+    try:
+        version = db_schema_version(conn)
+        for line, sql in _module_sql_statements():
+            item: Dict[str, Any] = {"line": line, "sql": sql, "plan": [], "scans": [], "index_scans": [], "error": ""}
+            try:
+                params = (None,) * sql.count("?")
+                rows = conn.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+                for r in rows:
+                    detail = safe_str(r[3])
+                    item["plan"].append(detail)
+                    # "SCAN trades" / "SCAN TABLE trades" -> O(n) tablo; "SCAN trades USING (COVERING) INDEX ..."
+                    # -> O(n) index (daha hafif ama yine tam tarama). SEARCH / CONSTANT ROW / subquery atlanır.
+                    parts = detail.split()
+                    if len(parts) >= 2 and parts[0] == "SCAN" and not parts[1].startswith(("CONSTANT", "(")):
+                        table = parts[2] if parts[1] == "TABLE" and len(parts) > 2 else parts[1]
+                        if " USING " in detail or "VIRTUAL TABLE" in detail:
+                            item["index_scans"].append(table)
+                        else:
+                            item["scans"].append(table)
+            except Exception as e:
+                item["error"] = safe_str(e)
+            items.append(item)
+    finally:
+        conn.close()
 
+    return {
+        "schema_version": version,
+        "total": len(items),
+        "full_scans": sum(1 for x in items if x["scans"]),
+        "index_scans": sum(1 for x in items if x["index_scans"]),
+        "errors": sum(1 for x in items if x["error"]),
+        "items": items,
+    }
+
+
+def _print_db_index_report() -> None:
+    rep = db_index_report()
+    for x in rep["items"]:
+        if not (x["scans"] or x["index_scans"] or x["error"]):
+            continue
+        if x["error"]:
+            tag = "ERROR"
+        elif x["scans"]:
+            tag = "SCAN " + ",".join(x["scans"])
+        else:
+            tag = "IDX-SCAN " + ",".join(x["index_scans"])
+        print(f"{x['line']:>6}  {tag}")
+        print(f"        {x['sql'][:160]}")
+        for d in x["plan"]:
+            print(f"          {d}")
+        if x["error"]:
+            print(f"          {x['error']}")
+    print(f"schema v{rep['schema_version']}  statements={rep['total']}  full_scans={rep['full_scans']}  index_scans={rep['index_scans']}  errors={rep['errors']}")
 
 # =========================
 # Paper Test helpers
 # =========================
 def _get_usdt_try_rate() -> float:
     try:
-        r = requests.get("https://api.binance.com/api/v3/ticker/price", params={"symbol":"USDTTRY"}, timeout=4)
+        r = http_get("https://api.binance.com/api/v3/ticker/price", params={"symbol":"USDTTRY"}, timeout=4)
         j = r.json()
         return float(j.get("price") or 0.0)
     except Exception:
@@ -3804,26 +6303,6 @@ def paper_test_ensure_state(username: str) -> dict:
     else:
         username = safe_str(username or "")
     conn = db()
-
-    # Şema migrasyonu: Eski kurulumlarda paper_test_state farklı kolonlarla oluşmuş olabilir.
-    # Bu blok eksik kolonları idempotent şekilde ekler (CREATE TABLE mevcut tabloyu değiştirmez).
-    try:
-        curx = conn.cursor()
-        cols = {r[1] for r in curx.execute("PRAGMA table_info(paper_test_state)").fetchall()}
-        need = {
-            "usdt": "REAL NOT NULL DEFAULT 0.0",
-            "pnl": "REAL NOT NULL DEFAULT 0.0",
-            "fee": "REAL NOT NULL DEFAULT 0.0",
-            "last_px": "REAL NOT NULL DEFAULT 0.0",
-            "updated_at": "INTEGER NOT NULL DEFAULT 0",
-        }
-        for c, ddl in need.items():
-            if c not in cols:
-                curx.execute(f"ALTER TABLE paper_test_state ADD COLUMN {c} {ddl}")
-        conn.commit()
-    except Exception:
-        # Migrasyon başarısız olsa bile test sayfası çökmesin (sonraki çağrıda tekrar dener)
-        pass
     try:
         row = conn.execute("SELECT * FROM paper_test_state WHERE username=? LIMIT 1", (username,)).fetchone()
         if row:
@@ -3910,6 +6389,137 @@ def _require_keys_for_exchange(exchange_id: str, api_key: str, api_secret: str,
         return None
     return "Borsa seçimi geçersiz"
 
+def _order_fee_to_usdt(ex: str, symbol: str, ccy: str, amt: float, px_hint: float = 0.0) -> float:
+    c = safe_str(ccy).upper()
+    a = abs(_to_float(amt, 0.0))
+    if a <= 0:
+        return 0.0
+    if c in ("USDT", "USD"):
+        return a
+    # if fee coin is base coin, convert with fill price hint
+    try:
+        base_ccy = _base_ccy_from_symbol(symbol).upper()
+        if base_ccy and c == base_ccy and px_hint > 0:
+            return a * float(px_hint)
+    except Exception:
+        pass
+    # try public price for fee coin
+    try:
+        px = _to_float(get_public_price(ex, f"{c}/USDT"), 0.0)
+        if px > 0:
+            return a * px
+    except Exception:
+        pass
+    return 0.0
+
+
+def _order_pre_balances(adapter: "ExchangeAdapter", symbol: str) -> Tuple[str, Optional[float], Optional[float]]:
+    """Balance snapshot (fee delta fix): bellekten, emir yolunda REST yok."""
+    base_ccy = _base_ccy_from_symbol(symbol.replace("-", "/").replace("_", "/"))
+    adapter.last_used = time.time()
+    okx_private_ws_ensure(adapter)
+    bal_before_usdt = bal_before_base = None
+    if adapter.balance_delta_fees:
+        bal_before_usdt = balance_snapshot(adapter, "USDT", BALANCE_DELTA_MAX_AGE_SEC)
+        bal_before_base = balance_snapshot(adapter, base_ccy, BALANCE_DELTA_MAX_AGE_SEC) if base_ccy else 0.0
+    return base_ccy, bal_before_usdt, bal_before_base
+
+
+def _order_finish(adapter: "ExchangeAdapter", ex: str, action: str, symbol: str, amount: float, res: Dict[str, Any],
+                  base_ccy: str, bal_before_usdt: Optional[float], bal_before_base: Optional[float]) -> Dict[str, Any]:
+    """Kabul edilmiş emrin fill + fee sonucu (place_order dönüş şekli)."""
+    ord_id = safe_str(res.get("ord_id"))
+    j = res.get("raw")
+
+    # Fill + fee
+    try:
+        fills = adapter.fetch_fills(symbol, ord_id, j)
+    except Exception:
+        fills = _empty_fills()
+    fill_price = _to_float(fills.get("fill_price"), 0.0)
+    fill_qty = _to_float(fills.get("fill_qty"), 0.0)
+    real_usdt = _to_float(fills.get("real_usdt"), 0.0)
+
+    if fill_price <= 0:
+        fill_price = _to_float(get_public_price(ex, symbol), 0.0)
+    if fill_price <= 0:
+        fill_price = reference_price(ex, symbol) or 100.0
+
+    fee_usdt = 0.0
+    fee_coin = 0.0
+    fee_coin_ccy = ""
+    for ccy, amt, px_hint in fills.get("fees") or []:
+        if amt <= 0 or not ccy:
+            continue
+        usd = amt if ccy in ("USDT", "USD") else (_order_fee_to_usdt(ex, symbol, ccy, amt, px_hint or fill_price) if adapter.convert_coin_fees else 0.0)
+        if usd > 0:
+            fee_usdt += usd
+        else:
+            fee_coin += amt
+            fee_coin_ccy = ccy
+    if fee_usdt > 0:
+        fee_coin = 0.0
+        fee_coin_ccy = ""
+
+    if action == "BUY":
+        if fill_qty <= 0:
+            fill_qty = amount / fill_price if fill_price > 0 else 0.0
+        if real_usdt <= 0:
+            real_usdt = amount
+    else:
+        if fill_qty <= 0:
+            fill_qty = amount
+        if real_usdt <= 0:
+            real_usdt = fill_qty * fill_price
+
+    # --- Balance-delta fee fix ---
+    # Sadece fill fee döndürmediyse ve emir öncesi taze snapshot varsa REST'e gider;
+    # aksi halde fill tracker'a uygulanır, REST uzlaştırması arka planda.
+    if (adapter.balance_delta_fees and fee_usdt <= 0 and fee_coin <= 0
+            and bal_before_usdt is not None and bal_before_base is not None):
+        try:
+            bal_after_usdt = adapter.get_balance("USDT")
+            bal_after_base = adapter.get_balance(base_ccy) if base_ccy else 0.0
+
+            if action == "BUY":
+                # Notional spent (excludes fee)
+                usdt_delta = max(0.0, bal_before_usdt - bal_after_usdt)
+                fee_usdt_delta = max(0.0, usdt_delta - real_usdt)
+
+                base_delta = max(0.0, bal_after_base - bal_before_base)
+                fee_coin_delta = max(0.0, fill_qty - base_delta)
+            else:  # SELL
+                net_usdt_gain = max(0.0, bal_after_usdt - bal_before_usdt)
+                fee_usdt_delta = max(0.0, real_usdt - net_usdt_gain)
+
+                base_spent = max(0.0, bal_before_base - bal_after_base)
+                fee_coin_delta = max(0.0, base_spent - fill_qty)
+
+            # If API returns 0 fee, use delta-derived values
+            if fee_usdt_delta > 0 and fee_usdt <= 0:
+                fee_usdt = fee_usdt_delta
+            if fee_coin_delta > 0 and fee_coin <= 0 and base_ccy:
+                fee_coin = fee_coin_delta
+                fee_coin_ccy = base_ccy
+        except Exception:
+            pass
+    else:
+        balance_track_fill(adapter, action, base_ccy, fill_qty, real_usdt, fee_usdt, fee_coin, fee_coin_ccy)
+    balance_reconcile_soon(adapter, ["USDT", base_ccy])
+
+    return {
+        "ok": True,
+        "fill_price": fill_price,
+        "fill_qty": fill_qty,
+        "real_usdt": real_usdt,
+        "fee_usdt": fee_usdt,
+        "fee_coin": fee_coin,
+        "fee_coin_ccy": fee_coin_ccy,
+        "ord_id": ord_id,
+        "raw": j,
+    }
+
+
 def place_order(exchange_id: str, action: str, symbol: str, usdt_amount: float, dry_run: bool,
                 api_key: str, api_secret: str, api_passphrase: str) -> Dict[str, Any]:
     """
@@ -3920,7 +6530,6 @@ def place_order(exchange_id: str, action: str, symbol: str, usdt_amount: float,
       - BUY: usdt_amount is QUOTE amount (USDT)
       - SELL: usdt_amount is BASE qty (sell all)
     """
-    import requests
 
     # ---- Safety: normalize numeric inputs ----
     usdt_amount = _to_float(usdt_amount, 0.0)
@@ -3943,34 +6552,11 @@ def place_order(exchange_id: str, action: str, symbol: str, usdt_amount: float,
     if usdt_amount <= 0:
         return {"ok": False, "reason": "Miktar sıfır"}
 
-    def _fee_to_usdt(ccy: str, amt: float, px_hint: float = 0.0) -> float:
-        c = safe_str(ccy).upper()
-        a = abs(_to_float(amt, 0.0))
-        if a <= 0:
-            return 0.0
-        if c in ("USDT", "USD"):
-            return a
-        # if fee coin is base coin, convert with fill price hint
-        try:
-            base_ccy = _base_ccy_from_symbol(symbol).upper()
-            if base_ccy and c == base_ccy and px_hint > 0:
-                return a * float(px_hint)
-        except Exception:
-            pass
-        # try public price for fee coin
-        try:
-            px = _to_float(get_public_price(ex, f"{c}/USDT"), 0.0)
-            if px > 0:
-                return a * px
-        except Exception:
-            pass
-        return 0.0
-
     # =========================
     # DRY RUN
     # =========================
     if dry_run:
-        fill_price = _to_float(get_public_price(ex, symbol), 0.0)
+        fill_price = reference_price(ex, symbol)
         if fill_price <= 0:
             fill_price = 100.0
         if action == "BUY":
@@ -4003,535 +6589,634 @@ def place_order(exchange_id: str, action: str, symbol: str, usdt_amount: float,
     # LIVE ORDERS
     # =========================
     try:
-        if ex == "OKX":
-            inst_id = symbol.replace("/", "-").replace("_", "-").upper()
-
-            base_url = os.getenv("OKX_BASE_URL", "https://www.okx.com")
-            path = "/api/v5/trade/order"
-            url = base_url.rstrip("/") + path
-
-            body_obj: Dict[str, Any] = {
-                "instId": inst_id,
-                "tdMode": "cash",
-                "side": "buy" if action == "BUY" else "sell",
-                "ordType": "market",
-            }
-
-            if action == "BUY":
-                body_obj["tgtCcy"] = "quote_ccy"
-                body_obj["sz"] = f"{usdt_amount:.8f}".rstrip("0").rstrip(".")
-            else:
-                body_obj["sz"] = f"{usdt_amount:.8f}".rstrip("0").rstrip(".")
+        adapter = exchange_adapter(ex, api_key, api_secret, api_passphrase)
+        if adapter is None:
+            return {"ok": False, "reason": f"Desteklenmeyen borsa: {ex}"}
+        # lot / min notional: borsanın reddedeceği emri hiç gönderme
+        usdt_amount, size_err = instrument_adjust(ex, action, symbol, usdt_amount)
+        if size_err:
+            return {"ok": False, "reason": size_err}
+        if not order_rate_acquire(ex, api_key):
+            return {"ok": False, "reason": f"{ex} emir limiti dolu, sonra tekrar dene"}
 
-            body_json = json.dumps(body_obj, separators=(",", ":"), ensure_ascii=False)
+        base_ccy, bal_before_usdt, bal_before_base = _order_pre_balances(adapter, symbol)
 
-            ts = datetime.now(timezone.utc).isoformat(timespec="milliseconds").replace("+00:00", "Z")
-            prehash = ts + "POST" + path + body_json
-            sign = base64.b64encode(hmac.new(api_secret.encode(), prehash.encode(), hashlib.sha256).digest()).decode()
+        if action == "BUY":
+            res = adapter.market_buy_quote(symbol, usdt_amount)
+        else:
+            res = adapter.market_sell_base(symbol, usdt_amount)
+        if not res.get("ok"):
+            return res
+        return _order_finish(adapter, ex, action, symbol, usdt_amount, res, base_ccy, bal_before_usdt, bal_before_base)
 
-            headers = {
-                "OK-ACCESS-KEY": api_key,
-                "OK-ACCESS-SIGN": sign,
-                "OK-ACCESS-TIMESTAMP": ts,
-                "OK-ACCESS-PASSPHRASE": api_passphrase,
-                "Content-Type": "application/json",
-            }
+    except Exception as e:
+        return {"ok": False, "reason": f"Emir hatası: {e}"}
 
 
-            # --- Balance snapshot (OKX) ---
-            base_ccy = ""
-            try:
-                if "/" in symbol:
-                    base_ccy = symbol.split("/")[0].strip().upper()
-                elif "-" in inst_id:
-                    base_ccy = inst_id.split("-")[0].strip().upper()
-            except Exception:
-                base_ccy = ""
-            bal_before_usdt = okx_get_asset_balance("USDT", api_key, api_secret, api_passphrase)
-            bal_before_base = okx_get_asset_balance(base_ccy, api_key, api_secret, api_passphrase) if base_ccy else 0.0
+def place_order_batch(exchange_id: str, action: str, orders: List[Tuple[str, float]], dry_run: bool,
+                      api_key: str, api_secret: str, api_passphrase: str) -> List[Dict[str, Any]]:
+    """
+    Aynı API key ile birden çok spot MARKET emir: borsanın toplu endpoint'iyle adapter.batch_max'lık
+    parçalar halinde gider, her parça tek rate-limit token'ı harcar (Binance spot'ta toplu endpoint yok: sırayla).
+    orders: [(symbol, amount)] (amount place_order'daki gibi). Sonuçlar aynı sırada, place_order dönüş şeklinde.
+    """
+    action = (action or "").upper().strip()
+    ex = (exchange_id or "").upper().strip()
+    items = [((sym or "").upper().strip(), _to_float(amt, 0.0)) for sym, amt in orders]
+    if dry_run or len(items) <= 1:
+        return [place_order(ex, action, sym, amt, dry_run, api_key, api_secret, api_passphrase) for sym, amt in items]
 
-            r = requests.post(url, headers=headers, data=body_json.encode("utf-8"), timeout=15)
-            j = r.json() if r is not None else {}
-            if safe_str((j or {}).get("code")) != "0":
-                return {"ok": False, "reason": safe_str((j or {}).get("msg") or "OKX emir hatası"), "raw": j}
+    try:
+        if is_global_panic():
+            return [{"ok": False, "reason": "PANIC aktif"} for _ in items]
+    except Exception:
+        pass
 
-            ord_id = ""
+    api_key = safe_str(api_key).strip()
+    adapter = exchange_adapter(ex, api_key, safe_str(api_secret).strip(), safe_str(api_passphrase).strip())
+    if adapter is None:
+        return [{"ok": False, "reason": f"Desteklenmeyen borsa: {ex}"} for _ in items]
+
+    out: List[Optional[Dict[str, Any]]] = [None] * len(items)
+    todo: List[int] = []
+    for i, (sym, amt) in enumerate(items):
+        if amt <= 0:
+            out[i] = {"ok": False, "reason": "Miktar sıfır"}
+            continue
+        amt, size_err = instrument_adjust(ex, action, sym, amt)
+        if size_err:
+            out[i] = {"ok": False, "reason": size_err}
+            continue
+        items[i] = (sym, amt)
+        todo.append(i)
+
+    step = max(1, int(adapter.batch_max))
+    for c0 in range(0, len(todo), step):
+        chunk = todo[c0:c0 + step]
+        if not order_rate_acquire(ex, api_key):
+            for i in chunk:
+                out[i] = {"ok": False, "reason": f"{ex} emir limiti dolu, sonra tekrar dene"}
+            continue
+        # toplu emirde bakiye farkı emir başına ayrılamaz: fee delta fix yok, fill'ler tracker'a uygulanır
+        base = {i: _order_pre_balances(adapter, items[i][0])[0] for i in chunk}
+        try:
+            ress = adapter.market_order_batch([(items[i][0], action, items[i][1]) for i in chunk])
+        except Exception as e:
+            ress = [{"ok": False, "reason": f"Emir hatası: {e}"} for _ in chunk]
+        for n, i in enumerate(chunk):
+            res = ress[n] if n < len(ress) else {"ok": False, "reason": "Toplu emir yanıtı eksik"}
+            if not (res or {}).get("ok"):
+                out[i] = res
+                continue
             try:
-                ord_id = safe_str(((j or {}).get("data") or [{}])[0].get("ordId") or "")
-            except Exception:
-                ord_id = ""
-
-            # Fill + fee
-            fill_price = 0.0
-            fill_qty = 0.0
-            real_usdt = 0.0
-            fee_usdt = 0.0
-            fee_coin = 0.0
-            fee_coin_ccy = ""
-
-            if ord_id:
-                try:
-                    fills_url = base_url.rstrip("/") + "/api/v5/trade/fills"
-                    params = {"ordId": ord_id, "instId": inst_id, "limit": "1"}
-                    qs = "&".join([f"{k}={v}" for k, v in params.items()])
-                    path2 = "/api/v5/trade/fills"
-                    ts2 = datetime.now(timezone.utc).isoformat(timespec="milliseconds").replace("+00:00", "Z")
-                    prehash2 = ts2 + "GET" + path2 + "?" + qs
-                    sign2 = base64.b64encode(hmac.new(api_secret.encode(), prehash2.encode(), hashlib.sha256).digest()).decode()
-                    headers2 = dict(headers)
-                    headers2["OK-ACCESS-SIGN"] = sign2
-                    headers2["OK-ACCESS-TIMESTAMP"] = ts2
-
-                    rr = requests.get(fills_url + "?" + qs, headers=headers2, timeout=15)
-                    fj = rr.json() if rr is not None else {}
-                    if safe_str((fj or {}).get("code")) == "0":
-                        d = (fj or {}).get("data") or []
-                        if d:
-                            last = d[0]
-                            fill_price = _to_float(last.get("fillPx"), 0.0)
-                            fill_qty = _to_float(last.get("fillSz"), 0.0)
-                            real_usdt = _to_float(last.get("fillNotional"), 0.0)
-
-                            _fee = abs(_to_float(last.get("fee"), 0.0))
-                            _fee_ccy = safe_str(last.get("feeCcy") or "").upper()
-                            if _fee > 0 and _fee_ccy:
-                                if _fee_ccy in ("USDT", "USD"):
-                                    fee_usdt = _fee
-                                else:
-                                    fee_coin = _fee
-                                    fee_coin_ccy = _fee_ccy
-                except Exception:
-                    pass
+                out[i] = _order_finish(adapter, ex, action, items[i][0], items[i][1], res, base[i], None, None)
+            except Exception as e:
+                out[i] = {"ok": False, "reason": f"Emir hatası: {e}", "ord_id": safe_str(res.get("ord_id"))}
+    return [r or {"ok": False, "reason": "Emir gönderilmedi"} for r in out]
 
-            if fill_price <= 0:
-                fill_price = _to_float(get_public_price(ex, symbol), 0.0)
-            if fill_price <= 0:
-                fill_price = 100.0
-
-            if action == "BUY":
-                if fill_qty <= 0:
-                    fill_qty = usdt_amount / fill_price if fill_price > 0 else 0.0
-                if real_usdt <= 0:
-                    real_usdt = usdt_amount
-            else:
-                if fill_qty <= 0:
-                    fill_qty = usdt_amount
-                if real_usdt <= 0:
-                    real_usdt = fill_qty * fill_price
-
-            # If fee is coin, keep it; Telegram will convert using fill_price/px
+def record_trade(username: str, exchange_id: str, action: str, symbol: str,
+                 real_usdt: float, pnl_usdt: float, dry_run: bool) -> None:
+    db_write_many(_trade_stmts(username, exchange_id.upper(), action.upper(), symbol.upper(),
+                               real_usdt, pnl_usdt, dry_run))
 
-            # --- Balance-delta fee fix (OKX) ---
-            try:
-                bal_after_usdt = okx_get_asset_balance("USDT", api_key, api_secret, api_passphrase)
-                bal_after_base = okx_get_asset_balance(base_ccy, api_key, api_secret, api_passphrase) if base_ccy else 0.0
-
-                if action == "BUY":
-                    # Notional spent (excludes fee)
-                    notional = _to_float(real_usdt, 0.0)
-                    usdt_delta = max(0.0, _to_float(bal_before_usdt, 0.0) - _to_float(bal_after_usdt, 0.0))
-                    fee_usdt_delta = max(0.0, usdt_delta - notional)
-
-                    base_delta = max(0.0, _to_float(bal_after_base, 0.0) - _to_float(bal_before_base, 0.0))
-                    fee_coin_delta = max(0.0, _to_float(fill_qty, 0.0) - base_delta)
-
-                    # If API returns 0 fee, use delta-derived values
-                    if fee_usdt_delta > 0 and _to_float(fee_usdt, 0.0) <= 0:
-                        fee_usdt = fee_usdt_delta
-                    if fee_coin_delta > 0 and _to_float(fee_coin, 0.0) <= 0 and base_ccy:
-                        fee_coin = fee_coin_delta
-                        fee_coin_ccy = base_ccy
-
-                else:  # SELL
-                    gross = _to_float(real_usdt, 0.0)  # fill_qty * fill_price
-                    net_usdt_gain = max(0.0, _to_float(bal_after_usdt, 0.0) - _to_float(bal_before_usdt, 0.0))
-                    fee_usdt_delta = max(0.0, gross - net_usdt_gain)
-
-                    base_spent = max(0.0, _to_float(bal_before_base, 0.0) - _to_float(bal_after_base, 0.0))
-                    fee_coin_delta = max(0.0, base_spent - _to_float(fill_qty, 0.0))
-
-                    if fee_usdt_delta > 0 and _to_float(fee_usdt, 0.0) <= 0:
-                        fee_usdt = fee_usdt_delta
-                    if fee_coin_delta > 0 and _to_float(fee_coin, 0.0) <= 0 and base_ccy:
-                        fee_coin = fee_coin_delta
-                        fee_coin_ccy = base_ccy
-            except Exception:
-                pass
-            return {
-                "ok": True,
-                "fill_price": fill_price,
-                "fill_qty": fill_qty,
-                "real_usdt": real_usdt,
-                "fee_usdt": fee_usdt,
-                "fee_coin": fee_coin,
-                "fee_coin_ccy": fee_coin_ccy,
-                "ord_id": ord_id,
-                "raw": j,
-            }
+def insert_trade(conn: sqlite3.Connection, username: str, exchange_id: str, action: str, symbol: str,
+                 real_usdt: float, pnl_usdt: float, dry_run: bool) -> None:
+    """trades INSERT + pnl_rollups güncellemesi, çağıranın transaction'ı içinde."""
+    for sql, params in _trade_stmts(username, exchange_id, action, symbol, real_usdt, pnl_usdt, dry_run):
+        conn.execute(sql, params)
 
-        # -------------------------
-        # BINANCE
-        # -------------------------
-        elif ex == "BINANCE":
-            import urllib.parse
-            base = "https://api.binance.com"
-            sym = _sym_norm_for_price("BINANCE", symbol).replace("/", "")
-            ts = int(time.time() * 1000)
-            recv = 5000
+def add_user_pnl(username: str, pnl: float) -> None:
+    db_write("UPDATE users SET total_pnl = total_pnl + ? WHERE username=?",
+             (float(pnl), username))
 
-            if action == "BUY":
-                params = {
-                    "symbol": sym,
-                    "side": "BUY",
-                    "type": "MARKET",
-                    "quoteOrderQty": f"{usdt_amount:.8f}".rstrip("0").rstrip("."),
-                    "recvWindow": str(recv),
-                    "timestamp": str(ts),
-                }
-            else:
-                params = {
-                    "symbol": sym,
-                    "side": "SELL",
-                    "type": "MARKET",
-                    "quantity": f"{usdt_amount:.8f}".rstrip("0").rstrip("."),
-                    "recvWindow": str(recv),
-                    "timestamp": str(ts),
-                }
+# =========================
+# Fill commit (tek transaction)
+# =========================
+def commit_fill(username: str, exchange_id: str, action: str, symbol: str, dry_run: bool, *,
+                position: Optional[Dict[str, Any]] = None,
+                close_position_ids: Optional[List[int]] = None,
+                close_all: bool = False,
+                trade_usdt: Optional[float] = None,
+                pnl_usdt: float = 0.0,
+                count_usage: bool = False,
+                signal_id: Optional[int] = None,
+                signal_status: str = "APPROVED",
+                log: str = "",
+                log_level: str = "INFO") -> Dict[str, Any]:
+    """
+    Borsada gerçekleşen bir BUY/SELL'in tüm DB yan etkilerini tek connection + tek transaction'da yazar:
+      position   -> open_positions INSERT (qty, entry_price, entry_usdt, buy_fee_*, buy_ord_id)
+      close_*    -> open_positions DELETE (id listesi veya username+exchange+symbol+dry_run)
+      trade_usdt -> trades + pnl_rollups
+      pnl_usdt   -> users.total_pnl (sadece GERÇEK işlemler)
+      count_usage, signal_id, log
+    Ya hepsi yazılır ya hiçbiri (crash arada yarım state bırakmaz).
+    """
+    out: Dict[str, Any] = {"position_id": 0, "closed": 0, "used_count": None}
+    with db_session() as conn:
+        if position is not None:
+            p = position
+            out["position_id"] = _position_insert(
+                conn, username, exchange_id, symbol,
+                _to_float(p.get("qty"), 0.0), _to_float(p.get("entry_price"), 0.0), _to_float(p.get("entry_usdt"), 0.0),
+                dry_run,
+                _to_float(p.get("buy_fee_usdt"), 0.0), _to_float(p.get("buy_fee_coin"), 0.0),
+                safe_str(p.get("buy_fee_coin_ccy") or ""), safe_str(p.get("buy_ord_id") or ""),
+            )
+        if close_position_ids:
+            for pid in close_position_ids:
+                cur = conn.execute("DELETE FROM open_positions WHERE id=? AND username=?", (int(pid), username))
+                out["closed"] += int(cur.rowcount or 0)
+        if close_all:
+            cur = conn.execute(
+                "DELETE FROM open_positions WHERE username=? AND exchange_id=? AND symbol=? AND dry_run=?",
+                (username, exchange_id, symbol, 1 if dry_run else 0),
+            )
+            out["closed"] += int(cur.rowcount or 0)
+        if trade_usdt is not None:
+            insert_trade(conn, username, safe_str(exchange_id).upper(), safe_str(action).upper(), safe_str(symbol).upper(),
+                         float(trade_usdt or 0.0), float(pnl_usdt or 0.0), dry_run)
+        if pnl_usdt and not dry_run:
+            conn.execute("UPDATE users SET total_pnl = total_pnl + ? WHERE username=?", (float(pnl_usdt), username))
+        if count_usage:
+            out["used_count"] = usage_inc_conn(conn, username)
+        if signal_id is not None:
+            conn.execute("UPDATE pending_signals SET status=? WHERE id=? AND username=?",
+                         (safe_str(signal_status), int(signal_id), username))
+        if log:
+            conn.execute("INSERT INTO logs (username, level, message, created_at) VALUES (?,?,?,?)",
+                         (username, log_level, log, now_ts()))
+
+    if out["used_count"] is not None:
+        _usage_mirror_set(username, int(out["used_count"]), only_up=True)
+    if not dry_run:
+        balance_cache_invalidate(username)
+    return out
 
-            qs = urllib.parse.urlencode(params)
-            sig = hmac.new(api_secret.encode(), qs.encode(), hashlib.sha256).hexdigest()
-            url = f"{base}/api/v3/order?{qs}&signature={sig}"
-            headers = {"X-MBX-APIKEY": api_key}
-            r = requests.post(url, headers=headers, timeout=15)
-            j = r.json() if r is not None else {}
-
-            if "code" in j and int(j.get("code") or 0) != 0:
-                return {"ok": False, "reason": safe_str(j.get("msg") or "Binance emir hatası"), "raw": j}
-
-            ord_id = safe_str(j.get("orderId") or "")
-
-            executed_qty = _to_float(j.get("executedQty"), 0.0)
-            cquote = _to_float(j.get("cummulativeQuoteQty"), 0.0)
-            fill_price = (cquote / executed_qty) if executed_qty > 0 and cquote > 0 else _to_float(get_public_price(ex, symbol), 0.0)
-
-            # Fee from fills (commission + commissionAsset)
-            fee_usdt = 0.0
-            fee_coin = 0.0
-            fee_coin_ccy = ""
-            fills = j.get("fills") or []
-            fee_total_usdt = 0.0
-            fee_coin_amt = 0.0
-            fee_coin_asset = ""
-            for f in fills:
-                com = abs(_to_float(f.get("commission"), 0.0))
-                asset = safe_str(f.get("commissionAsset") or "").upper()
-                if com <= 0 or not asset:
-                    continue
-                # try convert to USDT
-                usd = _fee_to_usdt(asset, com, fill_price)
-                if usd > 0:
-                    fee_total_usdt += usd
-                else:
-                    # keep last non-usdt fee as coin
-                    fee_coin_amt += com
-                    fee_coin_asset = asset
+# =========================
+# Order engine (async, durable)
+# =========================
+# Webhook / panel / TP manager emirleri request thread'inde çalışmaz: order_jobs tablosuna yazılır,
+# sınırlı worker havuzu öncelik sırasıyla (PANIC < SELL < BUY) alır. ORDER_WORKERS_SELL_LANE kadar worker
+# sadece SELL/PANIC alır; BUY seli satışları bekletmez. Aynı (kullanıcı, borsa, sembol) job'ları ise sırayla
+# çalışır: önceki job QUEUED/RUNNING iken sonraki alınmaz (BUY commit olmadan SELL koşmaz). Canlı emirler
+# borsa ve API key başına token bucket'tan geçer (place_order). Çağıran job id alır: GET /api/order-jobs/<id>.
+ORDER_WORKERS = int(os.getenv("ORDER_WORKERS", "4").strip() or "4")
+ORDER_WORKERS_SELL_LANE = int(os.getenv("ORDER_WORKERS_SELL_LANE", "1").strip() or "1")
+ORDER_JOB_MAX_AGE_SEC = float(os.getenv("ORDER_JOB_MAX_AGE_SEC", "300").strip() or "300")  # bu kadar bekleyen job çalışmaz
+ORDER_JOB_STALE_SEC = float(os.getenv("ORDER_JOB_STALE_SEC", "180").strip() or "180")  # heartbeat'i bu kadar eski RUNNING (crash) -> FAILED
+ORDER_JOB_KEEP_DAYS = int(os.getenv("ORDER_JOB_KEEP_DAYS", "7").strip() or "7")
+ORDER_RATE_PER_EXCHANGE = os.getenv("ORDER_RATE_PER_EXCHANGE", "OKX:20,BINANCE:8,BYBIT:10,GATEIO:8").strip()
+ORDER_RATE_PER_KEY = float(os.getenv("ORDER_RATE_PER_KEY", "4").strip() or "4")  # emir/sn (burst aynı)
+ORDER_RATE_MAX_WAIT_SEC = float(os.getenv("ORDER_RATE_MAX_WAIT_SEC", "10").strip() or "10")
+
+ORDER_PRIO_PANIC = 0  # toplu kapatma akışları için ayrılmış
+ORDER_PRIO_SELL = 10
+ORDER_PRIO_BUY = 20
+
+ORDER_JOB_HANDLERS: Dict[str, Callable[[Dict[str, Any]], Dict[str, Any]]] = {}
+_ORDER_COND = threading.Condition()
+_ORDER_OWNER = f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(4)}"  # bu process'in claim'leri
+_ORDER_RUNNING: set = set()  # bu process'te şu an çalışan job id'leri (_ORDER_COND altında)
+_ORDER_ENGINE: Dict[str, Any] = {
+    "started": False,
+    "done": 0,
+    "failed": 0,
+    "expired": 0,
+    "interrupted": 0,
+    "rate_waits": 0,
+    "rate_wait_ms": 0.0,
+    "rate_rejects": 0,
+}
 
-            if fee_total_usdt > 0:
-                fee_usdt = fee_total_usdt
-            elif fee_coin_amt > 0:
-                fee_coin = fee_coin_amt
-                fee_coin_ccy = fee_coin_asset
 
-            real_usdt = cquote if cquote > 0 else (executed_qty * fill_price if fill_price > 0 else 0.0)
-            return {
-                "ok": True,
-                "fill_price": fill_price,
-                "fill_qty": executed_qty if executed_qty > 0 else (usdt_amount / fill_price if action == "BUY" and fill_price > 0 else usdt_amount),
-                "real_usdt": real_usdt if real_usdt > 0 else usdt_amount,
-                "fee_usdt": fee_usdt,
-                "fee_coin": fee_coin,
-                "fee_coin_ccy": fee_coin_ccy,
-                "ord_id": ord_id,
-                "raw": j,
-            }
+def order_job_handler(kind: str):
+    """Job türü için handler kaydı: fn(job) -> {"ok": bool, ...}. Handler emir + DB + Telegram + log işini yapar."""
+    def deco(fn):
+        ORDER_JOB_HANDLERS[kind] = fn
+        return fn
+    return deco
 
-        # -------------------------
-        # BYBIT (v5 spot)
-        # -------------------------
-        elif ex == "BYBIT":
-            base = "https://api.bybit.com"
-            recv = "5000"
-            ts = str(int(time.time() * 1000))
-            sym = _sym_norm_for_price("BYBIT", symbol).replace("/", "")
 
-            path = "/v5/order/create"
-            url = f"{base}{path}"
+class _TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "ts", "lock")
 
-            if action == "BUY":
-                body_obj = {
-                    "category": "spot",
-                    "symbol": sym,
-                    "side": "Buy",
-                    "orderType": "Market",
-                    "qty": str(usdt_amount),
-                    "marketUnit": "quoteCoin",
-                }
-            else:
-                body_obj = {
-                    "category": "spot",
-                    "symbol": sym,
-                    "side": "Sell",
-                    "orderType": "Market",
-                    "qty": str(usdt_amount),
-                    "marketUnit": "baseCoin",
-                }
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = max(0.01, float(rate))
+        self.burst = max(1.0, float(burst if burst is not None else rate))
+        self.tokens = self.burst
+        self.ts = time.monotonic()
+        self.lock = threading.Lock()
 
-            body = json.dumps(body_obj, separators=(",", ":"), ensure_ascii=False)
-            prehash = ts + api_key + recv + body
-            sign = hmac.new(api_secret.encode(), prehash.encode(), hashlib.sha256).hexdigest()
-            headers = {
-                "Content-Type": "application/json",
-                "X-BAPI-API-KEY": api_key,
-                "X-BAPI-TIMESTAMP": ts,
-                "X-BAPI-RECV-WINDOW": recv,
-                "X-BAPI-SIGN": sign,
-            }
-            r = requests.post(url, headers=headers, data=body.encode("utf-8"), timeout=15)
-            j = r.json() if r is not None else {}
+    def reserve(self) -> float:
+        """Bir token ayırır (borç olabilir); token'a kadar beklenecek süreyi döndürür."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.ts) * self.rate)
+            self.ts = now
+            self.tokens -= 1.0
+            return 0.0 if self.tokens >= 0 else (-self.tokens / self.rate)
 
-            if int(_to_float(j.get("retCode"), 0.0)) != 0:
-                return {"ok": False, "reason": safe_str(j.get("retMsg") or "Bybit emir hatası"), "raw": j}
+    def cancel(self) -> None:
+        with self.lock:
+            self.tokens = min(self.burst, self.tokens + 1.0)
 
-            ord_id = safe_str(((j.get("result") or {}).get("orderId")) or "")
-            # Fetch executions to get avg/fees
-            fill_price = 0.0
-            fill_qty = 0.0
-            real_usdt = 0.0
-            fee_usdt = 0.0
-            fee_coin = 0.0
-            fee_coin_ccy = ""
 
+def _parse_rate_map(raw: str) -> Dict[str, float]:
+    out: Dict[str, float] = {}
+    for part in safe_str(raw).split(","):
+        k, _, v = part.partition(":")
+        if k.strip() and v.strip():
             try:
-                time.sleep(0.25)
-                path2 = "/v5/execution/list"
-                qs = f"category=spot&orderId={ord_id}&symbol={sym}&limit=50"
-                ts2 = str(int(time.time() * 1000))
-                prehash2 = ts2 + api_key + recv + qs
-                sign2 = hmac.new(api_secret.encode(), prehash2.encode(), hashlib.sha256).hexdigest()
-                url2 = f"{base}{path2}?{qs}"
-                headers2 = {
-                    "X-BAPI-API-KEY": api_key,
-                    "X-BAPI-TIMESTAMP": ts2,
-                    "X-BAPI-RECV-WINDOW": recv,
-                    "X-BAPI-SIGN": sign2,
-                }
-                rr = requests.get(url2, headers=headers2, timeout=15)
-                ej = rr.json() if rr is not None else {}
-                if int(_to_float(ej.get("retCode"), 0.0)) == 0:
-                    lst = (((ej.get("result") or {}).get("list")) or [])
-                    notional = 0.0
-                    qty_sum = 0.0
-                    fee_sum_usdt = 0.0
-                    fee_coin_sum = 0.0
-                    fee_coin_asset = ""
-                    for e in lst:
-                        px = _to_float(e.get("execPrice"), 0.0)
-                        q = _to_float(e.get("execQty"), 0.0)
-                        v = _to_float(e.get("execValue"), 0.0)
-                        notional += v
-                        qty_sum += q
-                        f = abs(_to_float(e.get("execFee"), 0.0))
-                        fc = safe_str(e.get("feeCurrency") or "").upper()
-                        if f > 0 and fc:
-                            usd = _fee_to_usdt(fc, f, px)
-                            if usd > 0:
-                                fee_sum_usdt += usd
-                            else:
-                                fee_coin_sum += f
-                                fee_coin_asset = fc
-                    fill_qty = qty_sum
-                    real_usdt = notional if notional > 0 else 0.0
-                    fill_price = (notional / qty_sum) if qty_sum > 0 and notional > 0 else 0.0
-                    if fee_sum_usdt > 0:
-                        fee_usdt = fee_sum_usdt
-                    elif fee_coin_sum > 0:
-                        fee_coin = fee_coin_sum
-                        fee_coin_ccy = fee_coin_asset
+                out[_ex_price_norm(k)] = float(v)
             except Exception:
                 pass
+    return out
 
-            if fill_price <= 0:
-                fill_price = _to_float(get_public_price(ex, symbol), 0.0)
-            if fill_price <= 0:
-                fill_price = 100.0
+_ORDER_RATE_EX = _parse_rate_map(ORDER_RATE_PER_EXCHANGE)
+_RATE_BUCKETS: Dict[Tuple[str, str], _TokenBucket] = {}
+_RATE_LOCK = threading.Lock()
+
+def _rate_bucket(scope: str, ident: str, rate: float) -> _TokenBucket:
+    with _RATE_LOCK:
+        b = _RATE_BUCKETS.get((scope, ident))
+        if b is None:
+            b = _RATE_BUCKETS[(scope, ident)] = _TokenBucket(rate)
+        return b
+
+def order_rate_acquire(exchange_id: str, api_key: str = "") -> bool:
+    """Canlı emir öncesi borsa + API key bucket'ları; ORDER_RATE_MAX_WAIT_SEC'ten uzun beklenecekse False."""
+    ex = _ex_price_norm(exchange_id)
+    buckets = [_rate_bucket("ex", ex, _ORDER_RATE_EX.get(ex, 5.0))]
+    if api_key:
+        kid = ex + ":" + hashlib.sha256(safe_str(api_key).encode("utf-8")).hexdigest()[:16]
+        buckets.append(_rate_bucket("key", kid, ORDER_RATE_PER_KEY))
+    wait = max(b.reserve() for b in buckets)
+    if wait > ORDER_RATE_MAX_WAIT_SEC:
+        for b in buckets:
+            b.cancel()
+        _ORDER_ENGINE["rate_rejects"] += 1
+        return False
+    if wait > 0:
+        _ORDER_ENGINE["rate_waits"] += 1
+        _ORDER_ENGINE["rate_wait_ms"] += wait * 1000.0
+        time.sleep(wait)
+    return True
 
-            if action == "BUY":
-                if fill_qty <= 0:
-                    fill_qty = usdt_amount / fill_price if fill_price > 0 else 0.0
-                if real_usdt <= 0:
-                    real_usdt = usdt_amount
-            else:
-                if fill_qty <= 0:
-                    fill_qty = usdt_amount
-                if real_usdt <= 0:
-                    real_usdt = fill_qty * fill_price
 
-            return {
-                "ok": True,
-                "fill_price": fill_price,
-                "fill_qty": fill_qty,
-                "real_usdt": real_usdt,
-                "fee_usdt": fee_usdt,
-                "fee_coin": fee_coin,
-                "fee_coin_ccy": fee_coin_ccy,
-                "ord_id": ord_id,
-                "raw": j,
-            }
+def order_stack_key(username: str, exchange_id: str, symbol: str) -> str:
+    return f"{safe_str(username)}:{_ex_price_norm(exchange_id)}:{canon_symbol(symbol)}"
 
-        # -------------------------
-        # GATE.IO (v4 spot)
-        # -------------------------
-        elif ex in ("GATE", "GATEIO", "GATE.IO"):
-            base = "https://api.gateio.ws"
-            path = "/api/v4/spot/orders"
-            url = f"{base}{path}"
-
-            # Gate spot market: amount is quote for buy, base for sell
-            pair = _sym_norm_for_price("GATE", symbol).replace("/", "_")
-            body_obj = {
-                "currency_pair": pair,
-                "side": "buy" if action == "BUY" else "sell",
-                "type": "market",
-                "amount": f"{usdt_amount:.8f}".rstrip("0").rstrip("."),
-            }
-            body = json.dumps(body_obj, separators=(",", ":"), ensure_ascii=False)
 
-            ts = str(int(time.time()))
-            body_hash = hashlib.sha512(body.encode()).hexdigest()
-            prehash = "POST" + "\n" + path + "\n" + "" + "\n" + body_hash + "\n" + ts
-            sign = hmac.new(api_secret.encode(), prehash.encode(), hashlib.sha512).hexdigest()
-            headers = {"KEY": api_key, "Timestamp": ts, "SIGN": sign, "Content-Type": "application/json"}
+def order_job_submit(kind: str, username: str, exchange_id: str = "", symbol: str = "",
+                     payload: Optional[Dict[str, Any]] = None, *, priority: int = ORDER_PRIO_BUY,
+                     dedupe_key: str = "", run_after: float = 0.0, symbols: Optional[List[str]] = None,
+                     claim_kinds: Tuple[str, ...] = ()) -> int:
+    """
+    Job'u kuyruğa yazar ve id döndürür. Aynı dedupe_key ile aktif (QUEUED/RUNNING) job varsa onun id'si döner.
+    symbols: job'un dokunduğu semboller (varsayılan [symbol]); bu stack'lerdeki önceki job'lar bitmeden alınmaz.
+    claim_kinds: stack bazlı dedupe. Bu türlerden aktif bir job aynı stack'teyse tek sembolde onun id'si döner;
+    çok sembolde o semboller düşülür (payload["symbols"] dahil), hiç sembol kalmazsa 0 döner.
+    """
+    if kind not in ORDER_JOB_HANDLERS:
+        raise ValueError(f"unknown order job kind: {kind}")
+    multi = symbols is not None
+    sym_keys = {safe_str(s): order_stack_key(username, exchange_id, s) for s in (symbols if multi else [symbol]) if safe_str(s)}
+    payload = dict(payload or {})
+    with db_session() as conn:
+        conn.execute("BEGIN IMMEDIATE")  # claim kontrolü + insert atomik
+        if claim_kinds and sym_keys:
+            rows = conn.execute(
+                f"SELECT k.key, MAX(j.id) FROM order_job_keys k JOIN order_jobs j ON j.id=k.job_id "
+                f"WHERE k.key IN ({','.join('?' * len(sym_keys))}) AND j.status IN ('QUEUED','RUNNING') "
+                f"AND j.kind IN ({','.join('?' * len(claim_kinds))}) GROUP BY k.key",
+                (*sym_keys.values(), *claim_kinds),
+            ).fetchall()
+            claimed = {r[0]: int(r[1]) for r in rows}
+            if claimed and not multi:
+                return next(iter(claimed.values()))
+            if claimed:
+                sym_keys = {s: k for s, k in sym_keys.items() if k not in claimed}
+                if not sym_keys:
+                    return 0
+                if "symbols" in payload:
+                    payload["symbols"] = [x for x in payload["symbols"] if safe_str(x) in sym_keys]
+        keys = sorted(set(sym_keys.values()))
+        cur = conn.execute(
+            "INSERT OR IGNORE INTO order_jobs (kind, username, exchange_id, symbol, priority, status, dedupe_key, "
+            "payload_json, run_after, created_at) VALUES (?,?,?,?,?,'QUEUED',?,?,?,?)",
+            (kind, safe_str(username), safe_str(exchange_id).upper(), safe_str(symbol), int(priority),
+             safe_str(dedupe_key), json.dumps(payload or {}, ensure_ascii=False), float(run_after or 0.0), now_ts()),
+        )
+        if cur.rowcount:
+            jid = int(cur.lastrowid)
+            conn.executemany("INSERT OR IGNORE INTO order_job_keys (job_id, key) VALUES (?,?)", [(jid, k) for k in keys])
+        else:
+            row = conn.execute(
+                "SELECT id FROM order_jobs WHERE dedupe_key=? AND status IN ('QUEUED','RUNNING') ORDER BY id DESC LIMIT 1",
+                (safe_str(dedupe_key),),
+            ).fetchone()
+            jid = int(row[0]) if row else 0
+    order_engine_start()
+    with _ORDER_COND:
+        _ORDER_COND.notify_all()
+    return jid
 
-            r = requests.post(url, headers=headers, data=body.encode("utf-8"), timeout=15)
-            j = r.json() if r is not None else {}
 
-            if isinstance(j, dict) and j.get("message") and j.get("label"):
-                return {"ok": False, "reason": safe_str(j.get("message")), "raw": j}
+def order_job_get(jid: int) -> Dict[str, Any]:
+    conn = db()
+    try:
+        r = conn.execute("SELECT * FROM order_jobs WHERE id=?", (int(jid),)).fetchone()
+    finally:
+        conn.close()
+    if not r:
+        return {}
+    out = dict(r)
+    for k in ("payload_json", "result_json"):
+        try:
+            out[k[:-5]] = json.loads(out.pop(k) or "{}")
+        except Exception:
+            out[k[:-5]] = {}
+    return out
 
-            ord_id = safe_str(j.get("id") or "")
 
-            fill_qty = _to_float(j.get("amount"), 0.0)
-            # Gate returns filled_total for total quote (USDT)
-            real_usdt = _to_float(j.get("filled_total"), 0.0)
-            fill_price = (real_usdt / fill_qty) if fill_qty > 0 and real_usdt > 0 else _to_float(get_public_price(ex, symbol), 0.0)
-
-            fee_amt = abs(_to_float(j.get("fee"), 0.0))
-            fee_ccy = safe_str(j.get("fee_currency") or "").upper()
-            fee_usdt = 0.0
-            fee_coin = 0.0
-            fee_coin_ccy = ""
-
-            if fee_amt > 0 and fee_ccy:
-                usd = _fee_to_usdt(fee_ccy, fee_amt, fill_price)
-                if usd > 0:
-                    fee_usdt = usd
-                else:
-                    fee_coin = fee_amt
-                    fee_coin_ccy = fee_ccy
+def _order_job_claim(max_priority: int) -> Optional[Dict[str, Any]]:
+    now = now_ts()
+    with db_session() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        exp_args = (now - ORDER_JOB_MAX_AGE_SEC, time.time() - ORDER_JOB_MAX_AGE_SEC)
+        expired = conn.execute(
+            "SELECT id, username, kind, exchange_id, symbol FROM order_jobs "
+            "WHERE status='QUEUED' AND created_at < ? AND run_after < ?", exp_args,
+        ).fetchall()
+        if expired:
+            conn.execute(
+                f"UPDATE order_jobs SET status='FAILED', error='expired', finished_at=? "
+                f"WHERE id IN ({','.join('?' * len(expired))})", (now, *[int(x["id"]) for x in expired]),
+            )
+            _ORDER_ENGINE["expired"] += len(expired)
+        # aynı stack'te daha önce eklenmiş aktif job varsa bu job beklemeli
+        r = conn.execute("""
+            SELECT * FROM order_jobs j
+            WHERE j.status='QUEUED' AND j.priority<=? AND j.run_after<=?
+              AND NOT EXISTS (
+                SELECT 1 FROM order_job_keys k
+                JOIN order_job_keys e ON e.key=k.key AND e.job_id<k.job_id
+                JOIN order_jobs p ON p.id=e.job_id
+                WHERE k.job_id=j.id AND p.status IN ('QUEUED','RUNNING'))
+            ORDER BY j.priority, j.id LIMIT 1
+        """, (int(max_priority), time.time())).fetchone()
+        if r:
+            conn.execute("UPDATE order_jobs SET status='RUNNING', started_at=?, heartbeat_at=?, owner=?, attempts=attempts+1 "
+                         "WHERE id=?", (now, now, _ORDER_OWNER, int(r["id"])))
+    if expired:
+        _order_jobs_notify_failed(expired, "zaman aşımı, çalıştırılmadı")
+    return dict(r) if r else None
 
-            # If Gate didn't include fee in create response, fetch order detail
-            if fee_amt <= 0 and ord_id:
-                try:
-                    time.sleep(0.2)
-                    path2 = f"/api/v4/spot/orders/{ord_id}"
-                    url2 = f"{base}{path2}"
-                    ts2 = str(int(time.time()))
-                    prehash2 = "GET" + "\n" + path2 + "\n" + "" + "\n" + hashlib.sha512("".encode()).hexdigest() + "\n" + ts2
-                    sign2 = hmac.new(api_secret.encode(), prehash2.encode(), hashlib.sha512).hexdigest()
-                    headers2 = {"KEY": api_key, "Timestamp": ts2, "SIGN": sign2}
-                    rr = requests.get(url2, headers=headers2, timeout=15)
-                    oj = rr.json() if rr is not None else {}
-                    fee_amt2 = abs(_to_float(oj.get("fee"), 0.0))
-                    fee_ccy2 = safe_str(oj.get("fee_currency") or "").upper()
-                    if fee_amt2 > 0 and fee_ccy2:
-                        usd = _fee_to_usdt(fee_ccy2, fee_amt2, fill_price)
-                        if usd > 0:
-                            fee_usdt = usd
-                            fee_coin = 0.0
-                            fee_coin_ccy = ""
-                        else:
-                            fee_coin = fee_amt2
-                            fee_coin_ccy = fee_ccy2
-                except Exception:
-                    pass
 
-            return {
-                "ok": True,
-                "fill_price": fill_price,
-                "fill_qty": fill_qty if fill_qty > 0 else (usdt_amount / fill_price if action == "BUY" and fill_price > 0 else usdt_amount),
-                "real_usdt": real_usdt if real_usdt > 0 else usdt_amount,
-                "fee_usdt": fee_usdt,
-                "fee_coin": fee_coin,
-                "fee_coin_ccy": fee_coin_ccy,
-                "ord_id": ord_id,
-                "raw": j,
-            }
+def _order_job_finish(jid: int, res: Dict[str, Any]) -> None:
+    ok = bool((res or {}).get("ok"))
+    err = "" if ok else safe_str((res or {}).get("error") or (res or {}).get("reason") or "başarısız")
+    result = {k: v for k, v in (res or {}).items() if k != "raw"}
+    try:
+        result_json = json.dumps(result, ensure_ascii=False, default=str)
+    except Exception:
+        result_json = "{}"
+    with db_session() as conn:
+        conn.execute("UPDATE order_jobs SET status=?, result_json=?, error=?, finished_at=? WHERE id=?",
+                     ("DONE" if ok else "FAILED", result_json, err, now_ts(), int(jid)))
+    _ORDER_ENGINE["done" if ok else "failed"] += 1
 
-        return {"ok": False, "reason": f"Desteklenmeyen borsa: {ex}"}
 
+def _order_job_run(job: Dict[str, Any]) -> None:
+    fn = ORDER_JOB_HANDLERS.get(safe_str(job.get("kind")))
+    try:
+        job["payload"] = json.loads(job.get("payload_json") or "{}") or {}
+        res = fn(job) if fn else {"ok": False, "error": "bilinmeyen job türü"}
     except Exception as e:
-        return {"ok": False, "reason": f"Emir hatası: {e}"}
+        res = {"ok": False, "error": safe_str(e)}
+        try:
+            log_line(safe_str(job.get("username")), "WARN", f"{E_X} Emir işi #{job.get('id')} ({job.get('kind')}) hata: {e}")
+        except Exception:
+            pass
+    try:
+        _order_job_finish(int(job["id"]), res if isinstance(res, dict) else {"ok": bool(res)})
+    except Exception:
+        pass
 
-def record_trade(username: str, exchange_id: str, action: str, symbol: str,
-                 real_usdt: float, pnl_usdt: float, dry_run: bool) -> None:
+
+def _order_worker_loop(max_priority: int) -> None:
+    while True:
+        try:
+            job = _order_job_claim(max_priority)
+        except Exception:
+            job = None
+        if job is None:
+            with _ORDER_COND:
+                _ORDER_COND.wait(timeout=1.0)
+            continue
+        with _ORDER_COND:
+            _ORDER_RUNNING.add(int(job["id"]))
+        try:
+            _order_job_run(job)
+        finally:
+            with _ORDER_COND:
+                _ORDER_RUNNING.discard(int(job["id"]))
+                _ORDER_COND.notify_all()  # aynı stack'te bekleyen job alınabilir
+
+
+def _order_jobs_notify_failed(rows: List[Any], why: str) -> None:
+    """Handler'a hiç ulaşmadan düşen job'lar (expired / interrupted): log + panel mesajı + Telegram."""
+    for r in rows:
+        username = safe_str(r["username"])
+        msg = f"{E_X} Emir işi #{r['id']} {why} ({r['kind']} {r['exchange_id']} {r['symbol']})"
+        try:
+            log_line(username, "WARN", msg)
+            set_last_msg(username, msg)
+            u = get_user(username)
+            if u:
+                telegram_send_for_user(u, msg)
+        except Exception:
+            pass
+
+
+def _order_jobs_heartbeat() -> None:
+    """Bu process'te çalışan job'ların heartbeat'i: başka process (veya restart sonrası) onları crash sanmasın."""
+    with _ORDER_COND:
+        ids = sorted(_ORDER_RUNNING)
+    if not ids:
+        return
+    with db_session() as conn:
+        conn.execute(f"UPDATE order_jobs SET heartbeat_at=? WHERE owner=? AND status='RUNNING' AND id IN ({','.join('?' * len(ids))})",
+                     (now_ts(), _ORDER_OWNER, *ids))
+
+
+def order_jobs_recover() -> int:
+    """
+    Sahibi ölmüş RUNNING job'lar (heartbeat ORDER_JOB_STALE_SEC'ten eski, bu process'e ait değil) FAILED olur;
+    canlı emir tekrar GÖNDERİLMEZ (çift emir riski).
+    """
+    cutoff = now_ts() - int(ORDER_JOB_STALE_SEC)
+    where = "status='RUNNING' AND owner<>? AND MAX(started_at, heartbeat_at) < ?"
     conn = db()
     try:
-        conn.execute("""
-            INSERT INTO trades (username, exchange_id, action, symbol, real_usdt, pnl_usdt, dry_run, created_at)
-            VALUES (?,?,?,?,?,?,?,?)
-        """, (username, exchange_id.upper(), action.upper(), symbol.upper(),
-              float(real_usdt), float(pnl_usdt), 1 if dry_run else 0, now_ts()))
+        rows = conn.execute(f"SELECT id, username, kind, exchange_id, symbol FROM order_jobs WHERE {where}",
+                            (_ORDER_OWNER, cutoff)).fetchall()
+        if not rows:
+            return 0
+        conn.execute(f"UPDATE order_jobs SET status='FAILED', error='interrupted', finished_at=? WHERE {where}",
+                     (now_ts(), _ORDER_OWNER, cutoff))
         conn.commit()
     finally:
         conn.close()
+    _order_jobs_notify_failed(rows, "yarıda kaldı • borsada kontrol et")
+    _ORDER_ENGINE["interrupted"] += len(rows)
+    return len(rows)
 
-def add_user_pnl(username: str, pnl: float) -> None:
-    conn = db()
+
+def _order_janitor_loop() -> None:
+    while True:
+        try:
+            _order_jobs_heartbeat()
+            order_jobs_recover()
+            db_write_many([
+                ("DELETE FROM order_jobs WHERE status IN ('DONE','FAILED') AND finished_at < ?",
+                 (now_ts() - ORDER_JOB_KEEP_DAYS * 86400,)),
+                # stack key'leri sadece aktif job'lar için gerekli
+                ("DELETE FROM order_job_keys WHERE job_id NOT IN (SELECT id FROM order_jobs WHERE status IN ('QUEUED','RUNNING'))", ()),
+            ])
+        except Exception:
+            pass
+        time.sleep(30.0)
+
+
+def order_engine_start() -> None:
+    with _ORDER_COND:
+        if _ORDER_ENGINE["started"]:
+            return
+        _ORDER_ENGINE["started"] = True
+    lanes = min(max(0, ORDER_WORKERS_SELL_LANE), max(1, ORDER_WORKERS) - 1)
+    for i in range(max(1, ORDER_WORKERS)):
+        max_prio = ORDER_PRIO_SELL if i < lanes else 1 << 30
+        threading.Thread(target=_order_worker_loop, args=(max_prio,), daemon=True, name=f"order-worker-{i}").start()
+    threading.Thread(target=_order_janitor_loop, daemon=True, name="order-janitor").start()
+
+
+def order_engine_stats() -> Dict[str, Any]:
+    out = dict(_ORDER_ENGINE)
+    out["rate_wait_ms"] = round(out["rate_wait_ms"], 1)
+    out["workers"] = max(1, ORDER_WORKERS)
     try:
-        conn.execute("UPDATE users SET total_pnl = total_pnl + ? WHERE username=?",
-                     (float(pnl), username))
-        conn.commit()
-    finally:
-        conn.close()
+        conn = db()
+        try:
+            for r in conn.execute("SELECT status, COUNT(*) FROM order_jobs WHERE status IN ('QUEUED','RUNNING') GROUP BY status"):
+                out[safe_str(r[0]).lower()] = int(r[1])
+        finally:
+            conn.close()
+    except Exception:
+        pass
+    return out
 
 # =========================
 # Stats
 # =========================
-def _window_start_ts(kind: str) -> int:
-    now_local = datetime.utcnow() + timedelta(hours=TZ_OFFSET_HOURS)
+# pnl_rollups: (username, bucket_kind, bucket_start, dry_run) başına count/pnl/vol.
+# trades'e yazan her yer aynı transaction'da günceller; stats_for_user tek satır okur.
+# Not: bucket sınırları TZ_OFFSET_HOURS'a bağlı; offset değişirse init_db rollup'ları yeniden kurar.
+_PNL_BUCKETS = ("day", "week", "month")
+
+_PNL_ROLLUP_UPSERT = """
+    INSERT INTO pnl_rollups (username, bucket_kind, bucket_start, dry_run, trade_count, pnl_usdt, vol_usdt, updated_at)
+    VALUES (?,?,?,?,?,?,?,?)
+    ON CONFLICT(username, bucket_kind, bucket_start, dry_run) DO UPDATE SET
+        trade_count = trade_count + excluded.trade_count,
+        pnl_usdt = pnl_usdt + excluded.pnl_usdt,
+        vol_usdt = vol_usdt + excluded.vol_usdt,
+        updated_at = excluded.updated_at
+"""
+
+def _bucket_start_ts(kind: str, ts: int) -> int:
+    """ts'in içinde bulunduğu gün/hafta(Pzt)/ay başlangıcı (TZ_OFFSET_HOURS yerel saatine göre), epoch sn."""
+    off = timedelta(hours=TZ_OFFSET_HOURS)
+    local = datetime.fromtimestamp(int(ts), timezone.utc) + off
     if kind == "day":
-        start = now_local.replace(hour=0, minute=0, second=0, microsecond=0)
+        start = local.replace(hour=0, minute=0, second=0, microsecond=0)
     elif kind == "week":
-        start = (now_local - timedelta(days=now_local.weekday())).replace(hour=0, minute=0, second=0, microsecond=0)
+        start = (local - timedelta(days=local.weekday())).replace(hour=0, minute=0, second=0, microsecond=0)
     else:
-        start = now_local.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-    start_utc = start - timedelta(hours=TZ_OFFSET_HOURS)
-    return int(start_utc.timestamp())
+        start = local.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    return int((start - off).timestamp())
 
-def stats_for_user(username: str, kind: str) -> Dict[str, Any]:
-    start_ts = _window_start_ts(kind)
-    conn = db()
+def _window_start_ts(kind: str) -> int:
+    return _bucket_start_ts(kind, now_ts())
+
+def _trade_stmts(username: str, exchange_id: str, action: str, symbol: str,
+                 real_usdt: float, pnl_usdt: float, dry_run: bool) -> List[Tuple[str, tuple]]:
+    ts = now_ts()
+    dr = 1 if dry_run else 0
+    pnl = float(pnl_usdt or 0.0)
+    vol = abs(float(real_usdt or 0.0))
+    out: List[Tuple[str, tuple]] = [(
+        "INSERT INTO trades (username, exchange_id, action, symbol, real_usdt, pnl_usdt, dry_run, created_at) "
+        "VALUES (?,?,?,?,?,?,?,?)",
+        (username, exchange_id, action, symbol, float(real_usdt or 0.0), pnl, dr, ts),
+    )]
+    for kind in _PNL_BUCKETS:
+        out.append((_PNL_ROLLUP_UPSERT, (username, kind, _bucket_start_ts(kind, ts), dr, 1, pnl, vol, ts)))
+    return out
+
+def rebuild_pnl_rollups(conn: Optional[sqlite3.Connection] = None) -> int:
+    """pnl_rollups'ı trades tablosundan baştan hesaplar. Yazılan satır sayısını döner."""
+    own = conn is None
+    if own:
+        conn = db()
     try:
+        off = int(TZ_OFFSET_HOURS * 3600)
+        # Önce SQL'de yerel güne indir, hafta/ay bucket'larını gün bucket'larından topla
         rows = conn.execute("""
-            SELECT COUNT(1) AS c,
+            SELECT username, dry_run, (created_at + ?) / 86400 AS d,
+                   COUNT(1) AS c,
                    COALESCE(SUM(pnl_usdt), 0.0) AS pnl,
                    COALESCE(SUM(ABS(real_usdt)), 0.0) AS vol
             FROM trades
-            WHERE username=? AND created_at>=? AND dry_run=0
-        """, (username, start_ts)).fetchone()
-        c = int(rows["c"] or 0)
-        pnl_usdt = float(rows["pnl"] or 0.0)
-        vol_usdt = float(rows["vol"] or 0.0)
+            GROUP BY username, dry_run, d
+        """, (off,)).fetchall()
+        acc: Dict[Tuple[str, str, int, int], List[float]] = {}
+        for r in rows:
+            day_ts = int(r["d"]) * 86400 - off
+            for kind in _PNL_BUCKETS:
+                key = (safe_str(r["username"]), kind, _bucket_start_ts(kind, day_ts), int(r["dry_run"] or 0))
+                a = acc.setdefault(key, [0, 0.0, 0.0])
+                a[0] += int(r["c"] or 0)
+                a[1] += float(r["pnl"] or 0.0)
+                a[2] += float(r["vol"] or 0.0)
+        ts = now_ts()
+        conn.execute("DELETE FROM pnl_rollups")
+        conn.executemany(
+            "INSERT INTO pnl_rollups (username, bucket_kind, bucket_start, dry_run, trade_count, pnl_usdt, vol_usdt, updated_at) "
+            "VALUES (?,?,?,?,?,?,?,?)",
+            [(k[0], k[1], k[2], k[3], int(a[0]), a[1], a[2], ts) for k, a in acc.items()],
+        )
+        if own:
+            conn.commit()
+        return len(acc)
+    finally:
+        if own:
+            conn.close()
+
+def stats_for_user(username: str, kind: str) -> Dict[str, Any]:
+    kind = kind if kind in _PNL_BUCKETS else "month"
+    start_ts = _window_start_ts(kind)
+    conn = db()
+    try:
+        row = conn.execute("""
+            SELECT trade_count, pnl_usdt, vol_usdt
+            FROM pnl_rollups
+            WHERE username=? AND bucket_kind=? AND bucket_start=? AND dry_run=0
+        """, (username, kind, start_ts)).fetchone()
+        c = int(row["trade_count"] or 0) if row else 0
+        pnl_usdt = float(row["pnl_usdt"] or 0.0) if row else 0.0
+        vol_usdt = float(row["vol_usdt"] or 0.0) if row else 0.0
     finally:
         conn.close()
 
@@ -5467,55 +8152,117 @@ CG_MAP = {
     "OP/USDT": "optimism",
 }
 
+# CoinGecko tek bir arka plan poller'ından beslenir; request thread'i asla upstream beklemez.
+# 429 gelirse aralık ikiye katlanır (Retry-After varsa ona uyulur), başarıda baza döner.
+# Son başarılı snapshot diske yazılır ve açılışta okunur: ilk istek boş/bekleyen yanıt görmez.
+CG_POLL_SEC = float(os.getenv("CG_POLL_SEC", "15").strip() or "15")
+CG_POLL_MAX_SEC = float(os.getenv("CG_POLL_MAX_SEC", "300").strip() or "300")
+CG_SNAPSHOT_PATH = os.getenv("CG_SNAPSHOT_PATH", "").strip()
+
 _ticker_cache = {"ts": 0.0, "usdt_try": 0.0, "prices": {}}
+_CG_LOCK = threading.Lock()
+_CG_STATE: Dict[str, Any] = {"started": False, "interval": CG_POLL_SEC, "ok": 0, "errors": 0, "rate_limited": 0, "last_status": 0}
 
-def _http_get_json(url: str, timeout: int = 8) -> dict:
+def _cg_snapshot_path() -> str:
+    if CG_SNAPSHOT_PATH:
+        return os.path.abspath(CG_SNAPSHOT_PATH)
+    return os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), "coingecko_snapshot.json")
+
+def _cg_load_snapshot() -> bool:
     try:
-        req = urllib.request.Request(url, headers={"User-Agent": "AU-AutoTrade/1.0"})
-        with urllib.request.urlopen(req, timeout=timeout) as r:
-            raw = r.read().decode("utf-8", "ignore")
-        return json.loads(raw) if raw else {}
+        with open(_cg_snapshot_path(), "r", encoding="utf-8") as f:
+            snap = json.load(f)
+        prices = {safe_str(k): float(v) for k, v in (snap.get("prices") or {}).items() if _to_float(v, 0.0) > 0}
     except Exception:
-        return {}
-
-def get_coingecko_ticker_cached(min_interval_sec: float = 3.0) -> dict:
-    """
-    CoinGecko'dan fiyatları çeker ama min_interval_sec içinde cache döndürür.
-    Rate-limit yememek için şart.
-    """
-    now = time.time()
-    if (now - float(_ticker_cache.get("ts") or 0.0)) < float(min_interval_sec):
-        return _ticker_cache
+        return False
+    if not prices:
+        return False
+    with _CG_LOCK:
+        if float(_ticker_cache.get("ts") or 0.0) >= float(snap.get("ts") or 0.0):
+            return False
+        _ticker_cache.update(ts=float(snap.get("ts") or 0.0), usdt_try=_to_float(snap.get("usdt_try"), 0.0), prices=prices)
+    return True
 
-    ids = ",".join(sorted(set(CG_MAP.values())))
-    ids_q = urllib.parse.quote(ids)
+def _cg_save_snapshot(snap: Dict[str, Any]) -> None:
+    path = _cg_snapshot_path()
+    tmp = path + ".tmp"
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(snap, f)
+        os.replace(tmp, path)
+    except Exception:
+        pass
 
-    # Coin fiyatları (USD)
-    url_prices = f"https://api.coingecko.com/api/v3/simple/price?ids={ids_q}&vs_currencies=usd"
-    j = _http_get_json(url_prices) or {}
+def _cg_poll_once() -> float:
+    """Bir kez çeker; bir sonraki beklemeyi (sn) döner."""
+    ids = ",".join(sorted(set(CG_MAP.values()) | {"tether"}))
+    # USDT/TRY tether'in TRY fiyatından gelir: tek istekte hem coinler hem kur
+    url = f"https://api.coingecko.com/api/v3/simple/price?ids={urllib.parse.quote(ids)}&vs_currencies=usd,try"
+    try:
+        r = http_get(url, timeout=8, retries=0)
+        status = r.status_code
+    except Exception:
+        r, status = None, 0
+    _CG_STATE["last_status"] = status
 
-    # USDTRY (USDT ~ USD kabul edip TRY kuruna çarparız)
-    url_fx = "https://api.coingecko.com/api/v3/simple/price?ids=usd&vs_currencies=try"
-    fx = _http_get_json(url_fx) or {}
-    usdt_try = 0.0
+    if status == 429:
+        _CG_STATE["rate_limited"] += 1
+        retry_after = _to_float((r.headers or {}).get("Retry-After") if r is not None else 0, 0.0)
+        return min(CG_POLL_MAX_SEC, max(retry_after, float(_CG_STATE["interval"]) * 2))
     try:
-        usdt_try = float(((fx.get("usd") or {}).get("try")) or 0.0)
+        j = r.json() if (r is not None and status == 200) else {}
     except Exception:
-        usdt_try = 0.0
+        j = {}
 
     out = {}
     for sym, cid in CG_MAP.items():
-        try:
-            px = float(((j.get(cid) or {}).get("usd")) or 0.0)
-        except Exception:
-            px = 0.0
+        px = _to_float(((j.get(cid) or {}).get("usd")), 0.0)
         if px > 0:
             out[sym] = px
+    if not out:
+        _CG_STATE["errors"] += 1
+        return min(CG_POLL_MAX_SEC, float(_CG_STATE["interval"]) * 1.5)
+
+    usdt_try = _to_float(((j.get("tether") or {}).get("try")), 0.0)
+    with _CG_LOCK:
+        _ticker_cache["ts"] = time.time()
+        _ticker_cache["usdt_try"] = usdt_try or float(_ticker_cache.get("usdt_try") or 0.0)
+        _ticker_cache["prices"] = out
+        snap = dict(_ticker_cache)
+    _cg_save_snapshot(snap)
+    _CG_STATE["ok"] += 1
+    return CG_POLL_SEC
+
+def _cg_poller_loop() -> None:
+    while True:
+        try:
+            _CG_STATE["interval"] = max(1.0, _cg_poll_once())
+        except Exception:
+            _CG_STATE["errors"] += 1
+        time.sleep(float(_CG_STATE["interval"]))
+
+def coingecko_poller_start() -> None:
+    with _CG_LOCK:
+        if _CG_STATE["started"]:
+            return
+        _CG_STATE["started"] = True
+    _cg_load_snapshot()
+    threading.Thread(target=_cg_poller_loop, daemon=True, name="coingecko").start()
 
-    _ticker_cache["ts"] = now
-    _ticker_cache["usdt_try"] = usdt_try
-    _ticker_cache["prices"] = out
-    return _ticker_cache
+def get_coingecko_ticker_cached(min_interval_sec: float = 3.0) -> dict:
+    """
+    Son CoinGecko snapshot'ının kopyası (bloklamaz). Poller çalışmıyorsa başlatır.
+    min_interval_sec geriye dönük uyumluluk için; aralık CG_POLL_SEC ile yönetilir.
+    """
+    if not _CG_STATE["started"]:
+        coingecko_poller_start()
+    with _CG_LOCK:
+        return {"ts": _ticker_cache["ts"], "usdt_try": _ticker_cache["usdt_try"], "prices": dict(_ticker_cache["prices"])}
+
+def coingecko_stats() -> Dict[str, Any]:
+    out = dict(_CG_STATE)
+    out["age_sec"] = round(time.time() - float(_ticker_cache.get("ts") or 0.0), 1) if _ticker_cache.get("ts") else None
+    return out
 
 
 
@@ -5547,49 +8294,94 @@ def symbols_compat(ex: str):
         out.append(s2)
     return jsonify({"ok": True, "symbols": out})
 
-@app.get("/api/ticker")
-def api_ticker():
-    rr = require_login()
-    if rr:
-        return rr
-
-    def _bn_price(sym: str) -> float:
-        try:
-            r = requests.get(
-                "https://api.binance.com/api/v3/ticker/price",
-                params={"symbol": sym},
-                timeout=4,
-            )
-            j = r.json()
-            return float(j.get("price") or 0.0)
-        except Exception:
-            return 0.0
-
-    # USDT → TL
-    usdt_try = _bn_price("USDTTRY")
+# =========================
+# /api/ticker shared snapshot
+# =========================
+# Alt bant ticker'ı tüm sekmeler için tek snapshot'tan servis edilir: arka plan thread'i Binance'ten
+# tek toplu istekle (tüm ticker/price) USDTTRY + seçili coinleri çeker. Yanıt strong ETag + max-age taşır,
+# tarayıcı aradaki poll'larda cache/304 kullanır. Sembol listesi admin panelden (app_settings) değişir.
+TICKER_SYMBOLS_KEY = "TICKER_SYMBOLS"
+TICKER_SYMBOLS_DEFAULT = "BTC,ETH,SOL,BNB,XRP,ADA,DOGE,AVAX,TRX,TON"
+TICKER_REFRESH_SEC = float(os.getenv("TICKER_REFRESH_SEC", "2").strip() or "2")
+TICKER_MAX_AGE_SEC = int(os.getenv("TICKER_MAX_AGE_SEC", "2").strip() or "2")
+TICKER_IDLE_SEC = float(os.getenv("TICKER_IDLE_SEC", "60").strip() or "60")  # bu kadar istek yoksa upstream'e gitme
+
+_TICKER_SNAP: Dict[str, Any] = {"ts": 0.0, "body": b"", "etag": "", "last_req": 0.0, "started": False, "errors": 0}
+_TICKER_LOCK = threading.Lock()
+
+def _ticker_parse_symbols(raw: str) -> List[str]:
+    """"btc, ETH/USDT solusdt" -> ["BTC", "ETH", "SOL"]"""
+    out: List[str] = []
+    for part in safe_str(raw).replace("\n", ",").replace(" ", ",").split(","):
+        base = part.strip().upper().replace("-", "/").replace("_", "/").split("/")[0]
+        if base.endswith("USDT") and len(base) > 4:
+            base = base[:-4]
+        if base and base.isalnum() and base not in out:
+            out.append(base)
+    return out
 
-    # İstediğin coin listesi (eklemek/silmek serbest)
-    bn_syms = [
-        "BTCUSDT", "ETHUSDT", "SOLUSDT", "BNBUSDT", "XRPUSDT",
-        "ADAUSDT", "DOGEUSDT", "AVAXUSDT", "TRXUSDT", "TONUSDT",
-    ]
+def ticker_symbols() -> List[str]:
+    return _ticker_parse_symbols(get_app_setting(TICKER_SYMBOLS_KEY, TICKER_SYMBOLS_DEFAULT) or TICKER_SYMBOLS_DEFAULT)
 
-    prices = {}
-    for s in bn_syms:
-        px = _bn_price(s)
+def _ticker_refresh() -> bool:
+    """Tek upstream isteği; başarılıysa body/etag'i günceller."""
+    try:
+        r = http_get("https://api.binance.com/api/v3/ticker/price", timeout=6)
+        book = {safe_str(t.get("symbol")): _to_float(t.get("price"), 0.0) for t in (r.json() or [])}
+    except Exception:
+        _TICKER_SNAP["errors"] += 1
+        return False
+    if not book:
+        _TICKER_SNAP["errors"] += 1
+        return False
+    prices: Dict[str, float] = {}
+    for base in ticker_symbols():
+        px = book.get(base + "USDT") or 0.0
         if px > 0:
-            base = s.replace("USDT", "")
             prices[f"{base}/USDT"] = px
+    body = json.dumps({"ok": True, "usdt_try": book.get("USDTTRY") or 0.0, "prices": prices},
+                      separators=(",", ":")).encode("utf-8")
+    with _TICKER_LOCK:
+        if body != _TICKER_SNAP["body"]:
+            _TICKER_SNAP["body"] = body
+            _TICKER_SNAP["etag"] = '"' + hashlib.sha1(body).hexdigest()[:20] + '"'
+        _TICKER_SNAP["ts"] = time.time()
+    return True
 
-    return jsonify({
-        "ok": True,
-        "usdt_try": usdt_try,
-        "prices": prices
-    })
+def _ticker_loop() -> None:
+    while True:
+        if (time.monotonic() - _TICKER_SNAP["last_req"]) <= TICKER_IDLE_SEC:
+            _ticker_refresh()
+        time.sleep(max(0.5, TICKER_REFRESH_SEC))
 
+def _ticker_ensure_started() -> None:
+    if _TICKER_SNAP["started"]:
+        return
+    with _TICKER_LOCK:
+        if _TICKER_SNAP["started"]:
+            return
+        _TICKER_SNAP["started"] = True
+    threading.Thread(target=_ticker_loop, daemon=True, name="ticker").start()
 
+@app.get("/api/ticker")
+def api_ticker():
+    rr = require_login()
+    if rr:
+        return rr
 
+    _TICKER_SNAP["last_req"] = time.monotonic()
+    _ticker_ensure_started()
+    if not _TICKER_SNAP["body"]:
+        _ticker_refresh()  # soğuk başlangıç: ilk istek bir kez bekler
+    with _TICKER_LOCK:
+        body, etag = _TICKER_SNAP["body"], _TICKER_SNAP["etag"]
+    if not body:
+        return jsonify({"ok": False, "usdt_try": 0.0, "prices": {}})
 
+    headers = {"ETag": etag, "Cache-Control": f"private, max-age={max(0, TICKER_MAX_AGE_SEC)}"}
+    if etag and etag in safe_str(request.headers.get("If-None-Match")):
+        return Response(status=304, headers=headers)
+    return Response(body, mimetype="application/json", headers=headers)
 
 
 # =========================
@@ -6254,7 +9046,7 @@ def test_reset():
         return rr
     # Test verilerini sıfırla: varsa paper test tablolarını temizle, yoksa sessiz geç
     try:
-        with sqlite3.connect(DB_PATH) as con:
+        with db_session() as con:
             cur = con.cursor()
             for t in ["paper_test_trades", "paper_test_positions", "paper_test_state"]:
                 try:
@@ -6266,7 +9058,6 @@ def test_reset():
                 cur.execute("INSERT INTO paper_test_state(id, usdt, pnl, fee, last_px) VALUES(1, ?, 0.0, 0.0, 0.0) ON CONFLICT(id) DO UPDATE SET usdt=excluded.usdt, pnl=0.0, fee=0.0, last_px=0.0", (100000.0,))
             except Exception:
                 pass
-            con.commit()
     except Exception:
         pass
     return redirect("/test")
@@ -6299,14 +9090,23 @@ def _render_user_dashboard(test_view: bool = False):
             "BYBIT": 0.0,
             "GATE": 0.0,
         }
+        bal_info = {}
     else:
-        bals = get_user_exchange_usdt_balances(u)
+        bal_info = get_user_balances_cached(u)
+        bals = {ex: float(v["value"] or 0.0) for ex, v in bal_info.items()}
     balances_txt = format_balances_line(bals)
 
     # Balance bubbles (hangi borsaya API girdiyse sadece onda 'API ✔' görünsün)
     def _bb(slug: str, name: str, val: float, has_api: bool) -> str:
         cls = "bb" if has_api else "bb off"
         st = "API ✔" if has_api else "API YOK"
+        # bakiye yaşı: cache'ten geliyorsa kaç sn önce, hiç gelmediyse "yükleniyor"
+        info = (bal_info.get(slug.upper()) if has_api else None) or {}
+        if info.get("value") is None and info.get("has_api"):
+            st += " • yükleniyor" if info.get("pending") else " • alınamadı"
+        elif (info.get("age_sec") or 0) >= 5:
+            age = int(info["age_sec"])
+            st += f" • {age}sn önce" if age < 120 else f" • {age // 60}dk önce"
         return (
             f'<div class="{cls}">'
             f'  <div class="t">{name}</div>'
@@ -6370,20 +9170,9 @@ def _render_user_dashboard(test_view: bool = False):
             conn = db_connect()
             try:
                 cur = conn.cursor()
-                # Determine which timestamp and pnl column exists (schema may vary)
-                cur.execute("PRAGMA table_info(paper_test_trades)")
-                cols = {r[1] for r in cur.fetchall()}
-                ts_col = "ts_close" if "ts_close" in cols else ("closed_at" if "closed_at" in cols else ("closed_ts" if "closed_ts" in cols else ("close_ts" if "close_ts" in cols else None)))
-                if not ts_col:
-                    return {"count": 0, "pnl": 0.0, "ratio": 0.0}
-
-                pnl_col = None
-                for cand in ["pnl_net_usdt", "pnl_net", "pnl_usdt", "pnl"]:
-                    if cand in cols:
-                        pnl_col = cand
-                        break
-                if not pnl_col:
-                    pnl_col = "pnl_net_usdt"  # will be added by migrations, but keep fallback
+                # Şema migration ile sabit (ensure_paper_test_schema): ts_close + pnl_net_usdt
+                ts_col = "ts_close"
+                pnl_col = "pnl_net_usdt"
 
                 since = int(time.time()) - int(sec)
 
@@ -6929,24 +9718,17 @@ def manual_enqueue():
         return redirect("/")
 
     # =========================
-    # MANUEL SELL: direkt kapat
+    # MANUEL SELL: order engine (SELL önceliği)
     # =========================
     if action == "SELL":
         try:
-            res = _auto_sell_execute_now(username, u, exchange_id, symbol)
+            jid = _auto_sell_submit(username, exchange_id, symbol, "MANUEL")
+            set_last_msg(username, f"{E_OK} SELL kuyruğa alındı {symbol} • iş #{jid}")
         except Exception as e:
-            res = {"ok": False, "error": safe_str(e)}
-        if not (res or {}).get("ok"):
-            err = safe_str((res or {}).get("error") or "SELL başarısız")
             try:
-                set_last_msg(username, f"{E_X} SELL başarısız: {err}")
+                set_last_msg(username, f"{E_X} SELL başarısız: {e}")
             except Exception:
                 pass
-            return redirect("/")
-        try:
-            set_last_msg(username, f"{E_OK} SELL gönderildi {symbol}")
-        except Exception:
-            pass
         return redirect("/")
 
     # =========================
@@ -6956,7 +9738,7 @@ def manual_enqueue():
         # DRY RUN BUY: public price ile pozisyon aç
         entry_price = 0.0
         try:
-            entry_price = float(get_public_price(exchange_id, symbol) or 0.0)
+            entry_price = reference_price(exchange_id, symbol)
         except Exception:
             entry_price = 0.0
         if entry_price <= 0:
@@ -6964,19 +9746,10 @@ def manual_enqueue():
 
         qty = (usdt / entry_price) if entry_price > 0 else 0.0
         try:
-            position_add(username, exchange_id, symbol, qty, entry_price, usdt, True, 0.0, 0.0, "", "")
-        except Exception:
-            try:
-                conn = db()
-                conn.execute(
-                    "INSERT INTO open_positions(username, exchange_id, symbol, qty, entry_price, entry_usdt, dry_run, created_at) "
-                    "VALUES (?,?,?,?,?,?,?,?)",
-                    (username, exchange_id, symbol, float(qty), float(entry_price), float(usdt), 1, now_ts()),
-                )
-                conn.commit()
-                conn.close()
-            except Exception:
-                pass
+            commit_fill(username, exchange_id, "BUY", symbol, True,
+                        position={"qty": qty, "entry_price": entry_price, "entry_usdt": usdt})
+        except Exception as e:
+            log_line(username, "WARN", f"{E_X} BUY (TEST) kaydı yazılamadı: {e}")
 
         try:
             telegram_send_for_user(u, build_telegram_text("BUY", u, symbol, usdt, True, {"mode": "MANUEL"}))
@@ -6988,7 +9761,30 @@ def manual_enqueue():
             pass
         return redirect("/")
 
-    # LIVE BUY
+    # LIVE BUY: order engine kuyruğuna; request thread borsayı beklemez
+    try:
+        jid = order_job_submit("manual_buy", username, exchange_id, symbol, {"usdt": usdt}, priority=ORDER_PRIO_BUY)
+        set_last_msg(username, f"{E_OK} BUY kuyruğa alındı (GERÇEK) {symbol} • iş #{jid}")
+    except Exception as e:
+        set_last_msg(username, f"{E_X} BUY başarısız: {e}")
+    return redirect("/")
+
+
+@order_job_handler("manual_buy")
+def _job_manual_buy(job: Dict[str, Any]) -> Dict[str, Any]:
+    username = safe_str(job.get("username"))
+    exchange_id = safe_str(job.get("exchange_id")).upper()
+    symbol = safe_str(job.get("symbol"))
+    usdt = _to_float((job.get("payload") or {}).get("usdt"), float(DEFAULT_USDT))
+    u = get_user(username)
+    if u and not isinstance(u, dict):
+        u = dict(u)
+    if not u:
+        return {"ok": False, "error": "Kullanıcı yok"}
+    if not may_trade(u):
+        set_last_msg(username, f"{E_STOP} Trade kapalı veya limit dolu")
+        return {"ok": False, "error": "Trade kapalı veya limit dolu"}
+
     keys = _keys_for_exchange(u, exchange_id)
     res = place_order(
         exchange_id, "BUY", symbol, usdt, False,
@@ -7003,7 +9799,7 @@ def manual_enqueue():
             pass
         log_line(username, "WARN", f"{E_X} BUY başarısız: {reason}")
         telegram_send_for_user(u, f"{E_X} BUY başarısız: {reason}")
-        return redirect("/")
+        return {"ok": False, "error": reason}
 
     fill_price = _to_float((res or {}).get("fill_price"), 0.0)
     fill_qty = _to_float((res or {}).get("fill_qty"), 0.0)
@@ -7011,45 +9807,22 @@ def manual_enqueue():
     if real_usdt <= 0:
         real_usdt = usdt
 
-    buy_fee_usdt = _to_float((res or {}).get("fee_usdt"), 0.0)
-    buy_fee_coin = _to_float((res or {}).get("fee_coin"), 0.0)
-    buy_fee_coin_ccy = safe_str((res or {}).get("fee_coin_ccy") or "")
-    buy_ord_id = safe_str((res or {}).get("ord_id") or "")
-
-    try:
-        position_add(username, exchange_id, symbol, fill_qty, fill_price, real_usdt, False,
-                     buy_fee_usdt, buy_fee_coin, buy_fee_coin_ccy, buy_ord_id)
-    except Exception:
-        try:
-            conn = db()
-            conn.execute(
-                "INSERT INTO open_positions(username, exchange_id, symbol, qty, entry_price, entry_usdt, dry_run, created_at) "
-                "VALUES (?,?,?,?,?,?,?,?)",
-                (username, exchange_id, symbol, float(fill_qty), float(fill_price), float(real_usdt), 0, now_ts()),
-            )
-            conn.commit()
-            conn.close()
-        except Exception:
-            pass
+    buy_fee_usdt = _to_float((res or {}).get("fee_usdt"), 0.0)
+    buy_fee_coin = _to_float((res or {}).get("fee_coin"), 0.0)
+    buy_fee_coin_ccy = safe_str((res or {}).get("fee_coin_ccy") or "")
+    buy_ord_id = safe_str((res or {}).get("ord_id") or "")
 
     try:
-        conn = db()
-        conn.execute(
-            "INSERT INTO trades(username, exchange_id, action, symbol, real_usdt, pnl_usdt, dry_run, created_at) "
-            "VALUES (?,?,?,?,?,?,?,?)",
-            (username, exchange_id, "BUY", symbol, float(real_usdt), 0.0, 0, now_ts()),
+        commit_fill(
+            username, exchange_id, "BUY", symbol, False,
+            position={"qty": fill_qty, "entry_price": fill_price, "entry_usdt": real_usdt,
+                      "buy_fee_usdt": buy_fee_usdt, "buy_fee_coin": buy_fee_coin,
+                      "buy_fee_coin_ccy": buy_fee_coin_ccy, "buy_ord_id": buy_ord_id},
+            trade_usdt=real_usdt, count_usage=True,
+            log=f"MANUEL BUY LIVE {exchange_id} {symbol} usdt={real_usdt:.2f}",
         )
-        conn.commit()
-        conn.close()
-    except Exception:
-        pass
-
-    try:
-        inc_usage(username)
-    except Exception:
-        pass
-
-    log_line(username, "INFO", f"MANUEL BUY LIVE {exchange_id} {symbol} usdt={real_usdt:.2f}")
+    except Exception as e:
+        log_line(username, "WARN", f"{E_X} MANUEL BUY LIVE kaydı yazılamadı ({exchange_id} {symbol} usdt={real_usdt:.2f} ord={buy_ord_id}): {e}")
     try:
         telegram_send_for_user(u, build_telegram_text("BUY", u, symbol, real_usdt, False, {"mode": "MANUEL"}))
     except Exception:
@@ -7058,7 +9831,7 @@ def manual_enqueue():
         set_last_msg(username, f"{E_OK} BUY gönderildi (GERÇEK) {symbol}")
     except Exception:
         pass
-    return redirect("/")
+    return {"ok": True, "fill_price": fill_price, "fill_qty": fill_qty, "real_usdt": real_usdt, "ord_id": buy_ord_id}
 
 
 
@@ -7134,13 +9907,48 @@ def enqueue_sell(pid: int):
     if not u:
         return redirect("/login")
 
-    # temsilci pozisyonu bul
     p = get_position(pid, username=username)
     if p and not isinstance(p, dict):
         p = dict(p)
     if not p:
         return redirect("/")
 
+    if bool(int(p.get("dry_run") or 0)):
+        # TEST: borsa yok, direkt kapat
+        _stack_sell_execute(username, u, pid)
+        return redirect("/")
+
+    ex = safe_str(p.get("exchange_id") or DEFAULT_EXCHANGE).upper()
+    symbol = normalize_symbol(safe_str(p.get("symbol") or DEFAULT_SYMBOL))
+    try:
+        jid = order_job_submit("stack_sell", username, ex, symbol, {"pid": int(pid)}, priority=ORDER_PRIO_SELL,
+                               dedupe_key=f"sell:{username}:{ex}:{symbol}", claim_kinds=_ORDER_SELL_KINDS)
+        set_last_msg(username, f"{E_OK} SELL kuyruğa alındı • {symbol} • iş #{jid}")
+    except Exception as e:
+        set_last_msg(username, f"{E_X} SELL başarısız • {symbol} • {e}")
+    return redirect("/")
+
+
+@order_job_handler("stack_sell")
+def _job_stack_sell(job: Dict[str, Any]) -> Dict[str, Any]:
+    username = safe_str(job.get("username"))
+    u = get_user(username)
+    if u and not isinstance(u, dict):
+        u = dict(u)
+    if not u:
+        return {"ok": False, "error": "Kullanıcı yok"}
+    return _stack_sell_execute(username, u, int((job.get("payload") or {}).get("pid") or 0))
+
+
+def _stack_sell_execute(username: str, u: dict, pid: int) -> Dict[str, Any]:
+    """Temsilci pozisyonun stack'ini (aynı exchange+symbol+dry_run) tek SELL ile kapatır."""
+    # temsilci pozisyonu bul
+    p = get_position(pid, username=username)
+    if p and not isinstance(p, dict):
+        p = dict(p)
+    if not p:
+        return {"ok": False, "error": "Pozisyon yok"}
+
     ex = safe_str(p.get("exchange_id") or DEFAULT_EXCHANGE).upper()
     symbol = normalize_symbol(safe_str(p.get("symbol") or DEFAULT_SYMBOL))
 
@@ -7166,7 +9974,7 @@ def enqueue_sell(pid: int):
         stack.append(row)
 
     if not stack:
-        return redirect("/")
+        return {"ok": False, "error": "Pozisyon yok"}
 
     total_entry_usdt = sum(_to_float(r.get("entry_usdt"), 0.0) + _to_float(r.get("buy_fee_usdt"), 0.0) for r in stack)
     total_qty_db = sum(_to_float(r.get("qty"), 0.0) for r in stack)
@@ -7183,7 +9991,7 @@ def enqueue_sell(pid: int):
 
     if not dry_run and ex == "OKX":
         try:
-            bal_qty = okx_get_asset_balance(base_ccy, api_key, api_secret, api_pass)
+            bal_qty = tracked_asset_balance(ex, api_key, api_secret, api_pass, base_ccy)
             if bal_qty > 0:
                 qty_to_sell = bal_qty
         except Exception:
@@ -7191,7 +9999,7 @@ def enqueue_sell(pid: int):
 
     if qty_to_sell <= 0:
         set_last_msg(username, f"{E_X} SELL iptal • {symbol} • qty sıfır")
-        return redirect("/")
+        return {"ok": False, "error": "qty sıfır"}
 
     # emri gönder
     res = place_order(ex, "SELL", symbol, qty_to_sell, dry_run, api_key, api_secret, api_pass)
@@ -7202,7 +10010,7 @@ def enqueue_sell(pid: int):
         # hata bildir
         telegram_send_for_user(u, build_telegram_text("SELL", u, symbol, 0.0, dry_run, {"reason": err}))
         set_last_msg(username, f"{E_X} SELL başarısız • {symbol} • {err}")
-        return redirect("/")
+        return {"ok": False, "error": err or "SELL başarısız"}
 
     
     fill_price = _to_float((res or {}).get("fill_price"), 0.0)
@@ -7217,16 +10025,16 @@ def enqueue_sell(pid: int):
     proceeds_net = real_usdt - sell_fee_total_usdt
     pnl_usdt = proceeds_net - float(total_entry_usdt) - buy_fee_total_usdt
 
-    # tüm stack satıldı say → DB temizle
-    for r in stack:
-        try:
-            delete_position(int(r.get("id") or 0), username=username)
-        except Exception:
-            pass
-
-    record_trade(username, ex, "SELL", symbol, total_entry_usdt, pnl_usdt, dry_run)
-    if not dry_run:
-        inc_usage(username)
+    # tüm stack satıldı say → DB temizle (pozisyon + trade + kullanım tek transaction)
+    try:
+        commit_fill(
+            username, ex, "SELL", symbol, dry_run,
+            close_position_ids=[int(r.get("id") or 0) for r in stack],
+            trade_usdt=total_entry_usdt, pnl_usdt=pnl_usdt, count_usage=(not dry_run),
+            log=f"SELL {ex} {symbol} pnl={pnl_usdt:.6f}",
+        )
+    except Exception as e:
+        log_line(username, "WARN", f"{E_X} SELL kaydı yazılamadı ({ex} {symbol}): {e}")
 
     telegram_send_for_user(
         u,
@@ -7249,7 +10057,7 @@ def enqueue_sell(pid: int):
     )
 
     set_last_msg(username, f"{E_OK} SELL başarılı • {symbol} • NET PnL {pnl_usdt:.6f} USDT")
-    return redirect("/")
+    return {"ok": True, "pnl_usdt": pnl_usdt, "fee_usdt_total": fee_total_usdt, "proceeds": real_usdt}
 
 @app.post("/auto/create")
 def auto_create_form():
@@ -7479,7 +10287,7 @@ def approve_signal(sid: int):
     if dry_run:
         entry_price = 0.0
         try:
-            entry_price = float(get_public_price(exchange_id, symbol) or 0.0)
+            entry_price = reference_price(exchange_id, symbol)
         except Exception:
             entry_price = 0.0
 
@@ -7489,28 +10297,14 @@ def approve_signal(sid: int):
 
         qty = (requested_usdt / entry_price) if entry_price > 0 else 0.0
         try:
-            position_add(username, exchange_id, symbol, qty, entry_price, requested_usdt, True)
-        except Exception:
-            # eğer position_add yoksa, DB insert fallback
-            conn = db()
-            try:
-                conn.execute(
-                    "INSERT INTO open_positions(username, exchange_id, symbol, qty, entry_price, entry_usdt, dry_run, created_at) "
-                    "VALUES (?,?,?,?,?,?,?,?)",
-                    (username, exchange_id, symbol, float(qty), float(entry_price), float(requested_usdt), 1, now_ts()),
-                )
-                conn.commit()
-            finally:
-                conn.close()
-
-        conn = db()
-        try:
-            conn.execute("UPDATE pending_signals SET status='APPROVED' WHERE id=? AND username=?", (int(sid), username))
-            conn.commit()
-        finally:
-            conn.close()
-
-        log_line(username, "INFO", f"BUY approved DRY_RUN {exchange_id} {symbol} usdt={requested_usdt:.2f}")
+            commit_fill(
+                username, exchange_id, "BUY", symbol, True,
+                position={"qty": qty, "entry_price": entry_price, "entry_usdt": requested_usdt},
+                signal_id=int(sid),
+                log=f"BUY approved DRY_RUN {exchange_id} {symbol} usdt={requested_usdt:.2f}",
+            )
+        except Exception as e:
+            log_line(username, "WARN", f"{E_X} BUY approved DRY_RUN kaydı yazılamadı ({exchange_id} {symbol}): {e}")
         telegram_send_for_user(u, build_telegram_text("BUY", u, symbol, requested_usdt, True, {"mode": "MANUEL"}))
         try:
             set_last_msg(username, f"{E_OK} BUY onaylandı (TEST) {symbol}")
@@ -7527,6 +10321,45 @@ def approve_signal(sid: int):
         telegram_send_for_user(u, f"{E_STOP} Trade kapalı veya limit dolu")
         return redirect("/")
 
+    # LIVE BUY: order engine kuyruğuna (aynı sinyal ikinci kez kuyruğa girmez)
+    try:
+        jid = order_job_submit("signal_buy", username, exchange_id, symbol,
+                               {"sid": int(sid), "requested_usdt": requested_usdt},
+                               priority=ORDER_PRIO_BUY, dedupe_key=f"signal:{int(sid)}")
+        set_last_msg(username, f"{E_OK} BUY kuyruğa alındı (GERÇEK) {symbol} • iş #{jid}")
+    except Exception as e:
+        set_last_msg(username, f"{E_X} BUY başarısız: {e}")
+    return redirect("/")
+
+
+@order_job_handler("signal_buy")
+def _job_signal_buy(job: Dict[str, Any]) -> Dict[str, Any]:
+    username = safe_str(job.get("username"))
+    exchange_id = safe_str(job.get("exchange_id")).upper()
+    symbol = safe_str(job.get("symbol"))
+    payload = job.get("payload") or {}
+    sid = int(payload.get("sid") or 0)
+    requested_usdt = _to_float(payload.get("requested_usdt"), 0.0)
+
+    # kuyrukta beklerken sinyal başka yoldan işlenmiş olabilir
+    conn = db()
+    try:
+        row = conn.execute("SELECT id FROM pending_signals WHERE id=? AND username=? AND status='PENDING'",
+                           (sid, username)).fetchone()
+    finally:
+        conn.close()
+    if not row:
+        return {"ok": False, "error": "Sinyal artık beklemede değil"}
+
+    u = get_user(username)
+    if u and not isinstance(u, dict):
+        u = dict(u)
+    if not u:
+        return {"ok": False, "error": "Kullanıcı yok"}
+    if not may_trade(u):
+        set_last_msg(username, f"{E_STOP} Trade kapalı veya limit dolu")
+        return {"ok": False, "error": "Trade kapalı veya limit dolu"}
+
     keys = _keys_for_exchange(u, exchange_id)
     res = place_order(exchange_id, "BUY", symbol, requested_usdt, False,
                       safe_str(keys.get("api_key")), safe_str(keys.get("api_secret")), safe_str(keys.get("api_passphrase")))
@@ -7539,7 +10372,7 @@ def approve_signal(sid: int):
             pass
         log_line(username, "WARN", f"{E_X} BUY başarısız: {reason}")
         telegram_send_for_user(u, f"{E_X} BUY başarısız: {reason}")
-        return redirect("/")
+        return {"ok": False, "error": reason}
 
     fill_price = _to_float((res or {}).get("fill_price"), 0.0)
     fill_qty = _to_float((res or {}).get("fill_qty"), 0.0)
@@ -7552,54 +10385,24 @@ def approve_signal(sid: int):
     buy_fee_coin_ccy = safe_str((res or {}).get("fee_coin_ccy") or "")
     buy_ord_id = safe_str((res or {}).get("ord_id") or "")
 
-    # yeni pozisyon EKLE (overwrite yok)
-    try:
-        position_add(username, exchange_id, symbol, fill_qty, fill_price, real_usdt, False, buy_fee_usdt, buy_fee_coin, buy_fee_coin_ccy, buy_ord_id)
-    except Exception:
-        conn = db()
-        try:
-            conn.execute(
-                "INSERT INTO open_positions(username, exchange_id, symbol, qty, entry_price, entry_usdt, dry_run, created_at) "
-                "VALUES (?,?,?,?,?,?,?,?)",
-                (username, exchange_id, symbol, float(fill_qty), float(fill_price), float(real_usdt), 0, now_ts()),
-            )
-            conn.commit()
-        finally:
-            conn.close()
-
-    # pending'i approved yap
-    conn = db()
-    try:
-        conn.execute("UPDATE pending_signals SET status='APPROVED' WHERE id=? AND username=?", (int(sid), username))
-        conn.commit()
-    finally:
-        conn.close()
-
-    # kullanım + trade log (LIVE'da artar)
+    # yeni pozisyon EKLE (overwrite yok) + pending APPROVED + kullanım + trade (tek transaction)
     try:
-        inc_usage(username)
-    except Exception:
-        pass
-
-    try:
-        conn = db()
-        conn.execute(
-            "INSERT INTO trades(username, exchange_id, action, symbol, real_usdt, pnl_usdt, dry_run, created_at) "
-            "VALUES (?,?,?,?,?,?,?,?)",
-            (username, exchange_id, "BUY", symbol, float(real_usdt), 0.0, 0, now_ts()),
+        commit_fill(
+            username, exchange_id, "BUY", symbol, False,
+            position={"qty": fill_qty, "entry_price": fill_price, "entry_usdt": real_usdt,
+                      "buy_fee_usdt": buy_fee_usdt, "buy_fee_coin": buy_fee_coin,
+                      "buy_fee_coin_ccy": buy_fee_coin_ccy, "buy_ord_id": buy_ord_id},
+            trade_usdt=real_usdt, count_usage=True, signal_id=int(sid),
+            log=f"BUY approved LIVE {exchange_id} {symbol} usdt={real_usdt:.2f}",
         )
-        conn.commit()
-        conn.close()
-    except Exception:
-        pass
-
-    log_line(username, "INFO", f"BUY approved LIVE {exchange_id} {symbol} usdt={real_usdt:.2f}")
+    except Exception as e:
+        log_line(username, "WARN", f"{E_X} BUY approved LIVE kaydı yazılamadı ({exchange_id} {symbol} usdt={real_usdt:.2f} ord={buy_ord_id}): {e}")
     telegram_send_for_user(u, build_telegram_text("BUY", u, symbol, real_usdt, False, {"mode": "MANUEL"}))
     try:
         set_last_msg(username, f"{E_OK} BUY onaylandı (GERÇEK) {symbol}")
     except Exception:
         pass
-    return redirect("/")
+    return {"ok": True, "fill_price": fill_price, "fill_qty": fill_qty, "real_usdt": real_usdt, "ord_id": buy_ord_id}
 
 
 @app.route("/webhook", methods=["POST"], strict_slashes=False)
@@ -7683,9 +10486,12 @@ def webhook():
             pass
         return jsonify({"ok": False, "error": "Unauthorized secret mismatch"}), 401
 
-    # Aynı saniyede BUY→SELL gelirse (TV alarm/strategy), OKX senkronu için kısa debounce uygula
+    # Aynı saniyede BUY→SELL gelirse (TV alarm/strategy), OKX senkronu için kısa debounce uygula.
+    # Request thread uyumaz: SELL job'u run_after ile ertelenir. BUY→SELL sırası engine'de garantili
+    # (aynı stack'in job'ları sırayla); debounce sadece borsa tarafının fill'i yansıtması için.
     k = f"{username}|{exchange_id}|{symbol}"
     now_ts = time.time()
+    sell_run_after = 0.0
     if action == "SELL":
         last_buy = _LAST_BUY_TS.get(k)
         if last_buy and (now_ts - last_buy) < SELL_DEBOUNCE_SEC:
@@ -7695,7 +10501,7 @@ def webhook():
                     log_line(username, "INFO", f"SELL debounce bekleme {wait_s:.2f}s {exchange_id} {symbol}")
                 except Exception:
                     pass
-                time.sleep(wait_s)
+                sell_run_after = now_ts + wait_s
     else:
         # BUY geldiğinde timestamp kaydet
         _LAST_BUY_TS[k] = now_ts
@@ -7720,24 +10526,8 @@ def webhook():
     except Exception:
         requested_usdt = 0.0
 
-    # Tüm bakiye modu (usdt=-1): OKX'te anlık USDT serbest bakiye ile al
-    if requested_usdt < 0:
-        if exchange_id == "OKX":
-            keys = _keys_for_exchange(u, exchange_id)
-            bal = 0.0
-            try:
-                bal = float(okx_get_asset_balance("USDT",
-                                                  safe_str(keys.get("api_key")),
-                                                  safe_str(keys.get("api_secret")),
-                                                  safe_str(keys.get("api_passphrase"))))
-            except Exception:
-                bal = 0.0
-            # küçük buffer bırak (komisyon / yuvarlama)
-            requested_usdt = max(0.0, bal - 1.0)
-        else:
-            requested_usdt = float(DEFAULT_USDT)
-
-    if requested_usdt <= 0:
+    # Tüm bakiye modu (usdt=-1): bakiye job içinde okunur (request thread borsayı beklemez)
+    if requested_usdt == 0:
         requested_usdt = float(DEFAULT_USDT)
 
     payload = dict(data)
@@ -7751,70 +10541,9 @@ def webhook():
             log_line(username, "WARN", f"{E_STOP} AUTO BUY engellendi: trade kapalı/limit dolu")
             return jsonify({"ok": False, "error": "Trade kapalı/limit dolu"}), 200
 
-        keys = _keys_for_exchange(u, exchange_id)
-        res = place_order(exchange_id, "BUY", symbol, requested_usdt, False,
-                          safe_str(keys.get("api_key")), safe_str(keys.get("api_secret")), safe_str(keys.get("api_passphrase")))
-
-        if not (res or {}).get("ok"):
-            reason = safe_str((res or {}).get("reason") or "Bilinmeyen hata")
-            log_line(username, "WARN", f"{E_X} AUTO BUY başarısız: {reason}")
-            return jsonify({"ok": False, "error": reason}), 200
-
-        fill_price = _to_float((res or {}).get("fill_price"), 0.0)
-        fill_qty = _to_float((res or {}).get("fill_qty"), 0.0)
-        real_usdt = _to_float((res or {}).get("real_usdt"), requested_usdt)
-
-        buy_fee_usdt = _to_float((res or {}).get("fee_usdt"), 0.0)
-        buy_fee_coin = _to_float((res or {}).get("fee_coin"), 0.0)
-        buy_fee_coin_ccy = safe_str((res or {}).get("fee_coin_ccy") or "")
-        buy_ord_id = safe_str((res or {}).get("ord_id") or "")
-
-        if fill_price <= 0:
-            try:
-                fill_price = float(get_public_price(exchange_id, symbol) or 0.0)
-            except Exception:
-                fill_price = 0.0
-            if fill_price <= 0:
-                fill_price = 100.0
-        if fill_qty <= 0 and fill_price > 0:
-            fill_qty = real_usdt / fill_price
-
-        # her BUY ayrı pozisyon
-        try:
-            position_add(username, exchange_id, symbol, float(fill_qty), float(fill_price), float(real_usdt), False, buy_fee_usdt, buy_fee_coin, buy_fee_coin_ccy, buy_ord_id)
-        except Exception:
-            conn = db()
-            try:
-                conn.execute(
-                    "INSERT INTO open_positions(username, exchange_id, symbol, qty, entry_price, entry_usdt, dry_run, created_at) "
-                    "VALUES (?,?,?,?,?,?,?,?)",
-                    (username, exchange_id, symbol, float(fill_qty), float(fill_price), float(real_usdt), 0, now_ts()),
-                )
-                conn.commit()
-            finally:
-                conn.close()
-
-        # kullanım + trades (AUTO da GERÇEK sayılır)
-        try:
-            inc_usage(username)
-        except Exception:
-            pass
-
-        try:
-            conn = db()
-            conn.execute(
-                "INSERT INTO trades(username, exchange_id, action, symbol, real_usdt, pnl_usdt, dry_run, created_at) "
-                "VALUES (?,?,?,?,?,?,?,?)",
-                (username, exchange_id, "BUY", symbol, float(real_usdt), 0.0, 0, now_ts()),
-            )
-            conn.commit()
-            conn.close()
-        except Exception:
-            pass
-
-        log_line(username, "INFO", f"{E_BOT} AUTO BUY çalıştı: {exchange_id} {symbol} usdt={real_usdt:.2f} ord={safe_str((res or {}).get('ord_id') or '')}")
-        telegram_send_for_user(u, build_telegram_text("BUY", u, symbol, real_usdt, False, {"mode": "AUTO"}))
-        return jsonify({"ok": True, "executed": True})
+        jid = order_job_submit("webhook_buy", username, exchange_id, symbol, {"requested_usdt": requested_usdt},
+                               priority=ORDER_PRIO_BUY)
+        return jsonify({"ok": True, "queued": True, "job_id": jid})
 
     # AUTO SELL: stack pozisyonu kapatır. Trend güçlü ise SELL DEFER'e alır.
     if action == "SELL":
@@ -7831,18 +10560,90 @@ def webhook():
                 pass
             return jsonify({"ok": True, "queued": True, "reason": reason}), 200
 
-        # Trend zayıf/yatay: SELL INSTANT
-        res = _auto_sell_execute_now(username, u, exchange_id, symbol)
-        if not bool((res or {}).get("ok")):
-            err = safe_str((res or {}).get("error") or "SELL başarısız")
+        # Trend zayıf/yatay: SELL INSTANT (SELL önceliğiyle kuyruğa)
+        jid = _auto_sell_submit(username, exchange_id, symbol, "AUTO", run_after=sell_run_after)
+        return jsonify({"ok": True, "queued": True, "job_id": jid}), 200
+
+    return jsonify({"ok": False, "error": "Bad action"}), 400
+
+
+@order_job_handler("webhook_buy")
+def _job_webhook_buy(job: Dict[str, Any]) -> Dict[str, Any]:
+    username = safe_str(job.get("username"))
+    exchange_id = safe_str(job.get("exchange_id")).upper()
+    symbol = safe_str(job.get("symbol"))
+    requested_usdt = _to_float((job.get("payload") or {}).get("requested_usdt"), 0.0)
+    u = get_user(username)
+    if u and not isinstance(u, dict):
+        u = dict(u)
+    if not u:
+        return {"ok": False, "error": "Kullanıcı yok"}
+    if not may_trade(u):
+        log_line(username, "WARN", f"{E_STOP} AUTO BUY engellendi: trade kapalı/limit dolu")
+        return {"ok": False, "error": "Trade kapalı/limit dolu"}
+
+    # Tüm bakiye modu (usdt=-1): OKX'te USDT serbest bakiye ile al (tracker snapshot / REST)
+    if requested_usdt < 0:
+        if exchange_id == "OKX":
+            keys = _keys_for_exchange(u, exchange_id)
+            bal = 0.0
             try:
-                log_line(username, "WARN", f"{E_X} AUTO SELL başarısız: {exchange_id} {symbol} {err}")
+                bal = float(tracked_asset_balance(exchange_id,
+                                                  safe_str(keys.get("api_key")),
+                                                  safe_str(keys.get("api_secret")),
+                                                  safe_str(keys.get("api_passphrase")), "USDT"))
             except Exception:
-                pass
-            return jsonify({"ok": False, "error": err}), 200
-        return jsonify({"ok": True, "executed": True}), 200
+                bal = 0.0
+            # küçük buffer bırak (komisyon / yuvarlama)
+            requested_usdt = max(0.0, bal - 1.0)
+        else:
+            requested_usdt = float(DEFAULT_USDT)
 
-    return jsonify({"ok": False, "error": "Bad action"}), 400
+    if requested_usdt <= 0:
+        requested_usdt = float(DEFAULT_USDT)
+
+    keys = _keys_for_exchange(u, exchange_id)
+    res = place_order(exchange_id, "BUY", symbol, requested_usdt, False,
+                      safe_str(keys.get("api_key")), safe_str(keys.get("api_secret")), safe_str(keys.get("api_passphrase")))
+
+    if not (res or {}).get("ok"):
+        reason = safe_str((res or {}).get("reason") or "Bilinmeyen hata")
+        log_line(username, "WARN", f"{E_X} AUTO BUY başarısız: {reason}")
+        return {"ok": False, "error": reason}
+
+    fill_price = _to_float((res or {}).get("fill_price"), 0.0)
+    fill_qty = _to_float((res or {}).get("fill_qty"), 0.0)
+    real_usdt = _to_float((res or {}).get("real_usdt"), requested_usdt)
+
+    buy_fee_usdt = _to_float((res or {}).get("fee_usdt"), 0.0)
+    buy_fee_coin = _to_float((res or {}).get("fee_coin"), 0.0)
+    buy_fee_coin_ccy = safe_str((res or {}).get("fee_coin_ccy") or "")
+    buy_ord_id = safe_str((res or {}).get("ord_id") or "")
+
+    if fill_price <= 0:
+        try:
+            fill_price = float(get_public_price(exchange_id, symbol) or 0.0)
+        except Exception:
+            fill_price = 0.0
+        if fill_price <= 0:
+            fill_price = reference_price(exchange_id, symbol) or 100.0
+    if fill_qty <= 0 and fill_price > 0:
+        fill_qty = real_usdt / fill_price
+
+    # her BUY ayrı pozisyon + kullanım + trades (AUTO da GERÇEK sayılır), tek transaction
+    try:
+        commit_fill(
+            username, exchange_id, "BUY", symbol, False,
+            position={"qty": fill_qty, "entry_price": fill_price, "entry_usdt": real_usdt,
+                      "buy_fee_usdt": buy_fee_usdt, "buy_fee_coin": buy_fee_coin,
+                      "buy_fee_coin_ccy": buy_fee_coin_ccy, "buy_ord_id": buy_ord_id},
+            trade_usdt=real_usdt, count_usage=True,
+            log=f"{E_BOT} AUTO BUY çalıştı: {exchange_id} {symbol} usdt={real_usdt:.2f} ord={buy_ord_id}",
+        )
+    except Exception as e:
+        log_line(username, "WARN", f"{E_X} AUTO BUY kaydı yazılamadı ({exchange_id} {symbol} usdt={real_usdt:.2f} ord={buy_ord_id}): {e}")
+    telegram_send_for_user(u, build_telegram_text("BUY", u, symbol, real_usdt, False, {"mode": "AUTO"}))
+    return {"ok": True, "fill_price": fill_price, "fill_qty": fill_qty, "real_usdt": real_usdt, "ord_id": buy_ord_id}
 
 
 @app.post("/admin/users/<username>/toggle-trade")
@@ -8482,7 +11283,7 @@ def admin_user_delete(username: str):
 
     conn = db()
     try:
-        for tbl in ("pending_signals", "usage", "logs", "trades", "auto_rules"):
+        for tbl in ("pending_signals", "usage", "logs", "trades", "pnl_rollups", "auto_rules"):
             try:
                 conn.execute(f"DELETE FROM {tbl} WHERE username=?", (username,))
             except Exception:
@@ -8491,6 +11292,7 @@ def admin_user_delete(username: str):
         conn.commit()
     finally:
         conn.close()
+    usage_forget(username)
 
     log_line("admin", "INFO", f"User deleted {username}")
     return redirect("/admin")
@@ -8542,6 +11344,16 @@ def admin_home():
   <div class="muted small" style="margin-top:10px">{safe_str(gate_reason) if gate_reason else ''}</div>
 </div>
 
+<div class="card" style="margin-top:16px">
+  <h2>📈 Ticker Sembolleri</h2>
+  <div class="muted">Alt banttaki coinler (virgülle ayır, örn. BTC,ETH,SOL). Fiyatlar Binance USDT paritesinden.</div>
+  <div class="hr"></div>
+  <form method="post" action="/admin/settings/ticker-symbols" style="display:flex;gap:12px;flex-wrap:wrap;align-items:center;margin:0">
+    <input class="input" name="ticker_symbols" value="{html_escape(",".join(ticker_symbols()))}" style="max-width:520px">
+    <button class="btn" type="submit">{E_SAVE} Kaydet</button>
+  </form>
+</div>
+
 <div class="hr"></div>
 
 
@@ -8596,31 +11408,243 @@ def admin_home():
     except Exception:
         cs = []
 
-    return base_html("Admin Panel", body, nav_html(True))
+    return base_html("Admin Panel", body, nav_html(True))
+
+@app.post("/admin/settings/auto-mode")
+def admin_set_auto_mode():
+    rr = require_admin()
+    if rr:
+        return rr
+
+    mode = safe_str(request.form.get("auto_mode") or "").upper()
+    if mode not in ("NORMAL", "AGGRESSIVE", "HARD"):
+        mode = "NORMAL"
+    set_app_setting("AUTO_MODE", mode)
+
+    # Hemen gate/reason güncelle (beklemesin)
+    try:
+        ev = _auto_regime_evaluate(mode) if AUTO_REGIME_ENABLED else {"ok": True, "gate": 1, "reason": ""}
+        gate = int((ev or {}).get("gate") or 0) if (ev or {}).get("ok") else 0
+        reason = safe_str((ev or {}).get("reason") or "Regime eval fail")
+        _set_auto_gate_for_all(gate, mode, reason)
+    except Exception:
+        pass
+
+    return redirect("/admin")
+
+
+@app.post("/admin/settings/ticker-symbols")
+def admin_set_ticker_symbols():
+    rr = require_admin()
+    if rr:
+        return rr
+
+    syms = _ticker_parse_symbols(request.form.get("ticker_symbols") or "")
+    value = ",".join(syms) or TICKER_SYMBOLS_DEFAULT
+    set_app_setting(TICKER_SYMBOLS_KEY, value)
+    _ticker_refresh()  # yeni liste hemen yayına girsin
+    log_line("admin", "INFO", f"Ticker symbols set: {value}")
+    return redirect("/admin")
+
+
+
+@app.get("/admin/db/index-report")
+def admin_db_index_report():
+    rr = require_admin()
+    if rr:
+        return rr
+    return jsonify(db_index_report())
+
 
-@app.post("/admin/settings/auto-mode")
-def admin_set_auto_mode():
+@app.get("/admin/metrics.json")
+def admin_metrics_json():
     rr = require_admin()
     if rr:
         return rr
+    return jsonify({
+        "price_cache": price_cache_stats(),
+        "db_pool": db_pool_stats(),
+        "db_writer": db_writer_stats(),
+        "backup": db_backup_stats(),
+        "market_ws": market_ws_stats(),
+        "http": http_stats(),
+        "coingecko": coingecko_stats(),
+        "exchange": exchange_adapter_stats(),
+        "balance_tracker": balance_tracker_stats(),
+        "orders": order_engine_stats(),
+        "instruments": instrument_stats(),
+    })
 
-    mode = safe_str(request.form.get("auto_mode") or "").upper()
-    if mode not in ("NORMAL", "AGGRESSIVE", "HARD"):
-        mode = "NORMAL"
-    set_app_setting("AUTO_MODE", mode)
 
-    # Hemen gate/reason güncelle (beklemesin)
+# =========================
+# Log search (FTS5, yoksa LIKE fallback)
+# =========================
+_SNIP_A = "\x02"
+_SNIP_B = "\x03"
+_LOGS_FTS_STATE: Dict[str, Any] = {"checked": False, "ok": False}
+
+
+def logs_fts_enabled() -> bool:
+    if _LOGS_FTS_STATE["checked"]:
+        return bool(_LOGS_FTS_STATE["ok"])
+    ok = False
+    conn = db()
     try:
-        ev = _auto_regime_evaluate(mode) if AUTO_REGIME_ENABLED else {"ok": True, "gate": 1, "reason": ""}
-        gate = int((ev or {}).get("gate") or 0) if (ev or {}).get("ok") else 0
-        reason = safe_str((ev or {}).get("reason") or "Regime eval fail")
-        _set_auto_gate_for_all(gate, mode, reason)
+        ok = conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='logs_fts'").fetchone() is not None
     except Exception:
-        pass
+        ok = False
+    finally:
+        conn.close()
+    _LOGS_FTS_STATE.update({"checked": True, "ok": ok})
+    return ok
 
-    return redirect("/admin")
+
+def _fts_query(term: str) -> str:
+    """Kullanıcı girdisini güvenli FTS5 sorgusuna çevirir: her kelime tırnaklı (AND), sonda * = prefix."""
+    parts = []
+    for w in safe_str(term).replace("ı", "i").replace("İ", "i").split():
+        prefix = w.endswith("*")
+        w = w.rstrip("*").replace('"', '""')
+        if not w:
+            continue
+        parts.append(f'"{w}"' + ("*" if prefix else ""))
+    return " ".join(parts)
+
+
+def _snippet_html(s: str) -> str:
+    return html_escape(s).replace(_SNIP_A, "<mark>").replace(_SNIP_B, "</mark>")
+
+
+def _like_snippet(msg: str, words: List[str]) -> str:
+    if not words:
+        return msg
+    pat = re.compile("|".join(re.escape(w) for w in words), re.IGNORECASE)
+    return pat.sub(lambda m: _SNIP_A + m.group(0) + _SNIP_B, msg)
 
 
+def _parse_day_ts(v: str, end: bool = False) -> int:
+    """'YYYY-MM-DD' (yerel gün) veya epoch sn -> epoch sn. end=True ise günün sonu (ertesi gün 00:00)."""
+    v = safe_str(v).strip()
+    if not v:
+        return 0
+    if v.isdigit():
+        return int(v)
+    try:
+        d = datetime.strptime(v[:10], "%Y-%m-%d").replace(tzinfo=timezone.utc) - timedelta(hours=TZ_OFFSET_HOURS)
+        if end:
+            d += timedelta(days=1)
+        return int(d.timestamp())
+    except Exception:
+        return 0
+
+
+def search_logs(term: str = "", username: str = "", level: str = "", since: int = 0, until: int = 0,
+                before: int = 0, limit: int = 200) -> Dict[str, Any]:
+    """logs araması; sonuçlar id DESC, keyset için before=<id>. snippet HTML (escape'li, <mark> vurgulu)."""
+    limit = max(1, min(1000, int(limit or 200)))
+    term = safe_str(term).strip()
+    use_fts = bool(term) and logs_fts_enabled() and bool(_fts_query(term))
+    # FTS modunda sıralama/keyset logs_fts.rowid üzerinden: FTS5 eşleşmeleri rowid DESC sırayla
+    # akıtır, tüm eşleşmeleri toplayıp sıralamaz.
+    id_col = "logs_fts.rowid" if use_fts else "l.id"
+    where: List[str] = []
+    params: List[Any] = []
+    if before > 0:
+        where.append(f"{id_col} < ?")
+        params.append(int(before))
+    if username:
+        where.append("l.username = ?")
+        params.append(username)
+    if level:
+        where.append("l.level = ?")
+        params.append(level.upper())
+    if since > 0:
+        where.append("l.created_at >= ?")
+        params.append(int(since))
+    if until > 0:
+        where.append("l.created_at < ?")
+        params.append(int(until))
+
+    mode = "list"
+    like_words: List[str] = []
+    if use_fts:
+        mode = "fts"
+        sql = (
+            "SELECT l.id, l.username, l.level, l.message, l.created_at, "
+            f"snippet(logs_fts, 0, '{_SNIP_A}', '{_SNIP_B}', '…', 24) AS snip "
+            "FROM logs_fts JOIN logs l ON l.id = logs_fts.rowid WHERE logs_fts MATCH ?"
+        )
+        params.insert(0, _fts_query(term))
+        if where:
+            sql += " AND " + " AND ".join(where)
+    else:
+        if term:
+            mode = "like"
+            like_words = term.split()
+            for w in like_words:
+                where.append("l.message LIKE ? ESCAPE '\\'")
+                params.append("%" + w.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%")
+        sql = "SELECT l.id, l.username, l.level, l.message, l.created_at, NULL AS snip FROM logs l"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+    sql += f" ORDER BY {id_col} DESC LIMIT ?"
+    params.append(limit)
+
+    t0 = time.monotonic()
+    conn = db()
+    try:
+        rows = conn.execute(sql, tuple(params)).fetchall()
+    finally:
+        conn.close()
+
+    items = []
+    for r in rows:
+        msg = safe_str(r["message"])
+        snip = safe_str(r["snip"]) if r["snip"] is not None else _like_snippet(msg, like_words)
+        items.append({
+            "id": int(r["id"]),
+            "username": safe_str(r["username"]),
+            "level": safe_str(r["level"]),
+            "created_at": int(r["created_at"] or 0),
+            "message": msg,
+            "snippet": _snippet_html(snip),
+        })
+    return {
+        "mode": mode,
+        "items": items,
+        "next_before": items[-1]["id"] if len(items) >= limit else 0,
+        "took_ms": round((time.monotonic() - t0) * 1000.0, 2),
+    }
+
+
+def _admin_logs_filters() -> Dict[str, Any]:
+    a = request.args
+    try:
+        before = int(a.get("before") or 0)
+    except Exception:
+        before = 0
+    try:
+        limit = max(1, min(1000, int(a.get("limit") or 200)))
+    except Exception:
+        limit = 200
+    return {
+        "term": safe_str(a.get("q") or "").strip(),
+        "username": safe_str(a.get("user") or "").strip(),
+        "level": safe_str(a.get("level") or "").strip().upper(),
+        "since": _parse_day_ts(a.get("from") or ""),
+        "until": _parse_day_ts(a.get("to") or "", end=True),
+        "before": before,
+        "limit": limit,
+    }
+
+
+@app.get("/admin/logs/search.json")
+def admin_logs_search_json():
+    rr = require_admin()
+    if rr:
+        return rr
+    return jsonify(search_logs(**_admin_logs_filters()))
+
 
 @app.get("/admin/logs")
 def admin_logs():
@@ -8628,24 +11652,48 @@ def admin_logs():
     if rr:
         return rr
 
-    conn = db()
-    rows = conn.execute("SELECT * FROM logs ORDER BY id DESC LIMIT 200").fetchall()
-    conn.close()
+    # Keyset pagination: ?before=<id>; q (FTS5), user, level, from/to filtreleri
+    f = _admin_logs_filters()
+    res = search_logs(**f)
 
     lines = ""
-    for x in rows:
+    for x in res["items"]:
         t = datetime.utcfromtimestamp(int(x["created_at"] or 0)) + timedelta(hours=TZ_OFFSET_HOURS)
         ts = t.strftime("%Y-%m-%d %H:%M:%S")
-        lines += f'<div class="logline">{ts}  {x["level"]}  {x["username"]}  {x["message"]}</div>'
+        lines += f'<div class="logline">{ts}  {html_escape(x["level"])}  {html_escape(x["username"])}  {x["snippet"]}</div>'
+
+    base_q = {k: v for k, v in (("q", f["term"]), ("user", f["username"]), ("level", f["level"]),
+                                 ("from", request.args.get("from") or ""), ("to", request.args.get("to") or "")) if v}
+    nav = ""
+    if f["before"] > 0:
+        nav += f'<a class="btn secondary" href="/admin/logs?{urllib.parse.urlencode(base_q)}">⏮ En yeni</a> '
+    if res["next_before"]:
+        older_q = dict(base_q, before=res["next_before"])
+        nav += f'<a class="btn secondary" href="/admin/logs?{urllib.parse.urlencode(older_q)}">Daha eski ▶</a>'
+
+    level_opts = "".join(
+        f'<option value="{lv}"{" selected" if lv == f["level"] else ""}>{lv or "Tümü"}</option>'
+        for lv in ("", "INFO", "WARN", "ERROR")
+    )
+    info = f'{len(res["items"])} satır • {res["took_ms"]} ms' + (f' • {res["mode"].upper()}' if f["term"] else "")
 
     body = f"""
 <div class="card">
   <h2>{E_LOGS} Logs</h2>
-  <div class="muted">Tek satır görünüm</div>
+  <div class="muted">Tek satır görünüm • {info}</div>
+  <form method="get" action="/admin/logs" style="display:flex;gap:8px;flex-wrap:wrap;margin-top:10px">
+    <input class="input" name="q" placeholder="Ara (örn: AUTO BUY başarısız, debounce*)" value="{html_escape(f["term"])}" style="max-width:320px">
+    <input class="input" name="user" placeholder="Kullanıcı" value="{html_escape(f["username"])}" style="max-width:180px">
+    <select class="input" name="level" style="max-width:140px">{level_opts}</select>
+    <input class="input" type="date" name="from" value="{html_escape(request.args.get("from") or "")}" style="max-width:170px">
+    <input class="input" type="date" name="to" value="{html_escape(request.args.get("to") or "")}" style="max-width:170px">
+    <button class="btn" type="submit">Filtrele</button>
+  </form>
   <div class="hr"></div>
   <div style="display:flex;flex-direction:column;gap:10px">
     {lines if lines else '<div class="muted">Log yok</div>'}
   </div>
+  <div style="display:flex;gap:8px;margin-top:12px">{nav}</div>
 </div>
 """
     return base_html("Logs", body, nav_html(True))
@@ -8726,10 +11774,9 @@ def _set_auto_gate_for_all(gate: int, mode: str, reason: str) -> None:
 
 def _okx_fetch_candles(symbol: str, bar: str = "1H", limit: int = 260) -> List[Dict[str, Any]]:
     try:
-        import requests
         inst = safe_str(symbol).upper().replace("/", "-")
         url = "https://www.okx.com/api/v5/market/candles"
-        r = requests.get(url, params={"instId": inst, "bar": bar, "limit": int(limit)}, timeout=10)
+        r = http_get(url, params={"instId": inst, "bar": bar, "limit": int(limit)}, timeout=10)
         j = r.json() if r is not None else {}
         data = (j or {}).get("data") or []
         out: List[Dict[str, Any]] = []
@@ -8939,8 +11986,8 @@ def _auto_sell_defer_enqueue(username: str, exchange_id: str, symbol: str, reaso
     return True
 
 
-def _auto_sell_execute_now(username: str, u: dict, exchange_id: str, symbol: str) -> Dict[str, Any]:
-    """Webhook AUTO SELL'in mevcut davranışı: aynı semboldeki tüm pozisyonları kapat."""
+def _auto_sell_prepare(username: str, u: dict, exchange_id: str, symbol: str) -> Dict[str, Any]:
+    """Stack'i okur, SELL miktarını belirler. Hata: {"ok": False, "error"}; aksi halde SELL bağlamı."""
     # açık pozisyon(lar) bul (stack destekli)
     conn = db()
     try:
@@ -8976,6 +12023,43 @@ def _auto_sell_execute_now(username: str, u: dict, exchange_id: str, symbol: str
     if (not dry_run_pos) and (not may_trade(u)):
         return {"ok": False, "error": "Trade kapalı/limit dolu"}
 
+    ctx: Dict[str, Any] = {
+        "ok": True,
+        "symbol": symbol,
+        "positions": positions,
+        "dry_run": dry_run_pos,
+        "total_qty": total_qty,
+        "total_entry_usdt": total_entry_usdt,
+        "avg_entry_price": avg_entry_price,
+        "qty_to_sell": float(total_qty or 0.0),
+        "keys": {},
+    }
+    if not dry_run_pos:
+        keys = _keys_for_exchange(u, exchange_id)
+        ctx["keys"] = keys
+        if exchange_id == "OKX":
+            try:
+                base_ccy = _base_ccy_from_symbol(symbol)
+                bal_qty = tracked_asset_balance(exchange_id, safe_str(keys.get("api_key")), safe_str(keys.get("api_secret")),
+                                                safe_str(keys.get("api_passphrase")), base_ccy)
+                if bal_qty > 0:
+                    ctx["qty_to_sell"] = bal_qty
+            except Exception:
+                pass
+    return ctx
+
+
+def _auto_sell_finish(username: str, u: dict, exchange_id: str, ctx: Dict[str, Any],
+                      res: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """Emir sonucu (TEST'te None) -> PnL, pozisyon kapatma, trade, kullanım, log, Telegram."""
+    symbol = ctx["symbol"]
+    positions = ctx["positions"]
+    dry_run_pos = bool(ctx["dry_run"])
+    total_qty = ctx["total_qty"]
+    total_entry_usdt = ctx["total_entry_usdt"]
+    avg_entry_price = ctx["avg_entry_price"]
+    qty_to_sell = ctx["qty_to_sell"]
+
     ok = True
     err = ""
     pnl_usdt = 0.0
@@ -8992,22 +12076,6 @@ def _auto_sell_execute_now(username: str, u: dict, exchange_id: str, symbol: str
         cost_basis = total_entry_usdt if total_entry_usdt > 0 else ((avg_entry_price * sell_qty) if (avg_entry_price > 0 and sell_qty > 0) else 0.0)
         pnl_usdt = (proceeds - cost_basis) if (proceeds > 0 and cost_basis >= 0) else 0.0
     else:
-        keys = _keys_for_exchange(u, exchange_id)
-        api_key = safe_str(keys.get("api_key"))
-        api_secret = safe_str(keys.get("api_secret"))
-        api_pass = safe_str(keys.get("api_passphrase"))
-
-        qty_to_sell = float(total_qty or 0.0)
-        if exchange_id == "OKX":
-            try:
-                base_ccy = _base_ccy_from_symbol(symbol)
-                bal_qty = okx_get_asset_balance(base_ccy, api_key, api_secret, api_pass)
-                if bal_qty > 0:
-                    qty_to_sell = bal_qty
-            except Exception:
-                pass
-
-        res = place_order(exchange_id, "SELL", symbol, qty_to_sell, False, api_key, api_secret, api_pass)
         ok = bool((res or {}).get("ok"))
         err = safe_str((res or {}).get("reason") or "")
         if ok:
@@ -9044,29 +12112,18 @@ def _auto_sell_execute_now(username: str, u: dict, exchange_id: str, symbol: str
     if not ok:
         return {"ok": False, "error": err or "SELL başarısız"}
 
-    # pozisyon(lar)ı kapat
+    # pozisyon(lar)ı kapat + trade + kullanım + log (tek transaction)
     try:
-        conn = db()
+        commit_fill(
+            username, exchange_id, "SELL", symbol, dry_run_pos,
+            close_all=True, trade_usdt=proceeds, pnl_usdt=pnl_usdt, count_usage=True,
+            log=f"{E_BOT} AUTO SELL çalıştı: {exchange_id} {symbol} pnl={pnl_usdt:.6f}",
+        )
+    except Exception as e:
         try:
-            conn.execute(
-                "DELETE FROM open_positions WHERE username=? AND exchange_id=? AND symbol=? AND dry_run=?",
-                (username, exchange_id, symbol, 1 if dry_run_pos else 0),
-            )
-            conn.commit()
-        finally:
-            conn.close()
-    except Exception:
-        pass
-
-    try:
-        record_trade(username, exchange_id, "SELL", symbol, proceeds, pnl_usdt, False if not dry_run_pos else True)
-    except Exception:
-        pass
-
-    try:
-        inc_usage(username)
-    except Exception:
-        pass
+            log_line(username, "WARN", f"{E_X} AUTO SELL kaydı yazılamadı ({exchange_id} {symbol}): {e}")
+        except Exception:
+            pass
 
     try:
         telegram_send_for_user(
@@ -9083,14 +12140,121 @@ def _auto_sell_execute_now(username: str, u: dict, exchange_id: str, symbol: str
     except Exception:
         pass
 
-    try:
-        log_line(username, "INFO", f"{E_BOT} AUTO SELL çalıştı: {exchange_id} {symbol} pnl={pnl_usdt:.6f}")
-    except Exception:
-        pass
-
     return {"ok": True, "pnl_usdt": pnl_usdt, "fee_usdt_total": fee_total_usdt, "proceeds": proceeds}
 
 
+def _auto_sell_execute_now(username: str, u: dict, exchange_id: str, symbol: str) -> Dict[str, Any]:
+    """Webhook AUTO SELL'in mevcut davranışı: aynı semboldeki tüm pozisyonları kapat."""
+    ctx = _auto_sell_prepare(username, u, exchange_id, symbol)
+    if not ctx.get("ok"):
+        return ctx
+    res = None
+    if not ctx["dry_run"]:
+        keys = ctx["keys"]
+        res = place_order(exchange_id, "SELL", symbol, ctx["qty_to_sell"], False,
+                          safe_str(keys.get("api_key")), safe_str(keys.get("api_secret")), safe_str(keys.get("api_passphrase")))
+    return _auto_sell_finish(username, u, exchange_id, ctx, res)
+
+
+def _auto_sell_execute_batch(username: str, u: dict, exchange_id: str, symbols: List[str]) -> Dict[str, Dict[str, Any]]:
+    """Aynı kullanıcı + borsa için birden çok stack'i kapatır; canlı SELL'ler toplu emirle gider. symbol -> sonuç."""
+    results: Dict[str, Dict[str, Any]] = {}
+    live: List[Dict[str, Any]] = []
+    for symbol in dict.fromkeys(symbols):
+        ctx = _auto_sell_prepare(username, u, exchange_id, symbol)
+        if not ctx.get("ok"):
+            results[symbol] = ctx
+        elif ctx["dry_run"]:
+            results[symbol] = _auto_sell_finish(username, u, exchange_id, ctx, None)
+        else:
+            live.append(ctx)
+    if live:
+        keys = live[0]["keys"]
+        ress = place_order_batch(exchange_id, "SELL", [(c["symbol"], c["qty_to_sell"]) for c in live], False,
+                                 safe_str(keys.get("api_key")), safe_str(keys.get("api_secret")),
+                                 safe_str(keys.get("api_passphrase")))
+        for ctx, res in zip(live, ress):
+            results[ctx["symbol"]] = _auto_sell_finish(username, u, exchange_id, ctx, res)
+    return results
+
+
+# Aynı stack'te aktif olanı varken ikinci SELL işi açılmaz (toplu iş üyeleri dahil)
+_ORDER_SELL_KINDS = ("stack_sell", "auto_sell", "auto_sell_batch")
+
+
+def _auto_sell_submit(username: str, exchange_id: str, symbol: str, source: str, run_after: float = 0.0) -> int:
+    """_auto_sell_execute_now'u order engine'e SELL önceliğiyle verir; aynı stack için tek aktif iş."""
+    return order_job_submit("auto_sell", username, exchange_id, symbol, {"source": source},
+                            priority=ORDER_PRIO_SELL, run_after=run_after, claim_kinds=_ORDER_SELL_KINDS,
+                            dedupe_key=f"sell:{username}:{safe_str(exchange_id).upper()}:{symbol}")
+
+
+def _auto_sell_submit_many(due: Dict[Tuple[str, str], List[str]], source: str) -> None:
+    """Aynı turda vadesi gelen kapatmalar: kullanıcı + borsa başına tek iş; birden çok sembol toplu emirle gider."""
+    for (username, exchange_id), symbols in due.items():
+        symbols = list(dict.fromkeys(symbols))
+        try:
+            if len(symbols) == 1:
+                _auto_sell_submit(username, exchange_id, symbols[0], source)
+            else:
+                # aktif SELL işi olan semboller düşülür; kalanlar için her stack bu işe bağlanır
+                order_job_submit("auto_sell_batch", username, exchange_id, "", {"symbols": symbols, "source": source},
+                                 priority=ORDER_PRIO_SELL, symbols=symbols, claim_kinds=_ORDER_SELL_KINDS)
+        except Exception:
+            pass
+
+
+@order_job_handler("auto_sell_batch")
+def _job_auto_sell_batch(job: Dict[str, Any]) -> Dict[str, Any]:
+    username = safe_str(job.get("username"))
+    exchange_id = safe_str(job.get("exchange_id")).upper()
+    payload = job.get("payload") or {}
+    source = safe_str(payload.get("source") or "AUTO")
+    u = get_user(username)
+    if u and not isinstance(u, dict):
+        u = dict(u)
+    if not u:
+        return {"ok": False, "error": "Kullanıcı yok"}
+    results = _auto_sell_execute_batch(username, u, exchange_id, [safe_str(x) for x in payload.get("symbols") or []])
+    failed = {sym: safe_str(r.get("error") or "SELL başarısız") for sym, r in results.items() if not r.get("ok")}
+    for sym, err in failed.items():
+        try:
+            log_line(username, "WARN", f"{E_X} {source} SELL başarısız: {exchange_id} {sym} {err}")
+        except Exception:
+            pass
+    out: Dict[str, Any] = {"ok": not failed, "results": results}
+    if failed:
+        out["error"] = ", ".join(f"{sym}: {err}" for sym, err in failed.items())
+    return out
+
+
+@order_job_handler("auto_sell")
+def _job_auto_sell(job: Dict[str, Any]) -> Dict[str, Any]:
+    username = safe_str(job.get("username"))
+    exchange_id = safe_str(job.get("exchange_id")).upper()
+    symbol = safe_str(job.get("symbol"))
+    source = safe_str((job.get("payload") or {}).get("source") or "AUTO")
+    u = get_user(username)
+    if u and not isinstance(u, dict):
+        u = dict(u)
+    if not u:
+        return {"ok": False, "error": "Kullanıcı yok"}
+    res = _auto_sell_execute_now(username, u, exchange_id, symbol) or {}
+    ok = bool(res.get("ok"))
+    err = safe_str(res.get("error") or "SELL başarısız")
+    if source == "MANUEL":
+        try:
+            set_last_msg(username, f"{E_OK} SELL gönderildi {symbol}" if ok else f"{E_X} SELL başarısız: {err}")
+        except Exception:
+            pass
+    elif not ok:
+        try:
+            log_line(username, "WARN", f"{E_X} {source} SELL başarısız: {exchange_id} {symbol} {err}")
+        except Exception:
+            pass
+    return res
+
+
 def _auto_sell_defer_loop():
     if not AUTO_SELL_DEFER_ENABLED:
         return
@@ -9107,6 +12271,7 @@ def _auto_sell_defer_loop():
         if not items:
             continue
 
+        due: Dict[Tuple[str, str], List[str]] = {}
         for k, it in items:
             try:
                 username = safe_str(it.get("username"))
@@ -9124,7 +12289,7 @@ def _auto_sell_defer_loop():
 
                 # time limit dolduysa: zorla sat
                 if max_sec > 0 and age >= max_sec:
-                    _auto_sell_execute_now(username, u, exchange_id, symbol)
+                    due.setdefault((username, exchange_id), []).append(symbol)
                     with _DEFERRED_SELLS_LOCK:
                         _DEFERRED_SELLS.pop(k, None)
                     continue
@@ -9136,12 +12301,13 @@ def _auto_sell_defer_loop():
                     continue
 
                 # trend zayıfladı: sat
-                _auto_sell_execute_now(username, u, exchange_id, symbol)
+                due.setdefault((username, exchange_id), []).append(symbol)
                 with _DEFERRED_SELLS_LOCK:
                     _DEFERRED_SELLS.pop(k, None)
             except Exception:
                 # bu item'da hata olursa en azından kuyrukta kalıp bir sonraki turda tekrar denensin
                 continue
+        _auto_sell_submit_many(due, "DEFER")
 
 
 def start_auto_sell_defer_thread():
@@ -9239,6 +12405,17 @@ def _tp_manager_loop():
         except Exception:
             continue
 
+        # Fiyatları borsa başına tek snapshot isteğiyle ısıt; aşağıdaki get_public_price'lar cache'ten okur
+        try:
+            by_ex: Dict[str, List[str]] = {}
+            for r in (rows or []):
+                by_ex.setdefault(safe_str(r["exchange_id"]).upper(), []).append(normalize_symbol(safe_str(r["symbol"])))
+            for ex, syms in by_ex.items():
+                get_public_prices(ex, syms)
+        except Exception:
+            pass
+
+        due: Dict[Tuple[str, str], List[str]] = {}  # (username, exchange) -> kapatılacak semboller
         for r in (rows or []):
             try:
                 p = dict(r) if r is not None else {}
@@ -9300,22 +12477,25 @@ def _tp_manager_loop():
 
                 # Zorla çık (max hold)
                 if TP_MAX_HOLD_SEC > 0 and age >= TP_MAX_HOLD_SEC:
-                    _auto_sell_execute_now(username, u, exchange_id, symbol)
+                    due.setdefault((username, exchange_id), []).append(symbol)
                     continue
 
                 # Stop loss (opsiyonel)
                 if TP_NET_STOP_PCT < 0 and net_pnl_pct <= TP_NET_STOP_PCT:
-                    _auto_sell_execute_now(username, u, exchange_id, symbol)
+                    due.setdefault((username, exchange_id), []).append(symbol)
                     continue
 
                 # Take profit
                 if net_pnl_pct >= float(TP_NET_TARGET_PCT):
-                    _auto_sell_execute_now(username, u, exchange_id, symbol)
+                    due.setdefault((username, exchange_id), []).append(symbol)
                     continue
 
             except Exception:
                 continue
 
+        # aynı turda vadesi gelenler: kullanıcı + borsa başına tek (toplu) SELL işi
+        _auto_sell_submit_many(due, "TP")
+
 
 def start_tp_manager_thread():
     if not TP_MANAGER_ENABLED:
@@ -9399,36 +12579,6 @@ _tg_admin_state = {
     "last_update_id": 0,
 }
 
-def _db_init_security() -> None:
-    conn = db()
-    try:
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS ip_bans (
-                ip TEXT PRIMARY KEY,
-                banned_until INTEGER,
-                reason TEXT,
-                created_at INTEGER
-            )
-        """)
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS login_fails (
-                ip TEXT PRIMARY KEY,
-                fails INTEGER,
-                first_ts INTEGER,
-                last_ts INTEGER
-            )
-        """)
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS admin_flags (
-                k TEXT PRIMARY KEY,
-                v TEXT,
-                updated_at INTEGER
-            )
-        """)
-        conn.commit()
-    finally:
-        conn.close()
-
 def get_admin_flag(k: str, default: str = "") -> str:
     try:
         conn = db()
@@ -9551,13 +12701,6 @@ def clear_login_fail(ip: str) -> None:
     finally:
         conn.close()
 
-# Global guard (admin/login paths)
-@app.before_request
-def _security_guard_before_request():
-    try:
-        _db_init_security()
-    except Exception:
-        pass
 # ===============================
 # HTTPS redirect FIX (WEBHOOK)
 # ===============================
@@ -9642,23 +12785,132 @@ def tg_admin_pop_confirm(code: str) -> Optional[dict]:
         pass
     return d
 
+# =========================
+# DB backup (SQLite online backup API)
+# =========================
+# shutil.copy2 WAL altında yırtık kopya üretebilir ve büyük DB'de diski tek seferde kilitler.
+# Burada sqlite3 backup API'si sayfa sayfa (BACKUP_PAGES_PER_STEP) kopyalar, adımlar arasında
+# uyuyarak canlı sunucuya yol verir; çıktı stream halinde gzip'lenir.
+BACKUP_DIR = os.getenv("BACKUP_DIR", "").strip()  # boş = DB dosyasının yanında backups/
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "14").strip() or "14")  # 0 = sınırsız
+BACKUP_PAGES_PER_STEP = int(os.getenv("BACKUP_PAGES_PER_STEP", "512").strip() or "512")
+BACKUP_STEP_SLEEP_MS = float(os.getenv("BACKUP_STEP_SLEEP_MS", "5").strip() or "5")
+BACKUP_GZIP_LEVEL = int(os.getenv("BACKUP_GZIP_LEVEL", "6").strip() or "6")
+
+_BACKUP_LOCK = threading.Lock()
+_BACKUP_STATS: Dict[str, Any] = {
+    "count": 0,
+    "failures": 0,
+    "last_path": "",
+    "last_ok_at": 0,
+    "last_duration_ms": 0,
+    "last_db_bytes": 0,
+    "last_gz_bytes": 0,
+    "last_error": "",
+}
+
+
+def _backup_dir() -> str:
+    if BACKUP_DIR:
+        return os.path.abspath(BACKUP_DIR)
+    return os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), "backups")
+
+
+def _backup_prune(bdir: str, keep: int) -> int:
+    """data_YYYYmmdd_HHMMSS.db(.gz) dosyalarından en yeni `keep` tanesi kalır."""
+    if keep <= 0:
+        return 0
+    try:
+        names = sorted(
+            n for n in os.listdir(bdir)
+            if n.startswith("data_") and (n.endswith(".db.gz") or n.endswith(".db"))
+        )
+    except Exception:
+        return 0
+    removed = 0
+    stale = names[:-keep] if len(names) > keep else []
+    for n in stale:
+        try:
+            os.remove(os.path.join(bdir, n))
+            removed += 1
+        except Exception:
+            pass
+    return removed
+
+
+def db_backup_stats() -> Dict[str, Any]:
+    return dict(_BACKUP_STATS)
+
+
 def _run_db_backup_now() -> str:
     # returns path or ""
+    if not DB_PATH or not os.path.exists(os.path.abspath(DB_PATH)):
+        return ""
+    if not _BACKUP_LOCK.acquire(blocking=False):
+        return ""  # başka bir backup zaten çalışıyor
+    t0 = time.monotonic()
+    tmp_db = ""
+    tmp_gz = ""
     try:
-        db_path = DB_PATH
-        if not db_path:
-            return ""
-        src = os.path.abspath(db_path)
-        if not os.path.exists(src):
-            return ""
-        bdir = os.path.join(os.path.dirname(src), "backups")
+        bdir = _backup_dir()
         os.makedirs(bdir, exist_ok=True)
         ts = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
-        dst = os.path.join(bdir, f"data_{ts}.db")
-        shutil.copy2(src, dst)
+        dst = os.path.join(bdir, f"data_{ts}.db.gz")
+        tmp_db = os.path.join(bdir, f".data_{ts}.db.tmp")
+        tmp_gz = dst + ".tmp"
+
+        src = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT_MS / 1000.0)
+        out = sqlite3.connect(tmp_db)
+        try:
+            # Okuma snapshot'ını sabitle: diğer writer'lar backup'ı baştan başlatmasın
+            src.execute("BEGIN")
+            src.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchall()
+            sleep_s = max(0.0, BACKUP_STEP_SLEEP_MS) / 1000.0
+            src.backup(
+                out,
+                pages=max(1, BACKUP_PAGES_PER_STEP),
+                progress=(lambda status, remaining, total: time.sleep(sleep_s)) if sleep_s > 0 else None,
+            )
+            src.rollback()
+        finally:
+            out.close()
+            src.close()
+
+        db_bytes = os.path.getsize(tmp_db)
+        with open(tmp_db, "rb") as fin, gzip.open(tmp_gz, "wb", compresslevel=BACKUP_GZIP_LEVEL) as fout:
+            shutil.copyfileobj(fin, fout, 1024 * 1024)
+        os.replace(tmp_gz, dst)
+
+        dur_ms = int((time.monotonic() - t0) * 1000)
+        gz_bytes = os.path.getsize(dst)
+        removed = _backup_prune(bdir, BACKUP_KEEP)
+        _BACKUP_STATS.update({
+            "count": int(_BACKUP_STATS["count"]) + 1,
+            "last_path": dst,
+            "last_ok_at": now_ts(),
+            "last_duration_ms": dur_ms,
+            "last_db_bytes": int(db_bytes),
+            "last_gz_bytes": int(gz_bytes),
+            "last_error": "",
+        })
+        log_line("admin", "INFO", f"DB backup ok {os.path.basename(dst)} db={db_bytes}B gz={gz_bytes}B {dur_ms}ms pruned={removed}")
         return dst
-    except Exception:
+    except Exception as e:
+        _BACKUP_STATS["failures"] = int(_BACKUP_STATS["failures"]) + 1
+        _BACKUP_STATS["last_error"] = safe_str(e)
+        try:
+            log_line("admin", "WARN", f"DB backup failed: {e}")
+        except Exception:
+            pass
         return ""
+    finally:
+        for p in (tmp_db, tmp_gz):
+            try:
+                if p and os.path.exists(p):
+                    os.remove(p)
+            except Exception:
+                pass
+        _BACKUP_LOCK.release()
 
 def _backup_scheduler_loop():
     # daily backup at 04:05 server local time
@@ -9674,6 +12926,85 @@ def _backup_scheduler_loop():
         except Exception:
             time.sleep(60)
 
+# =========================
+# Log retention (arşiv + batch silme)
+# =========================
+# LOG_RETENTION_DAYS'ten eski satırlar tarih bazlı NDJSON.gz dosyalarına eklenir, sonra
+# LOG_RETENTION_BATCH'lik parçalarla silinir. Arşiv yazıldıktan sonra silinir:
+# crash olursa bir sonraki turda aynı satırlar tekrar arşivlenebilir (kayıp olmaz).
+LOG_RETENTION_DAYS = int(os.getenv("LOG_RETENTION_DAYS", "30").strip() or "30")  # 0 = kapalı
+LOG_RETENTION_BATCH = int(os.getenv("LOG_RETENTION_BATCH", "5000").strip() or "5000")
+LOG_RETENTION_CHECK_SEC = float(os.getenv("LOG_RETENTION_CHECK_SEC", "3600").strip() or "3600")
+LOG_RETENTION_PAUSE_MS = float(os.getenv("LOG_RETENTION_PAUSE_MS", "50").strip() or "50")
+LOG_ARCHIVE_DIR = os.getenv("LOG_ARCHIVE_DIR", "").strip()  # boş = DB dosyasının yanında logs_archive/
+
+
+def _log_archive_dir() -> str:
+    if LOG_ARCHIVE_DIR:
+        return os.path.abspath(LOG_ARCHIVE_DIR)
+    return os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), "logs_archive")
+
+
+def run_log_retention_now(days: Optional[int] = None) -> Dict[str, Any]:
+    days = LOG_RETENTION_DAYS if days is None else int(days)
+    out = {"archived": 0, "deleted": 0, "files": []}
+    if days <= 0:
+        return out
+    cutoff = now_ts() - days * 86400
+    adir = _log_archive_dir()
+    os.makedirs(adir, exist_ok=True)
+    files = set()
+    while True:
+        conn = db()
+        try:
+            rows = conn.execute(
+                "SELECT id, username, level, message, created_at FROM logs "
+                "WHERE created_at < ? ORDER BY created_at, id LIMIT ?",
+                (cutoff, max(1, LOG_RETENTION_BATCH)),
+            ).fetchall()
+        finally:
+            conn.close()
+        if not rows:
+            break
+
+        # Gün (UTC) bazlı partition; gzip append = çok üyeli gzip, gzip.open ile okunur
+        by_day: Dict[str, List[str]] = {}
+        for r in rows:
+            day = datetime.fromtimestamp(int(r["created_at"] or 0), timezone.utc).strftime("%Y-%m-%d")
+            by_day.setdefault(day, []).append(json.dumps(dict(r), ensure_ascii=False))
+        for day, lines in by_day.items():
+            path = os.path.join(adir, f"logs_{day}.ndjson.gz")
+            with gzip.open(path, "at", encoding="utf-8") as f:
+                f.write("\n".join(lines) + "\n")
+            files.add(path)
+        out["archived"] += len(rows)
+
+        with db_session() as conn:
+            conn.executemany("DELETE FROM logs WHERE id=?", [(int(r["id"]),) for r in rows])
+        out["deleted"] += len(rows)
+
+        if len(rows) < LOG_RETENTION_BATCH:
+            break
+        time.sleep(max(0.0, LOG_RETENTION_PAUSE_MS) / 1000.0)  # canlı yazılara yol ver
+    out["files"] = sorted(files)
+    return out
+
+
+def _log_retention_loop():
+    if LOG_RETENTION_DAYS <= 0:
+        return
+    while True:
+        try:
+            res = run_log_retention_now()
+            if res.get("deleted"):
+                log_line("admin", "INFO", f"Log retention: {res['deleted']} satır arşivlendi ({len(res['files'])} dosya)")
+        except Exception as e:
+            try:
+                log_line("admin", "WARN", f"Log retention failed: {e}")
+            except Exception:
+                pass
+        time.sleep(max(60.0, LOG_RETENTION_CHECK_SEC))
+
 def _tg_handle_admin_command(text: str) -> None:
     t = safe_str(text).strip()
     if not t:
@@ -9760,7 +13091,13 @@ def _tg_handle_admin_command(text: str) -> None:
             elif cmd == "backup":
                 path = _run_db_backup_now()
                 if path:
-                    tg_admin_send(f"{E_OK} Backup hazır: {path}")
+                    st = db_backup_stats()
+                    tg_admin_send(
+                        f"{E_OK} Backup hazır: {path}\n"
+                        f"{int(st.get('last_gz_bytes') or 0) / 1048576:.1f} MB (gz) • "
+                        f"{int(st.get('last_db_bytes') or 0) / 1048576:.1f} MB (db) • "
+                        f"{int(st.get('last_duration_ms') or 0)} ms"
+                    )
                 else:
                     tg_admin_send(f"{E_X} Backup alınamadı")
             else:
@@ -9823,7 +13160,7 @@ def _tg_poll_loop():
         try:
             url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/getUpdates"
             params = {"timeout": 25, "offset": offset + 1, "allowed_updates": json.dumps(["message"])}
-            r = requests.get(url, params=params, timeout=40)
+            r = http_get(url, params=params, timeout=40)
             j = r.json() if r.ok else {}
             if not (j.get("ok") is True):
                 time.sleep(3)
@@ -10240,10 +13577,20 @@ def admin_panel():
 
 
 if __name__ == "__main__":
-    try:
-        _db_init_security()
-    except Exception:
-        pass
+    # CLI: python server.py db-index-report
+    if len(sys.argv) > 1 and sys.argv[1] == "db-index-report":
+        _print_db_index_report()
+        sys.exit(0)
+    # CLI: python server.py rebuild-pnl-rollups
+    if len(sys.argv) > 1 and sys.argv[1] == "rebuild-pnl-rollups":
+        db_writer_flush()
+        with db_session() as _conn:
+            print("pnl_rollups rows:", rebuild_pnl_rollups(_conn))
+        sys.exit(0)
+    # CLI: python server.py ws-standin [port]  (market-data WS stand-in, testler için)
+    if len(sys.argv) > 1 and sys.argv[1] == "ws-standin":
+        run_ws_standin(int(sys.argv[2]) if len(sys.argv) > 2 else 8765)
+        sys.exit(0)
 
     # Background jobs (non-blocking)
     try:
@@ -10254,5 +13601,33 @@ if __name__ == "__main__":
         threading.Thread(target=_tg_poll_loop, daemon=True).start()
     except Exception:
         pass
+    try:
+        threading.Thread(target=_log_retention_loop, daemon=True).start()
+    except Exception:
+        pass
+    try:
+        market_ws_start()
+    except Exception:
+        pass
+    try:
+        price_refresher_start()
+    except Exception:
+        pass
+    try:
+        coingecko_poller_start()
+    except Exception:
+        pass
+    try:
+        balance_tracker_start()
+    except Exception:
+        pass
+    try:
+        order_engine_start()
+    except Exception:
+        pass
+    try:
+        instrument_registry_start()
+    except Exception:
+        pass
 
     app.run(host=HOST, port=PORT, debug=False)
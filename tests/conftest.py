@@ -0,0 +1,22 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# server.py import sırasında DB'yi açar ve thread başlatır: geçici DB, arka plan döngüleri kapalı
+_TMP = tempfile.mkdtemp(prefix="autotrade-test-")
+os.environ["DB_PATH"] = os.path.join(_TMP, "test.db")
+os.environ["TP_MANAGER_ENABLED"] = "0"
+os.environ["AUTO_REGIME_ENABLED"] = "0"
+os.environ["AUTO_SELL_DEFER_ENABLED"] = "0"
+os.environ["DRY_RUN"] = "1"
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server as _server  # noqa: E402
+
+
+@pytest.fixture
+def server():
+    return _server
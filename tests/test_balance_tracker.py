@@ -0,0 +1,79 @@
+import threading
+import time
+
+
+def _adapter(server, key):
+    ad = server.exchange_adapter("OKX", key, "secret", "pass")
+    assert ad is not None
+    return ad
+
+
+def test_fill_debits_and_credits_known_balances(server):
+    ad = _adapter(server, "bt-fill")
+    server._balance_track_set(ad, "USDT", 1000.0, "rest")
+    server._balance_track_set(ad, "BTC", 0.0, "rest")
+
+    server.balance_track_fill(ad, "BUY", "BTC", 0.01, 600.0, fee_coin=0.00001, fee_coin_ccy="BTC")
+    assert server.balance_snapshot(ad, "USDT") == 400.0
+    assert abs(server.balance_snapshot(ad, "BTC") - 0.00999) < 1e-12
+
+    server.balance_track_fill(ad, "SELL", "BTC", 0.005, 310.0, fee_usdt=0.31)
+    assert abs(server.balance_snapshot(ad, "USDT") - 709.69) < 1e-9
+    assert abs(server.balance_snapshot(ad, "BTC") - 0.00499) < 1e-12
+
+    # bilinmeyen asset'e dokunulmaz; reconcile doldurur
+    server.balance_track_fill(ad, "BUY", "ETH", 1.0, 100.0)
+    assert server.balance_snapshot(ad, "ETH") is None
+
+
+def test_reconcile_corrects_drift(server, monkeypatch):
+    ad = _adapter(server, "bt-drift")
+    server._balance_track_set(ad, "USDT", 1000.0, "rest")
+    server._balance_track_set(ad, "BTC", 0.0, "rest")
+    server.balance_track_fill(ad, "BUY", "BTC", 0.01, 600.0)
+    assert server.balance_snapshot(ad, "USDT") == 400.0
+
+    # borsa farklı fee kesmiş: gerçek bakiye takip edilenden düşük
+    exchange = {"USDT": 399.4, "BTC": 0.0099}
+    monkeypatch.setattr(ad, "_get_balance", lambda ccy: exchange[ccy])
+    monkeypatch.setattr(server, "BALANCE_RECONCILE_DELAY_SEC", 0.05)
+    server.balance_reconcile_soon(ad, ["USDT"])
+    server.balance_reconcile_soon(ad, ["BTC"])  # bekleyenle birleşir
+
+    end = time.monotonic() + 5.0
+    while time.monotonic() < end and server.balance_tracker_stats()["reconcile_pending"]:
+        time.sleep(0.02)
+    end = time.monotonic() + 5.0
+    while time.monotonic() < end and ad.balances["BTC"][2] != "rest":
+        time.sleep(0.02)
+    assert ad.balances["USDT"][:1] == (399.4,) and ad.balances["USDT"][2] == "rest"
+    assert ad.balances["BTC"][:1] == (0.0099,) and ad.balances["BTC"][2] == "rest"
+
+
+def test_private_ws_started_once_under_concurrency(server, monkeypatch):
+    ad = _adapter(server, "bt-ws")
+    started = []
+    release = threading.Event()
+
+    def fake_loop(a):
+        started.append(a)
+        release.wait(5.0)
+        with server._BAL_TRACK_LOCK:
+            a._ws_started = False
+
+    monkeypatch.setattr(server, "OKX_PRIVATE_WS_ENABLED", True)
+    monkeypatch.setattr(server, "_okx_private_ws_loop", fake_loop)
+    gate = threading.Barrier(8)
+
+    def call():
+        gate.wait()
+        server.okx_private_ws_ensure(ad)
+
+    ths = [threading.Thread(target=call) for _ in range(8)]
+    for t in ths:
+        t.start()
+    for t in ths:
+        t.join()
+    time.sleep(0.1)
+    release.set()
+    assert len(started) == 1
@@ -0,0 +1,46 @@
+def _scratch_table(server, name):
+    with server.db_session() as conn:
+        conn.execute(f"DROP TABLE IF EXISTS {name}")
+        conn.execute(f"CREATE TABLE {name} (id INTEGER PRIMARY KEY, v TEXT)")
+
+
+def _count(server, name):
+    conn = server.db()
+    try:
+        return int(conn.execute(f"SELECT COUNT(*) FROM {name}").fetchone()[0])
+    finally:
+        conn.close()
+
+
+def test_sync_mode_write_is_visible_on_return(server):
+    _scratch_table(server, "t_writer_sync")
+    server.db_writer_set_sync(True)
+    try:
+        server.db_write("INSERT INTO t_writer_sync (v) VALUES (?)", ("a",))
+        assert _count(server, "t_writer_sync") == 1
+        assert server.db_writer_stats()["queued"] == 0
+    finally:
+        server.db_writer_set_sync(False)
+
+
+def test_group_commit_batches_and_flush(server, monkeypatch):
+    _scratch_table(server, "t_writer_batch")
+    server.db_writer_set_sync(False)
+    # açık bir batch penceresi kalmasın: önce boşalt, sonra pencereyi uzat, tekrar boşalt
+    server.db_write("SELECT 1")
+    assert server.db_writer_flush(timeout=5.0)
+    monkeypatch.setattr(server, "DB_WRITER_BATCH_MS", 5000.0)
+    assert server.db_writer_flush(timeout=5.0)
+    before = server.db_writer_stats()
+
+    # batch penceresi uzun: flush gelene kadar hiçbir şey commit edilmemeli
+    for i in range(20):
+        server.db_write("INSERT INTO t_writer_batch (v) VALUES (?)", (str(i),))
+    assert _count(server, "t_writer_batch") == 0
+
+    assert server.db_writer_flush(timeout=5.0)
+    after = server.db_writer_stats()
+    assert _count(server, "t_writer_batch") == 20
+    assert after["rows"] - before["rows"] == 20
+    assert after["batches"] - before["batches"] == 1
+    assert after["queued"] == 0
@@ -0,0 +1,47 @@
+import threading
+import time
+
+
+def _wait(pred, timeout=8.0):
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        v = pred()
+        if v:
+            return v
+        time.sleep(0.05)
+    return None
+
+
+def test_feed_against_standin_resubscribes_and_falls_back_to_rest(server, monkeypatch):
+    sa = server.ws_standin_start(tick_sec=0.05)
+    port = sa["port"]
+    monkeypatch.setenv("MARKET_WS_URL_OKX", f"ws://127.0.0.1:{port}/okx")
+    monkeypatch.setattr(server, "_md_wanted_symbols", lambda: {"OKX": {"BTC/USDT"}})
+    monkeypatch.setattr(server, "MARKET_WS_BACKOFF_MAX_SEC", 1.0)
+    threading.Thread(target=server._md_ws_loop, args=("OKX",), daemon=True).start()
+
+    try:
+        q = _wait(lambda: server.get_price_quote("OKX", "BTC/USDT"))
+        assert q and q["src"] == "ws"
+        assert q["bid"] and q["ask"] and q["ex_ts"] > 0
+        st = server.market_ws_stats()["OKX"]
+        assert st["connected"] and st["subs"] == 1
+
+        # soket düşer -> loop yeniden bağlanıp yeniden abone olmalı
+        sa["stop"]()
+        assert _wait(lambda: not server.market_ws_stats()["OKX"]["connected"])
+        last_ts = server.get_price_quote("OKX", "BTC/USDT")["ex_ts"]
+        sa = server.ws_standin_start(port=port, tick_sec=0.05)
+        q = _wait(lambda: (server.get_price_quote("OKX", "BTC/USDT") or {}).get("ex_ts", 0) > last_ts
+                  and server.get_price_quote("OKX", "BTC/USDT"))
+        assert q and q["src"] == "ws"
+        assert server.market_ws_stats()["OKX"]["reconnects"] >= 1
+    finally:
+        sa["stop"]()
+
+    # tick'ler kesilince cache TTL dolar, okuyucu REST yoluna düşer
+    monkeypatch.setattr(server, "PRICE_CACHE_TTL_SEC", 0.3)
+    monkeypatch.setattr(server, "_public_price_fetch", lambda ex, sym: 42.0)
+    assert _wait(lambda: server.get_price_quote("OKX", "BTC/USDT") is None)
+    assert server.get_public_price("OKX", "BTC/USDT") == 42.0
+    assert server.get_price_quote("OKX", "BTC/USDT")["src"] == "rest"
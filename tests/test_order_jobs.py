@@ -0,0 +1,96 @@
+import pytest
+
+
+@pytest.fixture
+def jobs(server, monkeypatch):
+    # worker'lar çalışmasın: claim'ler testte elle yapılır
+    monkeypatch.setattr(server, "order_engine_start", lambda: None)
+    notified = []
+    monkeypatch.setattr(server, "_order_jobs_notify_failed", lambda rows, why: notified.extend(int(r["id"]) for r in rows))
+    with server.db_session() as conn:
+        conn.execute("DELETE FROM order_jobs")
+        conn.execute("DELETE FROM order_job_keys")
+    return notified
+
+
+def _claim(server, max_priority=1 << 30):
+    job = server._order_job_claim(max_priority)
+    return int(job["id"]) if job else None
+
+
+def _status(server, jid):
+    return server.order_job_get(jid)["status"]
+
+
+def test_same_stack_sell_waits_for_earlier_buy(server, jobs):
+    buy = server.order_job_submit("webhook_buy", "u1", "OKX", "BTC-USDT", priority=server.ORDER_PRIO_BUY)
+    sell = server.order_job_submit("auto_sell", "u1", "okx", "BTC/USDT", priority=server.ORDER_PRIO_SELL)
+    other = server.order_job_submit("auto_sell", "u1", "OKX", "ETH/USDT", priority=server.ORDER_PRIO_SELL)
+
+    # SELL önceliği yüksek ama aynı stack'te önceki BUY bekliyor: önce diğer stack'in SELL'i, sonra BUY
+    assert _claim(server) == other
+    assert _claim(server) == buy
+    assert _claim(server) is None  # BUY RUNNING iken SELL alınmaz
+    server._order_job_finish(buy, {"ok": True})
+    assert _claim(server) == sell
+
+
+def test_sell_lane_skips_buys(server, jobs):
+    buy = server.order_job_submit("webhook_buy", "u2", "OKX", "BTC/USDT", priority=server.ORDER_PRIO_BUY)
+    sell = server.order_job_submit("auto_sell", "u2", "OKX", "ETH/USDT", priority=server.ORDER_PRIO_SELL)
+    assert _claim(server, server.ORDER_PRIO_SELL) == sell
+    assert _claim(server, server.ORDER_PRIO_SELL) is None
+    assert _status(server, buy) == "QUEUED"
+    assert _claim(server) == buy
+
+
+def test_claim_kinds_drop_batch_members_with_active_sell(server, jobs):
+    single = server._auto_sell_submit("u3", "OKX", "AAA/USDT", "AUTO")
+    server._auto_sell_submit_many({("u3", "OKX"): ["AAA/USDT", "BBB/USDT"]}, "TP")
+
+    conn = server.db()
+    try:
+        rows = conn.execute("SELECT id, kind FROM order_jobs WHERE username='u3' ORDER BY id").fetchall()
+    finally:
+        conn.close()
+    assert [r["kind"] for r in rows] == ["auto_sell", "auto_sell_batch"]
+    batch = int(rows[1]["id"])
+    assert server.order_job_get(batch)["payload"]["symbols"] == ["BBB/USDT"]
+
+    # tek sembol SELL'ler aktif işi (toplu iş dahil) geri döner, yenisini açmaz
+    assert server._auto_sell_submit("u3", "OKX", "AAA/USDT", "AUTO") == single
+    assert server._auto_sell_submit("u3", "OKX", "BBB-USDT", "AUTO") == batch
+    server._auto_sell_submit_many({("u3", "OKX"): ["AAA/USDT", "BBB/USDT"]}, "TP")
+    conn = server.db()
+    try:
+        assert conn.execute("SELECT COUNT(*) FROM order_jobs WHERE username='u3'").fetchone()[0] == 2
+    finally:
+        conn.close()
+
+
+def test_expired_jobs_fail_and_notify(server, jobs):
+    jid = server.order_job_submit("auto_sell", "u4", "OKX", "BTC/USDT", priority=server.ORDER_PRIO_SELL)
+    with server.db_session() as conn:
+        conn.execute("UPDATE order_jobs SET created_at=? WHERE id=?", (server.now_ts() - int(server.ORDER_JOB_MAX_AGE_SEC) - 5, jid))
+    assert _claim(server) is None
+    job = server.order_job_get(jid)
+    assert job["status"] == "FAILED" and job["error"] == "expired"
+    assert jobs == [jid]
+
+
+def test_recover_ignores_own_running_jobs(server, jobs):
+    old = server.now_ts() - int(server.ORDER_JOB_STALE_SEC) - 60
+    ids = {}
+    with server.db_session() as conn:
+        for name, owner, hb in (("own", server._ORDER_OWNER, old), ("dead", "other:1:x", old),
+                                ("alive", "other:2:y", server.now_ts())):
+            cur = conn.execute(
+                "INSERT INTO order_jobs (kind, username, status, created_at, started_at, heartbeat_at, owner) "
+                "VALUES ('auto_sell', 'u5', 'RUNNING', ?, ?, ?, ?)", (old, old, hb, owner))
+            ids[name] = int(cur.lastrowid)
+
+    assert server.order_jobs_recover() == 1
+    assert _status(server, ids["dead"]) == "FAILED"
+    assert _status(server, ids["own"]) == "RUNNING"
+    assert _status(server, ids["alive"]) == "RUNNING"
+    assert jobs == [ids["dead"]]